@@ -0,0 +1,522 @@
+"""
+Record/replay e benchmark offline della pipeline SERP (pages/1-SERP-Analyzer.py).
+
+Tre comandi:
+  record  -> esegue analisi reali passando da un proxy locale che salva le risposte DataForSEO
+             (live/advanced, live/regular, task_get) in --fixtures. Costa credito: va fatto una volta.
+  serve   -> avvia solo lo stub locale (replay delle fixture, latenza ed errori iniettati);
+             per usarlo dall'app: DATAFORSEO_API_BASE=http://127.0.0.1:PORT streamlit run Home.py
+  bench   -> avvia lo stub in-process ed esegue run_serp_analysis per 1, 100, 10.000 keyword
+             (configurabile), misurando throughput, latenza delle chiamate (p50/p95/p99),
+             memoria e i tempi di export e grafici sul risultato.
+
+Esempi:
+  python benchmarks/serp_replay.py record --login L --password P --keywords "scarpe running" "hotel roma"
+  python benchmarks/serp_replay.py bench --sizes 1 100 10000 --latency-ms 80 --jitter-ms 40 --error-rate 0.02
+  python benchmarks/serp_replay.py bench --sizes 100 --stages fetch charts --json bench.json
+
+Senza fixture registrate lo stub usa una SERP sintetica (organic + feature più comuni):
+i numeri restano confrontabili tra due versioni del codice, non con l'API reale.
+"""
+import argparse
+import hashlib
+import importlib.util
+import io
+import json
+import os
+import random
+import resource
+import socket
+import sys
+import threading
+import time
+import tracemalloc
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from pathlib import Path
+from urllib.parse import parse_qs
+
+import httpx
+
+ROOT = Path(__file__).resolve().parent.parent
+PAGE_PATH = ROOT / "pages" / "1-SERP-Analyzer.py"
+DEFAULT_FIXTURES = Path(__file__).resolve().parent / "fixtures"
+UPSTREAM = "https://api.dataforseo.com"
+# La parte UI della pagina non serve al benchmark: si carica solo il codice prima di questo marker
+UI_MARKER = "\n# ----------------------------\n# UI\n# ----------------------------\n"
+
+
+# ----------------------------
+# FIXTURE
+# ----------------------------
+def _task_start(task: dict) -> int:
+    """Offset della pagina (search_param start=N), 0 in modalità depth."""
+    return int(parse_qs(task.get("search_param", "")).get("start", ["0"])[0])
+
+def _fixture_key(kind: str, task: dict) -> str:
+    identity = [kind, task.get("keyword"), task.get("location_code"), task.get("device"),
+                task.get("depth"), _task_start(task), bool(task.get("calculate_rectangles"))]
+    return hashlib.sha1(json.dumps(identity).encode()).hexdigest()[:16]
+
+def _synthetic_response(kind: str) -> dict:
+    """Template usato quando non ci sono fixture: 100 organic + featured snippet, PAA, local pack."""
+    items = [
+        {"type": "featured_snippet", "rank_group": 1, "rank_absolute": 1, "domain": "www.snippet.it",
+         "url": "https://www.snippet.it/guida", "title": "Guida completa", "description": "Risposta in evidenza"},
+        {"type": "people_also_ask", "rank_group": 1, "rank_absolute": 3,
+         "items": [{"type": "people_also_ask_element", "title": f"Domanda {i}?"} for i in range(4)]},
+        {"type": "local_pack", "rank_group": 1, "rank_absolute": 5, "title": "Negozio Centro",
+         "domain": "negozio.it", "rating": {"value": 4.6, "votes_count": 87}},
+    ]
+    for i in range(100):
+        domain = f"www.sito{i % 23}.{'it' if i % 3 else 'com'}"
+        items.append({
+            "type": "organic", "rank_group": i + 1, "rank_absolute": i + 4, "domain": domain,
+            "url": f"https://{domain}/categoria/pagina-{i}", "title": f"Titolo del risultato organico {i}",
+            "description": f"Descrizione del risultato {i}. " + "Testo di esempio " * (i % 9),
+        })
+    return {"status_code": 20000, "status_message": "Ok.", "cost": 0.002,
+            "tasks": [{"id": "template", "status_code": 20000, "status_message": "Ok.", "cost": 0.002,
+                       "path": kind.split("/"), "data": {},
+                       "result": [{"keyword": "", "type": "organic", "items_count": len(items), "items": items}]}]}
+
+class FixtureStore:
+    """Risposte registrate: una per file JSON (kind, richiesta, risposta) in `root`."""
+
+    def __init__(self, root: Path):
+        self.root = Path(root)
+        self.exact = {}
+        self.templates = {}
+        if self.root.is_dir():
+            for path in sorted(self.root.glob("*.json")):
+                fixture = json.loads(path.read_text(encoding="utf-8"))
+                self.exact[_fixture_key(fixture["kind"], fixture["task"])] = fixture["response"]
+                current = self.templates.get(fixture["kind"])
+                if current is None or self._items_count(fixture["response"]) > self._items_count(current):
+                    self.templates[fixture["kind"]] = fixture["response"]
+
+    @staticmethod
+    def _items_count(response: dict) -> int:
+        try:
+            return len(response["tasks"][0]["result"][0]["items"] or [])
+        except (KeyError, IndexError, TypeError):
+            return 0
+
+    def save(self, kind: str, task: dict, response: dict):
+        self.root.mkdir(parents=True, exist_ok=True)
+        key = _fixture_key(kind, task)
+        fixture = {"kind": kind, "task": task, "response": response}
+        (self.root / f"{kind.replace('/', '_')}-{key}.json").write_text(json.dumps(fixture, ensure_ascii=False), encoding="utf-8")
+        self.exact[key] = response
+
+    def response_for(self, kind: str, task: dict) -> dict:
+        """Risposta registrata per la stessa richiesta; altrimenti il template del tipo riadattato."""
+        recorded = self.exact.get(_fixture_key(kind, task))
+        if recorded is not None:
+            return recorded
+        template = (self.templates.get(kind) or self.templates.get("live/advanced")
+                    or self.templates.get("task_get/advanced") or _synthetic_response(kind))
+        return self._adapt(template, task)
+
+    @staticmethod
+    def _adapt(template: dict, task: dict) -> dict:
+        """Template -> risposta per keyword/pagina richieste: organic rinumerati da `start`, fino a `depth`."""
+        start, depth = _task_start(task), int(task.get("depth") or 10)
+        source = template["tasks"][0]["result"][0]["items"] or []
+        organic = [it for it in source if it.get("type") == "organic"]
+        items = [dict(it) for it in source if it.get("type") != "organic"] if start == 0 else []
+        for rank in range(start, start + depth):
+            if not organic:
+                break
+            base = dict(organic[rank % len(organic)])
+            if rank >= len(organic):
+                # Oltre il template gli URL si ripetono: un frammento li rende distinti come in una SERP reale
+                base["url"] = f"{base['url']}#r{rank}"
+            base["rank_group"] = rank + 1
+            base["rank_absolute"] = rank + 1 + len(items)
+            items.append(base)
+        if not task.get("calculate_rectangles"):
+            for it in items:
+                it.pop("rectangle", None)
+        cost = template.get("cost") or 0.002
+        return {"status_code": 20000, "status_message": "Ok.", "cost": cost,
+                "tasks": [{"id": task.get("id", "replay"), "status_code": 20000, "status_message": "Ok.",
+                           "cost": cost, "data": task,
+                           "result": [{"keyword": task.get("keyword"), "type": "organic",
+                                       "items_count": len(items), "items": items}]}]}
+
+
+# ----------------------------
+# STUB SERVER (replay / proxy di registrazione)
+# ----------------------------
+class ReplayConfig:
+    def __init__(self, fixtures: FixtureStore, latency_ms: float = 0.0, jitter_ms: float = 0.0,
+                 error_rate: float = 0.0, throttle_rate: float = 0.0, upstream: str = None, seed: int = 0):
+        self.fixtures = fixtures
+        self.latency_ms = latency_ms
+        self.jitter_ms = jitter_ms
+        self.error_rate = error_rate
+        self.throttle_rate = throttle_rate
+        self.upstream = upstream
+        self.random = random.Random(seed)
+        self.lock = threading.Lock()
+        self.tasks = {}
+        self.seq = 0
+        self.requests = 0
+        self.injected = {"500": 0, "429": 0}
+
+class ReplayHandler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"  # keep-alive come l'API reale
+    config: ReplayConfig = None
+
+    def setup(self):
+        super().setup()
+        # Header e body partono con due write: senza TCP_NODELAY Nagle + delayed ACK aggiungono ~40 ms
+        self.connection.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+
+    def log_message(self, *args):
+        pass
+
+    def do_POST(self):
+        length = int(self.headers.get("Content-Length") or 0)
+        self._dispatch(json.loads(self.rfile.read(length) or b"null"))
+
+    def do_GET(self):
+        self._dispatch(None)
+
+    def _send(self, status: int, body: dict, headers: dict = None):
+        raw = json.dumps(body, ensure_ascii=False).encode()
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json; charset=utf-8")
+        self.send_header("Content-Length", str(len(raw)))
+        for name, value in (headers or {}).items():
+            self.send_header(name, value)
+        self.end_headers()
+        self.wfile.write(raw)
+
+    def _dispatch(self, payload):
+        cfg = self.config
+        with cfg.lock:
+            cfg.requests += 1
+            roll = cfg.random.random()
+            delay = max(0.0, cfg.latency_ms + cfg.random.uniform(-cfg.jitter_ms, cfg.jitter_ms)) / 1000
+        if delay:
+            time.sleep(delay)
+        if cfg.upstream:
+            return self._proxy(payload)
+        if roll < cfg.throttle_rate:
+            with cfg.lock:
+                cfg.injected["429"] += 1
+            return self._send(429, {"status_code": 40202, "status_message": "Rate limit (iniettato)."}, {"Retry-After": "0"})
+        if roll < cfg.throttle_rate + cfg.error_rate:
+            with cfg.lock:
+                cfg.injected["500"] += 1
+            return self._send(500, {"status_code": 50000, "status_message": "Internal error (iniettato)."})
+
+        path = self.path.split("?", 1)[0]
+        if path.endswith("/task_post"):
+            return self._send(200, self._task_post(payload))
+        if path.endswith("/tasks_ready"):
+            with cfg.lock:
+                ready = [{"id": tid, "tag": task.get("tag")} for tid, task in cfg.tasks.items() if not task.get("_served")]
+            return self._send(200, {"status_code": 20000, "status_message": "Ok.", "cost": 0,
+                                    "tasks": [{"status_code": 20000, "result": ready[:1000]}]})
+        if "/task_get/" in path:
+            task_id = path.rsplit("/", 1)[-1]
+            with cfg.lock:
+                task = cfg.tasks.get(task_id)
+                if task is not None:
+                    task["_served"] = True
+            if task is None:
+                return self._send(200, {"status_code": 20000, "tasks": [{"id": task_id, "status_code": 40401,
+                                                                         "status_message": "Task not found."}]})
+            clean = {k: v for k, v in task.items() if not k.startswith("_")}
+            return self._send(200, cfg.fixtures.response_for("task_get/advanced", dict(clean, id=task_id)))
+        for kind in ("live/advanced", "live/regular"):
+            if path.endswith(kind):
+                return self._send(200, cfg.fixtures.response_for(kind, payload[0]))
+        self._send(404, {"status_code": 40400, "status_message": f"Endpoint non gestito dallo stub: {path}"})
+
+    def _task_post(self, payload: list) -> dict:
+        cfg = self.config
+        out = []
+        with cfg.lock:
+            for task in payload:
+                cfg.seq += 1
+                task_id = f"replay-{cfg.seq:08d}"
+                cfg.tasks[task_id] = dict(task)
+                out.append({"id": task_id, "status_code": 20100, "status_message": "Task Created.", "cost": 0.0006, "data": task})
+        return {"status_code": 20000, "status_message": "Ok.", "cost": round(0.0006 * len(payload), 6), "tasks": out}
+
+    def _proxy(self, payload):
+        """Modalità record: inoltra all'API reale (stesse credenziali) e salva le risposte SERP."""
+        cfg = self.config
+        headers = {"Authorization": self.headers.get("Authorization", ""), "Content-Type": "application/json"}
+        r = httpx.request(self.command, cfg.upstream + self.path, headers=headers, json=payload, timeout=120)
+        try:
+            data = r.json()
+        except ValueError:
+            data = {"status_code": r.status_code, "status_message": r.text[:500]}
+        path = self.path.split("?", 1)[0]
+        if r.status_code == 200 and isinstance(data, dict):
+            if path.endswith("/task_post"):
+                with cfg.lock:
+                    for task in data.get("tasks") or []:
+                        if task.get("id") and task.get("data"):
+                            cfg.tasks[task["id"]] = task["data"]
+            elif "/task_get/" in path:
+                with cfg.lock:
+                    task = cfg.tasks.get(path.rsplit("/", 1)[-1])
+                if task is not None:
+                    cfg.fixtures.save("task_get/advanced", task, data)
+            else:
+                for kind in ("live/advanced", "live/regular"):
+                    if path.endswith(kind) and payload:
+                        cfg.fixtures.save(kind, payload[0], data)
+        self._send(r.status_code, data, {k: v for k, v in r.headers.items() if k.lower() == "retry-after"})
+
+def start_stub(config: ReplayConfig, port: int = 0):
+    """Avvia lo stub in un thread daemon; ritorna (server, base_url)."""
+    handler = type("BoundReplayHandler", (ReplayHandler,), {"config": config})
+    # Backlog di default (5) troppo corto: con molte connessioni nuove insieme i SYN in eccesso
+    # vengono ritrasmessi dopo 1 s e la latenza misurata non è più quella iniettata
+    server_cls = type("ReplayServer", (ThreadingHTTPServer,), {"request_queue_size": 256})
+    server = server_cls(("127.0.0.1", port), handler)
+    server.daemon_threads = True
+    threading.Thread(target=server.serve_forever, name="serp-replay-stub", daemon=True).start()
+    return server, f"http://127.0.0.1:{server.server_address[1]}"
+
+
+# ----------------------------
+# CARICAMENTO PAGINA
+# ----------------------------
+def load_serp_page(api_base: str):
+    """
+    Importa le funzioni della pagina SERP (tutto ciò che precede la sezione UI) come modulo.
+    DATAFORSEO_API_BASE va impostata prima: la pagina la legge all'import.
+    """
+    os.environ["DATAFORSEO_API_BASE"] = api_base
+    # Fuori da `streamlit run` st.* avvisa a ogni chiamata: rumore inutile nel benchmark
+    os.environ.setdefault("STREAMLIT_LOGGER_LEVEL", "error")
+    from streamlit import config, logger
+    config.get_config_options()
+    logger.set_log_level(os.environ["STREAMLIT_LOGGER_LEVEL"])
+    source = PAGE_PATH.read_text(encoding="utf-8")
+    if UI_MARKER not in source:
+        raise RuntimeError(f"Sezione UI non trovata in {PAGE_PATH}")
+    spec = importlib.util.spec_from_loader("serp_analyzer_page", loader=None, origin=str(PAGE_PATH))
+    module = importlib.util.module_from_spec(spec)
+    module.__file__ = str(PAGE_PATH)
+    exec(compile(source.split(UI_MARKER, 1)[0], str(PAGE_PATH), "exec"), module.__dict__)
+    return module
+
+def analysis_params(page, client, keywords: list, num_results: int, strategy: str, concurrency: int,
+                    rectangles: bool = False, login: str = "replay", password: str = "replay") -> dict:
+    """Stessi params che la UI passa a run_serp_analysis; cache, storico e checkpoint disattivati."""
+    return {
+        "mode": "single" if len(keywords) == 1 else "batch",
+        "query": keywords[0], "keywords": keywords, "paese": next(iter(page.PAESI)), "device": "desktop",
+        "markets": [], "devices": [], "max_in_flight": concurrency, "num_results": num_results,
+        "fetch_strategy": strategy, "concurrency": concurrency, "login": login, "password": password,
+        "use_cache": False, "adaptive_fallback": False, "save_history": False, "resumable": False,
+        "rectangles": rectangles, "debug_raw": False, "client": client, "cache": None,
+        "fallback_policy": None, "history_store": None, "job_store": None,
+    }
+
+
+# ----------------------------
+# BENCHMARK
+# ----------------------------
+def _max_rss_mb() -> float:
+    # ru_maxrss: KB su Linux, byte su macOS
+    rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return rss / (1024 * 1024) if sys.platform == "darwin" else rss / 1024
+
+def _timed(fn, *args, trace_memory: bool = False):
+    if trace_memory:
+        tracemalloc.start()
+    t0 = time.perf_counter()
+    value = fn(*args)
+    elapsed = time.perf_counter() - t0
+    peak = None
+    if trace_memory:
+        peak = tracemalloc.get_traced_memory()[1] / (1024 * 1024)
+        tracemalloc.stop()
+    return value, elapsed, peak
+
+def _drain(source) -> int:
+    """Byte prodotti da un export (bytes, file o generatore di chunk)."""
+    if isinstance(source, (bytes, str)):
+        return len(source)
+    if hasattr(source, "read"):
+        source.seek(0, io.SEEK_END)
+        return source.tell()
+    return sum(len(chunk) for chunk in source)
+
+def run_scenario(page, client, keywords: list, args) -> dict:
+    params = analysis_params(page, client, keywords, args.results, args.strategy, args.concurrency, args.rectangles)
+    out, elapsed, peak = _timed(page.run_serp_analysis, params, lambda *a, **k: None, trace_memory=args.trace_memory)
+    results = out["results"]
+    summary = out["metrics"].summary()
+    total = summary.iloc[-1].to_dict() if len(summary) else {}
+    report = {
+        "keywords": len(keywords),
+        "mode": params["mode"],
+        "rows": int(len(results)),
+        "errors": len(out["errors"]),
+        "fetch_s": round(elapsed, 3),
+        "keywords_per_s": round(len(keywords) / elapsed, 2) if elapsed else None,
+        "rows_per_s": round(len(results) / elapsed, 1) if elapsed else None,
+        "calls": int(total.get("Chiamate", 0)),
+        "retries": int(total.get("Retry", 0)),
+        "latency_ms": {f"p{q}": total.get(f"p{q} (ms)") for q in page.SerpCallMetrics.LATENCY_PERCENTILES},
+        "received_mb": round(float(total.get("KB ricevuti", 0)) / 1024, 2),
+        "fetch_peak_mb": round(peak, 1) if peak is not None else None,
+        "stages": {},
+    }
+
+    if "exports" in args.stages and len(results):
+        exports = {
+            "csv": lambda: page.stream_csv_export(results),
+            "txt": lambda: page.serp_txt_export(results),
+            "excel": lambda: page.create_excel_export(results, out["query"]),
+        }
+        if page.PARQUET_AVAILABLE:
+            exports["parquet"] = lambda: page.stream_parquet_export(results)
+        for name, build in exports.items():
+            if name == "excel" and len(results) > args.excel_max_rows:
+                continue
+            value, secs, stage_peak = _timed(build, trace_memory=args.trace_memory)
+            report["stages"][f"export_{name}"] = {"s": round(secs, 3), "bytes": _drain(value),
+                                                  "peak_mb": round(stage_peak, 1) if stage_peak is not None else None}
+
+    if "charts" in args.stages and len(results):
+        for name in ("create_position_chart", "create_domain_chart", "create_length_distribution"):
+            fig, secs, stage_peak = _timed(getattr(page, name), results, trace_memory=args.trace_memory)
+            t0 = time.perf_counter()
+            payload = fig.to_json()
+            report["stages"][name] = {"s": round(secs, 3), "json_s": round(time.perf_counter() - t0, 3),
+                                      "json_bytes": len(payload),
+                                      "peak_mb": round(stage_peak, 1) if stage_peak is not None else None}
+
+    report["max_rss_mb"] = round(_max_rss_mb(), 1)
+    return report
+
+def print_report(report: dict):
+    lat = report["latency_ms"]
+    print(f"\n== {report['keywords']} keyword ({report['mode']}) — {report['rows']} righe, {report['errors']} errori")
+    print(f"   fetch {report['fetch_s']}s | {report['keywords_per_s']} kw/s | {report['rows_per_s']} righe/s | "
+          f"{report['calls']} chiamate, {report['retries']} retry, {report['received_mb']} MB")
+    print(f"   latenza chiamate p50/p95/p99: {lat['p50']} / {lat['p95']} / {lat['p99']} ms | "
+          f"RSS max {report['max_rss_mb']} MB" + (f" | picco fetch {report['fetch_peak_mb']} MB" if report["fetch_peak_mb"] else ""))
+    for name, stage in report["stages"].items():
+        details = ", ".join(f"{k}={v}" for k, v in stage.items() if v is not None)
+        print(f"   {name}: {details}")
+
+def cmd_bench(args):
+    config = ReplayConfig(FixtureStore(args.fixtures), args.latency_ms, args.jitter_ms, args.error_rate,
+                          args.throttle_rate, seed=args.seed)
+    server, base = start_stub(config)
+    page = load_serp_page(base)
+    client = page.DataForSEOAsyncClient(pool_size=args.concurrency * 2, per_host_limit=args.concurrency, http2=False,
+                                        rate_per_minute=args.rate_per_minute, max_retries=4)
+    print(f"Stub {base} — fixture: {len(config.fixtures.exact)} registrate "
+          f"({', '.join(config.fixtures.templates) or 'template sintetico'}); latenza {args.latency_ms}±{args.jitter_ms} ms, "
+          f"errori {args.error_rate:.1%}, throttling {args.throttle_rate:.1%}")
+    reports = []
+    try:
+        for size in args.sizes:
+            keywords = [f"benchmark keyword {i}" for i in range(size)]
+            report = run_scenario(page, client, keywords, args)
+            report["stub"] = {"requests": config.requests, "injected": dict(config.injected)}
+            print_report(report)
+            reports.append(report)
+    finally:
+        client.close()
+        server.shutdown()
+    if args.json:
+        Path(args.json).write_text(json.dumps({"args": {k: str(v) for k, v in vars(args).items() if k != "func"},
+                                               "scenarios": reports}, indent=1), encoding="utf-8")
+        print(f"\nReport salvato in {args.json}")
+
+def cmd_record(args):
+    config = ReplayConfig(FixtureStore(args.fixtures), upstream=args.upstream)
+    server, base = start_stub(config)
+    page = load_serp_page(base)
+    client = page.DataForSEOAsyncClient(http2=False)
+    try:
+        for kw in args.keywords:
+            for strategy in ("Depth unico (1 chiamata)", "Paginazione (10 per pagina)"):
+                params = analysis_params(page, client, [kw], args.results, strategy, 4, args.rectangles,
+                                         args.login, args.password)
+                out = page.run_serp_analysis(params, lambda *a, **k: None)
+                print(f"{kw} [{strategy}]: {len(out['results'])} righe, errori: {out['errors'] or 'nessuno'}")
+        if args.batch and len(args.keywords) > 1:
+            params = analysis_params(page, client, list(args.keywords), args.results, "Depth unico (1 chiamata)", 4,
+                                     args.rectangles, args.login, args.password)
+            out = page.run_serp_analysis(params, lambda *a, **k: None)
+            print(f"batch {len(args.keywords)} keyword: {len(out['results'])} righe, errori: {out['errors'] or 'nessuno'}")
+    finally:
+        client.close()
+        server.shutdown()
+    print(f"Fixture in {args.fixtures}: {len(list(Path(args.fixtures).glob('*.json')))} file")
+
+def cmd_serve(args):
+    config = ReplayConfig(FixtureStore(args.fixtures), args.latency_ms, args.jitter_ms, args.error_rate,
+                          args.throttle_rate, seed=args.seed)
+    server, base = start_stub(config, args.port)
+    print(f"Stub in ascolto su {base} — avvia l'app con DATAFORSEO_API_BASE={base}")
+    try:
+        while True:
+            time.sleep(3600)
+    except KeyboardInterrupt:
+        server.shutdown()
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    sub = parser.add_subparsers(dest="command", required=True)
+
+    def stub_options(p):
+        p.add_argument("--fixtures", type=Path, default=DEFAULT_FIXTURES)
+        p.add_argument("--latency-ms", type=float, default=50.0, help="latenza media iniettata per richiesta")
+        p.add_argument("--jitter-ms", type=float, default=20.0, help="variazione uniforme ± sulla latenza")
+        p.add_argument("--error-rate", type=float, default=0.0, help="quota di risposte HTTP 500")
+        p.add_argument("--throttle-rate", type=float, default=0.0, help="quota di risposte HTTP 429")
+        p.add_argument("--seed", type=int, default=0)
+
+    bench = sub.add_parser("bench", help="benchmark offline sullo stub")
+    stub_options(bench)
+    bench.add_argument("--sizes", type=int, nargs="+", default=[1, 100, 10000])
+    bench.add_argument("--results", type=int, default=100, help="risultati organic per keyword")
+    bench.add_argument("--strategy", default="Paginazione (10 per pagina)",
+                       choices=["Paginazione (10 per pagina)", "Depth unico (1 chiamata)"],
+                       help="strategia per lo scenario a 1 keyword (il batch usa sempre depth)")
+    bench.add_argument("--concurrency", type=int, default=10)
+    bench.add_argument("--rate-per-minute", type=int, default=100_000)
+    bench.add_argument("--rectangles", action="store_true")
+    bench.add_argument("--stages", nargs="+", default=["fetch", "exports", "charts"], choices=["fetch", "exports", "charts"])
+    bench.add_argument("--excel-max-rows", type=int, default=200_000, help="oltre questa soglia l'export Excel viene saltato")
+    bench.add_argument("--trace-memory", action="store_true", help="picco memoria per fase con tracemalloc (rallenta)")
+    bench.add_argument("--json", help="salva il report completo in questo file")
+    bench.set_defaults(func=cmd_bench)
+
+    record = sub.add_parser("record", help="registra risposte reali (consuma credito DataForSEO)")
+    record.add_argument("--fixtures", type=Path, default=DEFAULT_FIXTURES)
+    record.add_argument("--upstream", default=UPSTREAM)
+    record.add_argument("--login", required=True)
+    record.add_argument("--password", required=True)
+    record.add_argument("--keywords", nargs="+", required=True)
+    record.add_argument("--results", type=int, default=100)
+    record.add_argument("--rectangles", action="store_true")
+    record.add_argument("--batch", action="store_true", help="registra anche le risposte task_get della coda standard")
+    record.set_defaults(func=cmd_record)
+
+    serve = sub.add_parser("serve", help="solo stub di replay")
+    stub_options(serve)
+    serve.add_argument("--port", type=int, default=8765)
+    serve.set_defaults(func=cmd_serve)
+
+    args = parser.parse_args(argv)
+    args.func(args)
+
+if __name__ == "__main__":
+    main()
@@ -1,12 +1,26 @@
 import streamlit as st
-import requests
+from streamlit.runtime.scriptrunner import get_script_run_ctx
+import httpx
+import asyncio
+import random
+import re
 import time
+import numpy as np
 import pandas as pd
-from urllib.parse import urlparse
 import plotly.express as px
 import plotly.graph_objects as go
-from io import BytesIO
+from openpyxl import Workbook
+import io
+import os
 import base64
+import tempfile
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from pathlib import Path
+import hashlib
+import json
+import sqlite3
+import threading
+import zlib
 
 
 # ----------------------------
@@ -70,6 +84,652 @@ st.markdown("""
 """, unsafe_allow_html=True)
 
 
+# ----------------------------
+# METRICHE CHIAMATE DATAFORSEO
+# ----------------------------
+def _endpoint_kind(endpoint: str) -> str:
+    """advanced | regular (fallback) | task_post | tasks_ready | task_get | altro path."""
+    for marker, kind in (("/live/advanced", "advanced"), ("/live/regular", "regular"), ("/task_post", "task_post"),
+                         ("/tasks_ready", "tasks_ready"), ("/task_get/", "task_get")):
+        if marker in endpoint:
+            return kind
+    return endpoint.rsplit("/", 1)[-1]
+
+class SerpCallMetrics:
+    """
+    Registro delle chiamate DataForSEO di un'analisi: latenza, byte della risposta, endpoint,
+    retry, timeout, hit di cache e campo `cost`. Thread-safe (le pagine arrivano dai worker).
+    """
+
+    LATENCY_PERCENTILES = (50, 95, 99)
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._calls = []
+        self.started_at = time.time()
+
+    def record(self, endpoint: str, latency_s: float, size: int = 0, status: int = None, retries: int = 0,
+               timeout: bool = False, cost: float = 0.0, cache_hit: bool = False):
+        call = {
+            "endpoint": _endpoint_kind(endpoint),
+            "latency_ms": round(latency_s * 1000, 2),
+            "bytes": int(size),
+            "status": status,
+            "retries": int(retries or 0),
+            "timeout": bool(timeout),
+            "cost": float(cost or 0.0),
+            "cache_hit": bool(cache_hit),
+            "t": round(time.time() - self.started_at, 3),
+        }
+        with self._lock:
+            self._calls.append(call)
+
+    def frame(self) -> pd.DataFrame:
+        with self._lock:
+            calls = list(self._calls)
+        return pd.DataFrame(calls, columns=["endpoint", "latency_ms", "bytes", "status", "retries", "timeout",
+                                            "cost", "cache_hit", "t"])
+
+    def summary(self) -> pd.DataFrame:
+        """Per endpoint + riga TOTALE: chiamate, cache, errori, retry, timeout, byte, costo e p50/p95/p99.
+        I percentili di latenza sono calcolati solo sulle chiamate di rete (hit di cache esclusi)."""
+        calls = self.frame()
+        if calls.empty:
+            return pd.DataFrame()
+        rows = []
+        for name, group in list(calls.groupby("endpoint", sort=True)) + [("TOTALE", calls)]:
+            network = group.loc[~group["cache_hit"], "latency_ms"].to_numpy()
+            row = {
+                "Endpoint": name,
+                "Chiamate": len(group),
+                "Hit cache": int(group["cache_hit"].sum()),
+                "Errori HTTP": int(((group["status"].fillna(200) >= 400) & ~group["timeout"]).sum()),
+                "Timeout": int(group["timeout"].sum()),
+                "Retry": int(group["retries"].sum()),
+                "KB ricevuti": round(group["bytes"].sum() / 1024, 1),
+                "Costo ($)": round(group["cost"].sum(), 5),
+            }
+            for q in self.LATENCY_PERCENTILES:
+                row[f"p{q} (ms)"] = round(float(np.percentile(network, q)), 1) if len(network) else None
+            rows.append(row)
+        return pd.DataFrame(rows)
+
+    def to_json(self, meta: dict = None) -> str:
+        return json.dumps({
+            "meta": {"started_at": self.started_at, **(meta or {})},
+            "summary": self.summary().to_dict("records"),
+            "calls": self.frame().to_dict("records"),
+        }, ensure_ascii=False, indent=1, default=str)
+
+
+# ----------------------------
+# CLIENT HTTP DATAFORSEO (async, condiviso dal processo)
+# ----------------------------
+try:
+    import h2  # noqa: F401  (abilita HTTP/2 in httpx)
+    HTTP2_AVAILABLE = True
+except ImportError:
+    HTTP2_AVAILABLE = False
+
+try:
+    import pyarrow as pa
+    import pyarrow.parquet as pq
+    PARQUET_AVAILABLE = True
+except ImportError:
+    PARQUET_AVAILABLE = False
+
+# Timeout di rete da trattare come "pagina saltata" (non come errore fatale)
+DATAFORSEO_TIMEOUTS = (httpx.TimeoutException,)
+
+# status_code interni DataForSEO che segnalano throttling pur con HTTP 200
+DATAFORSEO_RATE_LIMIT_CODES = {40202}
+_STATUS_CODE_RE = re.compile(rb'"status_code"\s*:\s*(\d+)')
+
+class TokenBucket:
+    """
+    Token bucket asincrono (usato solo dal loop del client) con rate adattivo AIMD:
+    - finché c'è credito le richieste partono subito (zero attese artificiali)
+    - su throttling il rate si dimezza, poi risale gradualmente ad ogni successo
+      fino al limite dell'account: si converge al massimo throughput sostenibile.
+    """
+
+    def __init__(self, rate_per_s: float, burst: int):
+        self.max_rate = float(rate_per_s)
+        self.rate = float(rate_per_s)
+        self.capacity = float(max(1, burst))
+        self.tokens = self.capacity
+        self._updated = time.monotonic()
+
+    def _refill(self):
+        now = time.monotonic()
+        self.tokens = min(self.capacity, self.tokens + (now - self._updated) * self.rate)
+        self._updated = now
+
+    async def acquire(self):
+        while True:
+            self._refill()
+            if self.tokens >= 1:
+                self.tokens -= 1
+                return
+            await asyncio.sleep((1 - self.tokens) / self.rate)
+
+    def on_throttled(self):
+        self.rate = max(self.max_rate * 0.05, self.rate * 0.5)
+        self.tokens = min(self.tokens, 0.0)
+
+    def on_success(self):
+        if self.rate < self.max_rate:
+            self.rate = min(self.max_rate, self.rate + self.max_rate * 0.02)
+
+class DataForSEOAsyncClient:
+    """
+    Client HTTP unico per processo: un event loop asyncio dedicato (thread daemon) con un
+    httpx.AsyncClient in keep-alive, HTTP/2 opzionale, pool di connessioni e limite di
+    richieste contemporanee per host configurabili.
+    Le analisi successive riusano le connessioni già aperte (niente nuovi handshake TLS).
+    Ogni richiesta passa da un TokenBucket dimensionato sui limiti dell'account; HTTP 429/5xx
+    (e il throttling segnalato nel JSON) vengono ritentati con backoff esponenziale con jitter.
+    I chiamanti sincroni (thread pool delle estrazioni) usano request(); il codice async arequest().
+    """
+
+    def __init__(self, pool_size: int = 50, per_host_limit: int = 20, http2: bool = True,
+                 rate_per_minute: int = 2000, max_retries: int = 4, backoff_base_s: float = 0.5,
+                 backoff_max_s: float = 30.0):
+        self.pool_size = int(pool_size)
+        self.per_host_limit = max(1, int(per_host_limit))
+        self.http2 = bool(http2) and HTTP2_AVAILABLE
+        self.max_retries = int(max_retries)
+        self.backoff_base_s = backoff_base_s
+        self.backoff_max_s = backoff_max_s
+        self._bucket = TokenBucket(rate_per_minute / 60.0, burst=max(1, min(rate_per_minute // 60, self.pool_size)))
+        self._host_slots = {}
+        self._loop = asyncio.new_event_loop()
+        self._thread = threading.Thread(target=self._loop.run_forever, name="dataforseo-client", daemon=True)
+        self._thread.start()
+        self._client = asyncio.run_coroutine_threadsafe(self._make_client(), self._loop).result()
+
+    async def _make_client(self) -> httpx.AsyncClient:
+        return httpx.AsyncClient(
+            http2=self.http2,
+            limits=httpx.Limits(max_connections=self.pool_size, max_keepalive_connections=self.pool_size,
+                                keepalive_expiry=120),
+        )
+
+    async def arequest(self, method: str, url: str, headers: dict = None, json_payload=None, timeout_s: float = 60):
+        host = httpx.URL(url).host
+        # I semafori vivono nel loop del client: creati e usati solo qui, niente race
+        slots = self._host_slots.get(host)
+        if slots is None:
+            slots = self._host_slots[host] = asyncio.Semaphore(self.per_host_limit)
+        attempt = 0
+        while True:
+            await self._bucket.acquire()
+            async with slots:
+                response = await self._client.request(method, url, headers=headers, json=json_payload, timeout=timeout_s)
+            throttled = self._is_throttled(response)
+            if not throttled and response.status_code < 500:
+                self._bucket.on_success()
+                break
+            if throttled:
+                self._bucket.on_throttled()
+            if attempt >= self.max_retries:
+                break
+            await asyncio.sleep(self._backoff_delay(attempt, response))
+            attempt += 1
+        response.retries = attempt
+        return response
+
+    @staticmethod
+    def _is_throttled(response: httpx.Response) -> bool:
+        if response.status_code == 429:
+            return True
+        if response.status_code == 200:
+            # Il status_code globale è tra i primi campi del JSON: basta guardare l'inizio del body
+            m = _STATUS_CODE_RE.search(response.content[:300])
+            return bool(m) and int(m.group(1)) in DATAFORSEO_RATE_LIMIT_CODES
+        return False
+
+    def _backoff_delay(self, attempt: int, response: httpx.Response) -> float:
+        """Retry-After se presente, altrimenti full jitter: uniforme tra 0 e base * 2^attempt."""
+        retry_after = response.headers.get("Retry-After")
+        if retry_after and retry_after.replace(".", "", 1).isdigit():
+            return min(float(retry_after), self.backoff_max_s)
+        return random.uniform(0, min(self.backoff_max_s, self.backoff_base_s * (2 ** attempt)))
+
+    def request(self, method: str, url: str, headers: dict = None, json_payload=None, timeout_s: float = 60):
+        future = asyncio.run_coroutine_threadsafe(self.arequest(method, url, headers, json_payload, timeout_s), self._loop)
+        return future.result()
+
+    def close(self):
+        asyncio.run_coroutine_threadsafe(self._client.aclose(), self._loop).result()
+        self._loop.call_soon_threadsafe(self._loop.stop)
+
+# Limiti del client condiviso: valgono per tutte le sessioni, quindi li decide il server e non la UI
+DATAFORSEO_CLIENT_LIMITS = {
+    "pool_size": int(os.environ.get("DATAFORSEO_POOL_SIZE", "50")),
+    "per_host_limit": int(os.environ.get("DATAFORSEO_PER_HOST_LIMIT", "20")),
+    "http2": os.environ.get("DATAFORSEO_HTTP2", "1") not in ("0", "false", "False"),
+    "rate_per_minute": int(os.environ.get("DATAFORSEO_RATE_PER_MINUTE", "2000")),
+    "max_retries": int(os.environ.get("DATAFORSEO_MAX_RETRIES", "4")),
+}
+
+@st.cache_resource
+def get_dataforseo_client() -> DataForSEOAsyncClient:
+    """Un solo client (event loop + pool) per processo, condiviso da sessioni e rerun, con i limiti del server."""
+    return DataForSEOAsyncClient(**DATAFORSEO_CLIENT_LIMITS)
+
+class DataForSEOSession:
+    """Credenziali di un utente sopra il client condiviso; stessa interfaccia post/get usata dal codice di fetch."""
+
+    def __init__(self, client: DataForSEOAsyncClient, login: str, password: str, metrics: SerpCallMetrics = None):
+        self._client = client
+        self.metrics = metrics
+        self._headers = {
+            "Authorization": _basic_auth_header(login, password),
+            "Content-Type": "application/json"
+        }
+
+    def post(self, url: str, json=None, timeout: float = 60):
+        return self._client.request("POST", url, headers=self._headers, json_payload=json, timeout_s=timeout)
+
+    def get(self, url: str, timeout: float = 60):
+        return self._client.request("GET", url, headers=self._headers, timeout_s=timeout)
+
+
+# ----------------------------
+# CACHE LOCALE RISPOSTE (SQLite)
+# ----------------------------
+SERP_DATA_DIR = Path(__file__).resolve().parent.parent / ".serp_data"
+
+# Campi del payload che identificano una risposta (oltre all'endpoint)
+CACHE_KEY_FIELDS = ("keyword", "location_code", "language_code", "se_domain", "device", "search_param", "depth",
+                    "calculate_rectangles")
+# Limiti della cache condivisa, decisi dal server (non dalle sessioni): età massima conservata e dimensione su disco
+SERP_CACHE_MAX_TTL_S = 30 * 24 * 3600
+SERP_CACHE_MAX_BYTES = int(os.environ.get("SERP_CACHE_MAX_MB", "200")) * 1024 * 1024
+
+class SerpResponseCache:
+    """
+    Cache su disco delle risposte live DataForSEO: JSON compresso (zlib) in SQLite,
+    TTL configurabile ed eviction LRU quando si supera max_bytes.
+    Thread-safe (una connessione condivisa protetta da lock), contatori hit/miss per processo.
+    ttl_s e max_bytes sono limiti del processo; ogni sessione può chiedere risposte più fresche
+    passando `max_age_s` a get() (vedi with_max_age).
+    """
+
+    def __init__(self, path: Path, ttl_s: float = 24 * 3600, max_bytes: int = 200 * 1024 * 1024):
+        path.parent.mkdir(parents=True, exist_ok=True)
+        self.ttl_s = ttl_s
+        self.max_bytes = max_bytes
+        self.hits = 0
+        self.misses = 0
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(str(path), check_same_thread=False)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute("""
+            CREATE TABLE IF NOT EXISTS responses (
+                key TEXT PRIMARY KEY,
+                endpoint TEXT NOT NULL,
+                body BLOB NOT NULL,
+                size INTEGER NOT NULL,
+                created_at REAL NOT NULL,
+                last_access REAL NOT NULL
+            )
+        """)
+        self._conn.execute("CREATE INDEX IF NOT EXISTS idx_responses_last_access ON responses(last_access)")
+        self._conn.commit()
+
+    @staticmethod
+    def make_key(endpoint: str, payload: list) -> str:
+        task = (payload or [{}])[0]
+        key_data = {"endpoint": endpoint, **{f: task.get(f) for f in CACHE_KEY_FIELDS}}
+        return hashlib.sha256(json.dumps(key_data, sort_keys=True).encode("utf-8")).hexdigest()
+
+    def get(self, key: str, max_age_s: float = None):
+        now = time.time()
+        max_age_s = self.ttl_s if max_age_s is None else min(max_age_s, self.ttl_s)
+        with self._lock:
+            row = self._conn.execute("SELECT body, created_at FROM responses WHERE key = ?", (key,)).fetchone()
+            if row is None or now - row[1] > max_age_s:
+                # Troppo vecchia per questa sessione non vuol dire scaduta per tutti: si elimina solo oltre ttl_s
+                if row is not None and now - row[1] > self.ttl_s:
+                    self._conn.execute("DELETE FROM responses WHERE key = ?", (key,))
+                    self._conn.commit()
+                self.misses += 1
+                return None
+            self._conn.execute("UPDATE responses SET last_access = ? WHERE key = ?", (now, key))
+            self._conn.commit()
+            self.hits += 1
+        return json.loads(zlib.decompress(row[0]).decode("utf-8"))
+
+    def put(self, key: str, endpoint: str, data: dict):
+        body = zlib.compress(json.dumps(data, separators=(",", ":")).encode("utf-8"), 6)
+        now = time.time()
+        with self._lock:
+            self._conn.execute(
+                "INSERT OR REPLACE INTO responses (key, endpoint, body, size, created_at, last_access) VALUES (?, ?, ?, ?, ?, ?)",
+                (key, endpoint, body, len(body), now, now)
+            )
+            self._evict()
+            self._conn.commit()
+
+    def _evict(self):
+        """Elimina le voci scadute, poi le meno usate di recente finché si rientra in max_bytes."""
+        self._conn.execute("DELETE FROM responses WHERE created_at < ?", (time.time() - self.ttl_s,))
+        total = self._conn.execute("SELECT COALESCE(SUM(size), 0) FROM responses").fetchone()[0]
+        if total <= self.max_bytes:
+            return
+        freed = 0
+        victims = []
+        for key, size in self._conn.execute("SELECT key, size FROM responses ORDER BY last_access ASC"):
+            victims.append((key,))
+            freed += size
+            if total - freed <= self.max_bytes:
+                break
+        self._conn.executemany("DELETE FROM responses WHERE key = ?", victims)
+
+    def with_max_age(self, max_age_s: float) -> "SerpCacheView":
+        return SerpCacheView(self, max_age_s)
+
+    def clear(self):
+        with self._lock:
+            self._conn.execute("DELETE FROM responses")
+            self._conn.commit()
+            self.hits = 0
+            self.misses = 0
+
+    def stats(self) -> dict:
+        with self._lock:
+            entries, size = self._conn.execute("SELECT COUNT(*), COALESCE(SUM(size), 0) FROM responses").fetchone()
+        lookups = self.hits + self.misses
+        return {
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_rate": (self.hits / lookups) if lookups else 0.0,
+            "entries": entries,
+            "bytes": size,
+        }
+
+class SerpCacheView:
+    """La cache condivisa vista da una sessione: stessa interfaccia usata da _call_dataforseo, TTL della sessione su ogni get."""
+
+    def __init__(self, cache: SerpResponseCache, max_age_s: float):
+        self.cache = cache
+        self.max_age_s = max_age_s
+        self.make_key = cache.make_key
+
+    def get(self, key: str):
+        return self.cache.get(key, max_age_s=self.max_age_s)
+
+    def put(self, key: str, endpoint: str, data: dict):
+        self.cache.put(key, endpoint, data)
+
+@st.cache_resource
+def get_serp_cache() -> SerpResponseCache:
+    """Un'unica cache per processo, condivisa tra rerun e sessioni; limiti da SERP_CACHE_MAX_TTL_S / SERP_CACHE_MAX_MB."""
+    return SerpResponseCache(SERP_DATA_DIR / "serp_cache.sqlite", ttl_s=SERP_CACHE_MAX_TTL_S, max_bytes=SERP_CACHE_MAX_BYTES)
+
+class RegularFallbackPolicy:
+    """
+    Policy adattiva per il fallback sull'endpoint REGULAR, per (location_code, device).
+    Ricorda (su SQLite) quante volte il fallback è stato eseguito e quante volte ha
+    davvero aggiunto organic, e decide:
+      - "parallel": il fallback aggiunge organic in almeno PARALLEL_MIN_GAIN_RATE dei casi ->
+                    REGULAR parte insieme ad ADVANCED (una chiamata in più per pagina, zero attesa extra)
+      - "skip":     almeno MIN_SAMPLES tentativi senza mai un guadagno -> niente fallback
+                    (tranne 1 volta ogni EXPLORE_EVERY, per accorgersi se la SERP cambia)
+      - "after":    dati insufficienti o guadagni rari -> REGULAR dopo ADVANCED, solo se serve
+    """
+    MIN_SAMPLES = 5
+    EXPLORE_EVERY = 20
+    PARALLEL_MIN_GAIN_RATE = 0.5
+
+    def __init__(self, path: Path):
+        path.parent.mkdir(parents=True, exist_ok=True)
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(str(path), check_same_thread=False)
+        self._conn.execute("""
+            CREATE TABLE IF NOT EXISTS fallback_stats (
+                location_code INTEGER NOT NULL,
+                device TEXT NOT NULL,
+                attempts INTEGER NOT NULL DEFAULT 0,
+                gains INTEGER NOT NULL DEFAULT 0,
+                skipped INTEGER NOT NULL DEFAULT 0,
+                speculative_unused INTEGER NOT NULL DEFAULT 0,
+                PRIMARY KEY (location_code, device)
+            )
+        """)
+        self._conn.commit()
+
+    def _row(self, location_code, device) -> tuple:
+        row = self._conn.execute(
+            "SELECT attempts, gains, skipped FROM fallback_stats WHERE location_code = ? AND device = ?",
+            (location_code, device)
+        ).fetchone()
+        return row or (0, 0, 0)
+
+    def mode(self, location_code, device) -> str:
+        with self._lock:
+            attempts, gains, skipped = self._row(location_code, device)
+        if gains > 0 and gains / attempts >= self.PARALLEL_MIN_GAIN_RATE:
+            return "parallel"
+        if gains == 0 and attempts >= self.MIN_SAMPLES and (skipped + 1) % self.EXPLORE_EVERY != 0:
+            return "skip"
+        return "after"
+
+    def record(self, location_code, device, attempts=0, gains=0, skipped=0, speculative_unused=0):
+        with self._lock:
+            self._conn.execute("""
+                INSERT INTO fallback_stats (location_code, device, attempts, gains, skipped, speculative_unused)
+                VALUES (?, ?, ?, ?, ?, ?)
+                ON CONFLICT(location_code, device) DO UPDATE SET
+                    attempts = attempts + excluded.attempts,
+                    gains = gains + excluded.gains,
+                    skipped = skipped + excluded.skipped,
+                    speculative_unused = speculative_unused + excluded.speculative_unused
+            """, (location_code, device, attempts, gains, skipped, speculative_unused))
+            self._conn.commit()
+
+    def stats_frame(self) -> pd.DataFrame:
+        with self._lock:
+            rows = self._conn.execute(
+                "SELECT location_code, device, attempts, gains, skipped, speculative_unused FROM fallback_stats ORDER BY location_code, device"
+            ).fetchall()
+        df = pd.DataFrame(rows, columns=["location_code", "Device", "Fallback eseguiti", "Fallback utili",
+                                         "Fallback saltati", "REGULAR paralleli inutilizzati"])
+        df["% utili"] = (100 * df["Fallback utili"] / df["Fallback eseguiti"].where(df["Fallback eseguiti"] > 0)).round(1).fillna(0)
+        df["Policy"] = [self.mode(loc, dev) for loc, dev in zip(df["location_code"], df["Device"])]
+        return df
+
+@st.cache_resource
+def get_fallback_policy() -> RegularFallbackPolicy:
+    return RegularFallbackPolicy(SERP_DATA_DIR / "serp_fallback_policy.sqlite")
+
+
+class _CachedResponse:
+    """Risposta servita dalla cache: espone solo quello che usa il codice di fetch."""
+    status_code = 200
+    headers = {"Content-Type": "application/json"}
+    from_cache = True
+
+    def __init__(self, data: dict):
+        self._data = data
+        self.text = json.dumps(data)[:2000]
+
+    def json(self):
+        return self._data
+
+def _is_cacheable(r, data) -> bool:
+    """Solo risposte complete e senza errori: status HTTP 200, status_code 20000 e task 20000."""
+    if r.status_code != 200 or not isinstance(data, dict) or data.get("status_code") != 20000:
+        return False
+    tasks = data.get("tasks") or []
+    return bool(tasks) and (tasks[0] or {}).get("status_code") == 20000
+
+
+# ----------------------------
+# JOB RIPRENDIBILI (checkpoint su disco)
+# ----------------------------
+class SerpJobStore:
+    """
+    Job SERP con checkpoint per unità di lavoro (pagina, keyword, blocco di task_post) in SQLite.
+    Un job è identificato dai suoi parametri: rilanciando la stessa analisi dopo un'interruzione
+    si riprende il job "running" e le unità già completate (e già fatturate) non vengono rifatte.
+    Si riprendono solo job aggiornati entro `resume_ttl_s`: quelli più vecchi diventano "stale",
+    così una SERP di giorni prima non viene riusata come se fosse appena estratta.
+    Ogni job appartiene a un `owner` (hash delle credenziali DataForSEO, vedi credential_owner):
+    elenco, ripresa ed eliminazione vedono solo i job dello stesso account.
+    """
+
+    def __init__(self, path: Path, resume_ttl_s: float = 2 * 3600):
+        path.parent.mkdir(parents=True, exist_ok=True)
+        self.resume_ttl_s = resume_ttl_s
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(str(path), check_same_thread=False)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.executescript("""
+            CREATE TABLE IF NOT EXISTS jobs (
+                job_id TEXT PRIMARY KEY,
+                params_hash TEXT NOT NULL,
+                kind TEXT NOT NULL,
+                label TEXT NOT NULL,
+                status TEXT NOT NULL,
+                created_at REAL NOT NULL,
+                updated_at REAL NOT NULL,
+                owner TEXT
+            );
+            CREATE INDEX IF NOT EXISTS idx_jobs_params ON jobs(params_hash, status);
+            CREATE TABLE IF NOT EXISTS units (
+                job_id TEXT NOT NULL,
+                unit TEXT NOT NULL,
+                body BLOB NOT NULL,
+                cost REAL NOT NULL DEFAULT 0,
+                done_at REAL NOT NULL,
+                PRIMARY KEY (job_id, unit)
+            ) WITHOUT ROWID;
+        """)
+        # Job salvati prima della colonna: senza proprietario (NULL), non più visibili né riprendibili
+        columns = {row[1] for row in self._conn.execute("PRAGMA table_info(jobs)")}
+        if "owner" not in columns:
+            self._conn.execute("ALTER TABLE jobs ADD COLUMN owner TEXT")
+        self._conn.execute("CREATE INDEX IF NOT EXISTS idx_jobs_owner ON jobs(owner, updated_at)")
+        self._conn.commit()
+
+    def open_job(self, owner: str, kind: str, label: str, params: dict):
+        """
+        Riprende l'ultimo job "running" dello stesso owner con gli stessi parametri o ne crea uno nuovo.
+        Ritorna (job_id, ripreso).
+        """
+        params_hash = hashlib.sha256(
+            json.dumps({"kind": kind, "owner": owner, **params}, sort_keys=True).encode("utf-8")
+        ).hexdigest()
+        now = time.time()
+        with self._lock:
+            self._conn.execute(
+                "UPDATE jobs SET status = 'stale' WHERE params_hash = ? AND status = 'running' AND updated_at < ?",
+                (params_hash, now - self.resume_ttl_s)
+            )
+            row = self._conn.execute(
+                "SELECT job_id FROM jobs WHERE params_hash = ? AND status = 'running' ORDER BY created_at DESC LIMIT 1",
+                (params_hash,)
+            ).fetchone()
+            if row is not None:
+                self._conn.execute("UPDATE jobs SET updated_at = ? WHERE job_id = ?", (now, row[0]))
+                self._conn.commit()
+                return row[0], True
+            job_id = f"{params_hash[:10]}-{int(now * 1000)}"
+            self._conn.execute(
+                "INSERT INTO jobs (job_id, params_hash, kind, label, status, created_at, updated_at, owner) "
+                "VALUES (?, ?, ?, ?, 'running', ?, ?, ?)",
+                (job_id, params_hash, kind, label, now, now, owner)
+            )
+            self._conn.commit()
+        return job_id, False
+
+    def finish_job(self, job_id: str):
+        with self._lock:
+            self._conn.execute("UPDATE jobs SET status = 'done', updated_at = ? WHERE job_id = ?", (time.time(), job_id))
+            self._conn.commit()
+
+    def get_unit(self, job_id: str, unit: str):
+        with self._lock:
+            row = self._conn.execute("SELECT body FROM units WHERE job_id = ? AND unit = ?", (job_id, unit)).fetchone()
+        return None if row is None else json.loads(zlib.decompress(row[0]).decode("utf-8"))
+
+    def put_unit(self, job_id: str, unit: str, data, cost: float = 0.0):
+        body = zlib.compress(json.dumps(data, separators=(",", ":")).encode("utf-8"), 6)
+        now = time.time()
+        with self._lock:
+            self._conn.execute(
+                "INSERT OR REPLACE INTO units (job_id, unit, body, cost, done_at) VALUES (?, ?, ?, ?, ?)",
+                (job_id, unit, body, float(cost or 0.0), now)
+            )
+            self._conn.execute("UPDATE jobs SET updated_at = ? WHERE job_id = ?", (now, job_id))
+            self._conn.commit()
+
+    def units_count(self, job_id: str) -> int:
+        with self._lock:
+            return self._conn.execute("SELECT COUNT(*) FROM units WHERE job_id = ?", (job_id,)).fetchone()[0]
+
+    def jobs_frame(self, owner: str, limit: int = 50) -> pd.DataFrame:
+        with self._lock:
+            rows = self._conn.execute("""
+                SELECT j.job_id, j.kind, j.label, j.status, COUNT(u.unit), COALESCE(SUM(u.cost), 0), j.updated_at
+                FROM jobs j LEFT JOIN units u ON u.job_id = j.job_id
+                WHERE j.owner = ?
+                GROUP BY j.job_id ORDER BY j.updated_at DESC LIMIT ?
+            """, (owner, limit)).fetchall()
+        df = pd.DataFrame(rows, columns=["Job", "Tipo", "Analisi", "Stato", "Unità completate", "Costo già pagato ($)", "Aggiornato"])
+        df["Aggiornato"] = pd.to_datetime(df["Aggiornato"], unit="s").dt.strftime("%Y-%m-%d %H:%M")
+        return df
+
+    def delete_jobs(self, owner: str, status: str = None):
+        """Elimina i job di `owner` (solo quelli con `status`, se indicato) e i relativi checkpoint."""
+        with self._lock:
+            where, args = ("WHERE owner = ? AND status = ?", (owner, status)) if status else ("WHERE owner = ?", (owner,))
+            self._conn.execute(f"DELETE FROM units WHERE job_id IN (SELECT job_id FROM jobs {where})", args)
+            self._conn.execute(f"DELETE FROM jobs {where}", args)
+            self._conn.commit()
+
+class JobCheckpoint:
+    """
+    Vista su un job del SerpJobStore, con prefisso opzionale per le unità (es. mercato·device).
+    `restored` (condiviso tra le viste dello stesso job) raccoglie le unità rilette dal checkpoint:
+    i loro dati non sono freschi e non vanno salvati nello storico.
+    """
+
+    def __init__(self, store: SerpJobStore, job_id: str, prefix: str = "", restored: set = None):
+        self.store = store
+        self.job_id = job_id
+        self.prefix = prefix
+        self.restored = restored if restored is not None else set()
+
+    def get(self, unit: str):
+        data = self.store.get_unit(self.job_id, self.prefix + unit)
+        if data is not None:
+            self.restored.add(self.prefix + unit)
+        return data
+
+    def put(self, unit: str, data, cost: float = 0.0):
+        self.store.put_unit(self.job_id, self.prefix + unit, data, cost)
+
+    def scoped(self, prefix: str) -> "JobCheckpoint":
+        return JobCheckpoint(self.store, self.job_id, self.prefix + prefix, self.restored)
+
+@st.cache_resource
+def get_job_store() -> SerpJobStore:
+    return SerpJobStore(SERP_DATA_DIR / "serp_jobs.sqlite")
+
+def credential_owner(login: str, password: str) -> str:
+    """Proprietario dei job con checkpoint: hash SHA-256 delle credenziali (mai salvate in chiaro)."""
+    return hashlib.sha256(f"{login}:{password}".encode("utf-8")).hexdigest()
+
+def open_checkpoint(store: SerpJobStore, owner: str, kind: str, label: str, params: dict):
+    """Apre (o riprende) il job e ritorna (JobCheckpoint, unità già completate: 0 se job nuovo)."""
+    job_id, resumed = store.open_job(owner, kind, label, params)
+    return JobCheckpoint(store, job_id), store.units_count(job_id) if resumed else 0
+
+
 # ----------------------------
 # DATAFORSEO HELPERS
 # ----------------------------
@@ -83,13 +743,72 @@ PAESI = {
     "USA 🇺🇸":      {"gl": "us", "hl": "en", "location_code": 2840, "language_code": "en", "se_domain": "google.com"},
 }
 
+# Base URL sovrascrivibile (es. stub di replay locale: benchmarks/serp_replay.py)
+DATAFORSEO_API_BASE = os.environ.get("DATAFORSEO_API_BASE", "https://api.dataforseo.com").rstrip("/")
+# Coda standard (non-live) per il batch multi-keyword e live/advanced|regular
+DATAFORSEO_SERP_BASE = f"{DATAFORSEO_API_BASE}/v3/serp/google/organic"
+TASK_POST_MAX_TASKS = 100  # limite DataForSEO di task per singola richiesta task_post
+
 def _basic_auth_header(login: str, password: str) -> str:
     token = base64.b64encode(f"{login}:{password}".encode("utf-8")).decode("utf-8")
     return f"Basic {token}"
 
-def _call_dataforseo(session: requests.Session, endpoint: str, payload: list, timeout_s: int = 60):
-    r = session.post(endpoint, json=payload, timeout=timeout_s)
-    return r, (r.json() if r.headers.get("Content-Type", "").startswith("application/json") else None)
+def _call_dataforseo(session: DataForSEOSession, endpoint: str, payload: list, timeout_s: int = 60,
+                     cache: SerpResponseCache = None):
+    """
+    POST con payload, GET se payload è None (tasks_ready / task_get).
+    Con `cache` le POST live passano prima dalla cache locale; in caso di hit il campo
+    `cost` viene azzerato perché la chiamata non è stata fatturata.
+    Se la sessione ha `metrics` (SerpCallMetrics) ogni chiamata viene registrata, timeout compresi.
+    """
+    metrics = getattr(session, "metrics", None)
+    key = None
+    if payload is not None and cache is not None:
+        key = cache.make_key(endpoint, payload)
+        cached = cache.get(key)
+        if cached is not None:
+            cached["cost"] = 0
+            if metrics is not None:
+                metrics.record(endpoint, 0.0, status=200, cache_hit=True)
+            return _CachedResponse(cached), cached
+
+    t0 = time.perf_counter()
+    try:
+        if payload is None:
+            r = session.get(endpoint, timeout=timeout_s)
+        else:
+            r = session.post(endpoint, json=payload, timeout=timeout_s)
+    except DATAFORSEO_TIMEOUTS:
+        if metrics is not None:
+            metrics.record(endpoint, time.perf_counter() - t0, timeout=True)
+        raise
+    data = r.json() if r.headers.get("Content-Type", "").startswith("application/json") else None
+    if metrics is not None:
+        metrics.record(endpoint, time.perf_counter() - t0, size=len(r.content), status=r.status_code,
+                       retries=getattr(r, "retries", 0), cost=_response_cost(data))
+    if key is not None and _is_cacheable(r, data):
+        cache.put(key, endpoint, data)
+    return r, data
+
+def _new_dataforseo_session(login: str, password: str, client: DataForSEOAsyncClient = None,
+                            metrics: SerpCallMetrics = None) -> DataForSEOSession:
+    return DataForSEOSession(client or get_dataforseo_client(), login, password, metrics)
+
+class _CappedSession:
+    """Sessione condivisa con un tetto globale di richieste HTTP contemporanee (semaforo)."""
+
+    def __init__(self, session: DataForSEOSession, max_in_flight: int):
+        self._session = session
+        self.metrics = session.metrics
+        self._slots = threading.BoundedSemaphore(max(1, int(max_in_flight)))
+
+    def post(self, *args, **kwargs):
+        with self._slots:
+            return self._session.post(*args, **kwargs)
+
+    def get(self, *args, **kwargs):
+        with self._slots:
+            return self._session.get(*args, **kwargs)
 
 def _extract_items(data: dict):
     """Estrae items in modo robusto anche quando result/task mancano o sono vuoti."""
@@ -123,7 +842,303 @@ def _is_organic(item: dict) -> bool:
         return True
     return False
 
-def fetch_google_organic_dataforseo(
+# Etichette dei tipi di item SERP più comuni (gli altri tipi vengono tenuti con il nome API)
+SERP_FEATURE_LABELS = {
+    "organic": "Organic",
+    "featured_snippet": "Featured snippet",
+    "people_also_ask": "People Also Ask",
+    "local_pack": "Local pack",
+    "shopping": "Shopping",
+    "popular_products": "Prodotti popolari",
+    "video": "Video",
+    "images": "Immagini",
+    "top_stories": "Top stories",
+    "knowledge_graph": "Knowledge graph",
+    "paid": "Annunci",
+    "related_searches": "Ricerche correlate",
+}
+FEATURE_COLUMNS = ["Tipo", "Rank", "Title", "URL", "Dominio", "Elementi", "Dettaglio", "X", "Y", "Larghezza", "Altezza"]
+
+def _feature_detail(kind: str, item: dict, sub_items: list) -> str:
+    """Campo compatto specifico per tipo (domande PAA, rating local pack, prezzi shopping...)."""
+    if kind in ("people_also_ask", "related_searches"):
+        return " | ".join(str(s.get("title") or "") if isinstance(s, dict) else str(s) for s in sub_items[:5])
+    if kind == "local_pack":
+        rating = item.get("rating") or {}
+        return f"★ {rating.get('value')} ({rating.get('votes_count')})" if rating.get("value") is not None else ""
+    if kind in ("shopping", "popular_products"):
+        prices = [s.get("price") for s in sub_items if isinstance(s, dict)]
+        prices = [p.get("current") if isinstance(p, dict) else p for p in prices]
+        prices = [p for p in prices if isinstance(p, (int, float))]
+        return f"{min(prices)}–{max(prices)}" if prices else ""
+    if kind in ("video", "top_stories"):
+        return " | ".join(str(s.get("source") or s.get("title") or "") for s in sub_items[:3] if isinstance(s, dict))
+    return item.get("description") or ""
+
+def _parse_serp_items(items: list):
+    """
+    Un solo passaggio su TUTTI gli item della risposta (già fatturati).
+    Ritorna (item organic grezzi, record compatti per ogni item: organic e SERP feature).
+    I record hanno le chiavi di FEATURE_COLUMNS; X/Y/Larghezza/Altezza solo con calculate_rectangles.
+    """
+    organic, records = [], []
+    for item in items:
+        if not isinstance(item, dict):
+            continue
+        kind = "organic" if _is_organic(item) else (item.get("type") or "unknown").lower()
+        if kind == "organic":
+            organic.append(item)
+        sub_items = item.get("items")
+        sub_items = sub_items if isinstance(sub_items, list) else []
+        rect = item.get("rectangle") or {}
+        records.append({
+            "Tipo": kind,
+            "Rank": item.get("rank_absolute") or item.get("rank_group"),
+            "Title": item.get("title") or "",
+            "URL": item.get("url") or "",
+            "Dominio": (item.get("domain") or "").lower(),
+            "Elementi": len(sub_items),
+            "Dettaglio": _feature_detail(kind, item, sub_items)[:300],
+            "X": rect.get("x"),
+            "Y": rect.get("y"),
+            "Larghezza": rect.get("width"),
+            "Altezza": rect.get("height"),
+        })
+    return organic, records
+
+def _build_payload(keyword: str, location_code: int, language_code: str, se_domain: str,
+                   device: str, gl: str, hl: str, start=None, depth: int = 10,
+                   calculate_rectangles: bool = False) -> list:
+    """
+    Payload per live/advanced|regular.
+    start=None -> modalità "depth": niente num/start, DataForSEO scorre la SERP fino a `depth`.
+    calculate_rectangles=True -> DataForSEO aggiunge la posizione in pixel di ogni item (costo extra).
+    """
+    # Parametri Google: pws=0 (no personalization), nfpr=1 (no autocorrect)
+    # NB: gl/hl qui DEVONO essere validi, per UK gl=gb
+    search_param = f"pws=0&nfpr=1&hl={hl}&gl={gl}"
+    if start is not None:
+        search_param = f"num=10&start={start}&" + search_param
+    task = {
+        "keyword": keyword,
+        "location_code": location_code,
+        "language_code": language_code,
+        "se_domain": se_domain,
+        "device": device,
+        "search_param": search_param,
+        "depth": depth
+    }
+    if calculate_rectangles:
+        task["calculate_rectangles"] = True
+    return [task]
+
+def _response_cost(data) -> float:
+    """Campo `cost` della risposta DataForSEO (0 se assente)."""
+    if not isinstance(data, dict):
+        return 0.0
+    try:
+        return float(data.get("cost") or 0)
+    except (TypeError, ValueError):
+        return 0.0
+
+SPECULATIVE_MAX_WORKERS = 16
+
+@st.cache_resource
+def get_speculative_pool() -> ThreadPoolExecutor:
+    """Pool unico e limitato per i REGULAR speculativi: i thread non crescono con pagine, keyword e combinazioni."""
+    return ThreadPoolExecutor(max_workers=SPECULATIVE_MAX_WORKERS, thread_name_prefix="serp-regular")
+
+def _speculative_cost(future) -> float:
+    """Costo di un REGULAR speculativo lasciato finire in background (0 se fallito: lo registra comunque metrics)."""
+    try:
+        _, data = future.result()
+    except Exception:
+        return 0.0
+    return _response_cost(data)
+
+def _fetch_serp_page(session: DataForSEOSession, endpoint_advanced: str, endpoint_regular: str,
+                     payload: list, timeout_s: int = 60, cache: SerpResponseCache = None,
+                     fallback_policy: RegularFallbackPolicy = None) -> dict:
+    """
+    Scarica UNA pagina SERP (advanced + eventuale fallback regular).
+    Oltre agli organic restituisce in "features" i record compatti di tutti gli item (vedi _parse_serp_items).
+    Non usa st.* perché gira anche nei worker thread: l'esito viene restituito come dict
+    e mostrato a video dal thread principale.
+    Con `fallback_policy` il fallback REGULAR può partire in parallelo ad ADVANCED o essere saltato.
+    In parallelo, se ADVANCED ha organic si ritorna subito: il REGULAR (già fatturato) finisce in
+    background e il suo costo va sommato dal chiamante tramite "speculative" (vedi _speculative_cost).
+    """
+    out = {"organic": [], "features": [], "data": None, "data_regular": None, "regular_http_error": None,
+           "error": None, "calls": 1, "cost": 0.0, "fallback": "none", "fallback_gain": False, "speculative": None}
+
+    task = payload[0]
+    mode = fallback_policy.mode(task["location_code"], task["device"]) if fallback_policy else "after"
+
+    regular_future = None
+    if mode == "parallel":
+        regular_future = get_speculative_pool().submit(_call_dataforseo, session, endpoint_regular, payload, timeout_s, cache)
+        out["calls"] += 1
+
+    def _apply_regular(r2, data2) -> list:
+        """Esito REGULAR -> organic della pagina, aggiornando costo e policy."""
+        organic = []
+        out["fallback"] = mode
+        if r2.status_code == 200:
+            out["data_regular"] = data2
+            out["cost"] += _response_cost(data2)
+            items2, err2 = _extract_items(data2)
+            if not err2:
+                organic, regular_records = _parse_serp_items(items2)
+                # Le feature (PAA, snippet, local pack...) restano quelle di ADVANCED: da REGULAR solo le righe organic
+                out["features"] = out["features"] + [rec for rec in regular_records if rec["Tipo"] == "organic"]
+        else:
+            out["regular_http_error"] = r2.text[:2000]
+        out["fallback_gain"] = len(organic) > 0
+        if fallback_policy is not None:
+            fallback_policy.record(task["location_code"], task["device"],
+                                   attempts=1, gains=int(out["fallback_gain"]))
+        return organic
+
+    # 1) ADVANCED
+    r, data = _call_dataforseo(session, endpoint_advanced, payload, timeout_s=timeout_s, cache=cache)
+    out["data"] = data
+    out["cost"] += _response_cost(data)
+    organic_items = []
+    if r.status_code != 200:
+        out["error"] = f"❌ HTTP {r.status_code}: {r.text[:300]}"
+    else:
+        items, err = _extract_items(data)
+        if err:
+            out["error"] = f"❌ Errore parsing tasks/result: {err}"
+            out["parse_error"] = True
+        else:
+            organic_items, out["features"] = _parse_serp_items(items)
+
+    if out["error"]:
+        # ADVANCED fallito ma REGULAR già partito (e fatturato): se ha organic la pagina è salva
+        if regular_future is not None:
+            try:
+                organic_items = _apply_regular(*regular_future.result())
+            except Exception:
+                # Anche il REGULAR è fallito: tentativo senza guadagno, il costo (se c'è) lo ricava il chiamante
+                organic_items = []
+                out["fallback"] = mode
+                out["speculative"] = regular_future
+                fallback_policy.record(task["location_code"], task["device"], attempts=1)
+            if organic_items:
+                out["error"] = None
+                out.pop("parse_error", None)
+        out["organic"] = organic_items
+        return out
+
+    if organic_items:
+        if regular_future is not None:
+            # REGULAR partito in parallelo ma non necessario: non lo si aspetta, il costo arriva dopo
+            out["speculative"] = regular_future
+            fallback_policy.record(task["location_code"], task["device"], speculative_unused=1)
+    elif mode == "skip":
+        # ADVANCED senza organic: niente fallback se la policy lo ritiene inutile
+        out["fallback"] = "skipped"
+        fallback_policy.record(task["location_code"], task["device"], skipped=1)
+    else:
+        if regular_future is not None:
+            r2, data2 = regular_future.result()
+        else:
+            r2, data2 = _call_dataforseo(session, endpoint_regular, payload, timeout_s=timeout_s, cache=cache)
+            out["calls"] += 1
+        organic_items = _apply_regular(r2, data2)
+
+    out["organic"] = organic_items
+    return out
+
+def _show_debug_raw(outcome: dict):
+    if outcome["data_regular"] is not None:
+        with st.expander("🔎 Debug RAW (regular fallback)"):
+            st.write(outcome["data_regular"])
+    elif outcome["regular_http_error"] is not None:
+        with st.expander("🔎 Debug RAW (regular HTTP error)"):
+            st.write(outcome["regular_http_error"])
+    with st.expander("🔎 Debug RAW (advanced)"):
+        st.write(outcome["data"])
+
+SERP_COLUMNS = ["Posizione", "URL", "Title", "Snippet", "Dominio", "Lunghezza Title", "Lunghezza Snippet"]
+
+# netloc come urlparse: tutto tra "scheme://" e il primo / ? #
+_NETLOC_PATTERN = r"^[A-Za-z][A-Za-z0-9+.\-]*://([^/?#]*)"
+
+def _organic_frame(organic_items: list) -> pd.DataFrame:
+    """
+    Item organic -> DataFrame colonnare: un solo passaggio sugli item per estrarre i campi,
+    poi dominio e lunghezze calcolati in modo vettoriale sulle colonne.
+    """
+    frame = pd.DataFrame({
+        "URL": [it.get("url") or it.get("link") or "" for it in organic_items],
+        "Title": [it.get("title") or "N/A" for it in organic_items],
+        "Snippet": [it.get("description") or it.get("snippet") or "N/A" for it in organic_items],
+    }, dtype="string")
+    frame["Dominio"] = frame["URL"].str.extract(_NETLOC_PATTERN, expand=False).str.lower().fillna("")
+    frame["Lunghezza Title"] = frame["Title"].str.len().astype("int64")
+    frame["Lunghezza Snippet"] = frame["Snippet"].str.len().astype("int64")
+    return frame
+
+def _take_new_organic(frame: pd.DataFrame, seen: set, collected: int, limit: int) -> pd.DataFrame:
+    """Tiene solo gli URL non ancora visti (dedup vettoriale), max `limit`, numerati da collected+1."""
+    if limit <= 0 or frame.empty:
+        return pd.DataFrame(columns=SERP_COLUMNS)
+    fresh = frame[(frame["URL"] != "") & ~frame["URL"].isin(seen)].drop_duplicates("URL").head(limit)
+    seen.update(fresh["URL"])
+    fresh.insert(0, "Posizione", range(collected + 1, collected + 1 + len(fresh)))
+    return fresh[SERP_COLUMNS].reset_index(drop=True)
+
+def _empty_serp_frame() -> pd.DataFrame:
+    return pd.DataFrame(columns=SERP_COLUMNS)
+
+def _compact_organic(organic_items: list) -> list:
+    """Solo i campi usati da _organic_frame (più pagina/rank per _next_page_start): è quello che finisce nei checkpoint."""
+    return [{"url": it.get("url") or it.get("link") or "", "title": it.get("title"),
+             "description": it.get("description") or it.get("snippet"),
+             "page": it.get("page"), "rank_group": it.get("rank_group")} for it in organic_items]
+
+def _next_page_start(organic_items: list) -> int:
+    """
+    start da cui paginare dopo una richiesta depth: ultima pagina SERP davvero restituita (campo `page`),
+    altrimenti rank_group organic più alto. Il numero di organic tenuti non basta: con pagine da meno
+    di 10 organic (feature, dedup) si ripartirebbe troppo indietro o si salterebbero posizioni.
+    """
+    pages = [it.get("page") for it in organic_items if isinstance(it.get("page"), int)]
+    if pages:
+        return max(pages) * 10
+    ranks = [it.get("rank_group") for it in organic_items if isinstance(it.get("rank_group"), int)]
+    last = max(ranks) if ranks else len(organic_items)
+    return -(-last // 10) * 10
+
+def _checkpointed_fetch(checkpoint, unit: str, *fetch_args) -> dict:
+    """
+    _fetch_serp_page con checkpoint: un'unità già completata viene ricostruita dal job store
+    (0 chiamate, 0 costo); una pagina scaricata senza errori viene salvata subito.
+    """
+    if checkpoint is not None:
+        saved = checkpoint.get(unit)
+        if saved is not None:
+            return {"organic": saved["organic"], "features": saved["features"], "data": None, "data_regular": None,
+                    "regular_http_error": None, "error": None, "calls": 0, "cost": 0.0,
+                    "fallback": "none", "fallback_gain": False, "speculative": None, "from_checkpoint": True}
+    outcome = _fetch_serp_page(*fetch_args)
+    if checkpoint is not None and not outcome["error"]:
+        checkpoint.put(unit, {"organic": _compact_organic(outcome["organic"]), "features": outcome["features"]},
+                       outcome["cost"])
+    return outcome
+
+def serp_features_frame(records: list, extra_columns: tuple = ()) -> pd.DataFrame:
+    """Record di _parse_serp_items -> DataFrame (colonne extra es. Keyword/Mercato/Device in testa)."""
+    columns = list(extra_columns) + FEATURE_COLUMNS
+    frame = pd.DataFrame.from_records(records, columns=columns) if records else pd.DataFrame(columns=columns)
+    frame["Rank"] = pd.to_numeric(frame["Rank"], errors="coerce").astype("Int64")
+    for col in ("X", "Y", "Larghezza", "Altezza"):
+        frame[col] = pd.to_numeric(frame[col], errors="coerce")
+    return frame
+
+def iter_google_organic_dataforseo(
     keyword: str,
     login: str,
     password: str,
@@ -134,204 +1149,1170 @@ def fetch_google_organic_dataforseo(
     hl: str,
     device: str = "desktop",
     target_results: int = 100,
-    sleep_s: float = 0.3,
-    debug_raw: bool = False
+    concurrency: int = 5,
+    strategy: str = "depth",
+    cache: SerpResponseCache = None,
+    fallback_policy: RegularFallbackPolicy = None,
+    session=None,
+    client: DataForSEOAsyncClient = None,
+    calculate_rectangles: bool = False,
+    checkpoint: JobCheckpoint = None,
+    metrics: SerpCallMetrics = None
 ):
     """
-    Estrae fino a target_results ORGANIC paginando con start=0,10,20...
+    Generatore: estrae fino a target_results ORGANIC ed emette eventi man mano che le pagine arrivano.
+    strategy="depth": UNA sola task con depth=target_results; paginazione solo come fallback
+                      (errore/timeout o meno organic del richiesto).
+    strategy="paged": paginazione classica con start=0,10,20...
+    Per ogni chiamata:
     1) Prova endpoint ADVANCED
     2) Se ADVANCED ritorna 0 organic, prova endpoint REGULAR come fallback
-    """
-    endpoint_advanced = "https://api.dataforseo.com/v3/serp/google/organic/live/advanced"
-    endpoint_regular  = "https://api.dataforseo.com/v3/serp/google/organic/live/regular"
-
-    session = requests.Session()
-    session.headers.update({
-        "Authorization": _basic_auth_header(login, password),
-        "Content-Type": "application/json"
-    })
 
-    results = []
+    Con concurrency > 1 le pagine necessarie vengono richieste tutte insieme (a ondate di
+    max `concurrency` richieste) e poi elaborate in ordine di start: dedup per URL, ordine
+    delle posizioni e stop dopo 2 pagine vuote restano identici alla modalità sequenziale.
+    Nessuna pausa fissa tra le pagine: il ritmo lo decide il rate limiter del client.
+    Con `cache` le risposte già viste (stessa keyword/paese/device/pagina) non vengono rifatturate.
+    Con `fallback_policy` il fallback REGULAR è adattivo (vedi RegularFallbackPolicy).
+    Le chiamate passano dal client HTTP condiviso (`client`, default get_dataforseo_client()).
+    `session` permette di condividere credenziali e tetto di concorrenza tra più estrazioni (matrice).
+    Con `checkpoint` ogni pagina completata viene salvata nel job store e, se il job viene ripreso,
+    riletta da lì invece di essere richiesta (e pagata) di nuovo.
+
+    Non usa st.*: eventi emessi (dict con chiave "type")
+      - "status": {"level": markdown|info|warning|error, "message"}
+      - "page":   {"rows": DataFrame delle nuove righe (SERP_COLUMNS), "features": record nuovi di tutti gli item,
+                   "outcome": esito _fetch_serp_page, "collected": totale raccolto}
+      - "done":   {"stats": chiamate, costo, tempo, fallback}
+    """
+    endpoint_advanced = f"{DATAFORSEO_SERP_BASE}/live/advanced"
+    endpoint_regular  = f"{DATAFORSEO_SERP_BASE}/live/regular"
+
+    concurrency = max(1, int(concurrency))
+    t0 = time.perf_counter()
+    calls = 0
+    cost = 0.0
+    fallback_runs = 0
+    fallback_gains = 0
+    resumed_units = 0
+    failed_pages = 0
+    speculative = []  # REGULAR paralleli non attesi: costo sommato a fine estrazione
+
+    if session is None:
+        session = _new_dataforseo_session(login, password, client, metrics)
+
+    collected = 0
     seen = set()
-
-    progress_bar = st.progress(0)
-    status = st.empty()
+    seen_features = set()
+    feature_count = 0
+
+    def _status(level, message):
+        return {"type": "status", "level": level, "message": message}
+
+    def _page(outcome, rows):
+        nonlocal feature_count
+        # In paginazione le stesse feature (es. PAA) possono ripetersi: dedup per tipo/url/title
+        features = []
+        for rec in outcome.get("features") or []:
+            key = (rec["Tipo"], rec["URL"], rec["Title"])
+            if rec["Tipo"] == "organic" or key not in seen_features:
+                seen_features.add(key)
+                features.append(rec)
+        feature_count += sum(rec["Tipo"] != "organic" for rec in features)
+        return {"type": "page", "rows": rows, "features": features, "outcome": outcome, "collected": collected}
 
     start = 0
     page = 1
     no_new_pages = 0
     max_pages = 30  # 30 pagine = 300 posizioni (margine ampio)
+    stop = False
 
-    # Parametri Google: pws=0 (no personalization), nfpr=1 (no autocorrect)
-    # NB: gl/hl qui DEVONO essere validi, per UK gl=gb
-    while len(results) < target_results and page <= max_pages:
-        progress_bar.progress(min(len(results) / max(target_results, 1), 0.95))
-        status.markdown(f"**🔄 Pagina {page} (start={start}) — Organic raccolti: {len(results)}/{target_results}**")
-
-        search_param = f"num=10&start={start}&pws=0&nfpr=1&hl={hl}&gl={gl}"
-
-        payload = [{
-            "keyword": keyword,
-            "location_code": location_code,
-            "language_code": language_code,
-            "se_domain": se_domain,
-            "device": device,
-            "search_param": search_param,
-            "depth": 10
-        }]
-
+    if strategy == "depth":
+        depth = min(max(int(target_results), 10), 700)  # 700 = depth massima DataForSEO
+        yield _status("markdown", f"**🔄 Richiesta unica depth={depth} — Organic richiesti: {target_results}**")
         try:
-            # 1) ADVANCED
-            r, data = _call_dataforseo(session, endpoint_advanced, payload, timeout_s=60)
+            outcome = _checkpointed_fetch(
+                checkpoint, f"depth:{depth}",
+                session, endpoint_advanced, endpoint_regular,
+                _build_payload(keyword, location_code, language_code, se_domain, device, gl, hl, depth=depth,
+                               calculate_rectangles=calculate_rectangles),
+                120, cache, fallback_policy
+            )
+            resumed_units += bool(outcome.get("from_checkpoint"))
+            calls += outcome["calls"]
+            cost += outcome["cost"]
+            if outcome["speculative"] is not None:
+                speculative.append(outcome["speculative"])
+            fallback_runs += outcome["fallback"] in ("after", "parallel")
+            fallback_gains += outcome["fallback_gain"]
+            if outcome["error"]:
+                yield _status("warning", f"{outcome['error']} — passo alla paginazione.")
+            else:
+                rows = _take_new_organic(_organic_frame(outcome["organic"]), seen, collected, target_results - collected)
+                collected += len(rows)
+                start = _next_page_start(outcome["organic"])
+                yield _page(outcome, rows)
+        except DATAFORSEO_TIMEOUTS:
+            calls += 1
+            yield _status("warning", "⚠️ Timeout sulla richiesta depth. Passo alla paginazione...")
+        except Exception as e:
+            calls += 1
+            yield _status("warning", f"⚠️ Errore sulla richiesta depth ({str(e)}). Passo alla paginazione...")
+
+        # Fallback: si riprende a paginare dall'ultima pagina SERP coperta dalla richiesta depth
+        # (start resta 0 se la depth è fallita; gli URL già visti sono comunque scartati dal dedup)
+        page = start // 10 + 1
+        if 0 < collected < target_results:
+            # Meno organic della depth richiesta: la SERP è quasi certamente finita,
+            # conta come prima pagina vuota (basta un'altra pagina vuota per fermarsi)
+            no_new_pages = 1
+            yield _status("info", f"ℹ️ Depth: {collected}/{target_results} organic, completo con la paginazione da start={start}...")
+
+    with ThreadPoolExecutor(max_workers=concurrency) as pool:
+        while not stop and collected < target_results and page <= max_pages:
+            # Pagine ancora necessarie per arrivare a target_results (10 organic max per pagina)
+            needed = -(-(target_results - collected) // 10)
+            wave = max(1, min(needed, concurrency, max_pages - page + 1))
+            if no_new_pages > 0:
+                # SERP probabilmente finita: sondiamo una pagina alla volta invece di un'ondata intera
+                wave = 1
+            starts = [start + 10 * i for i in range(wave)]
+
+            if wave == 1:
+                yield _status("markdown", f"**🔄 Pagina {page} (start={start}) — Organic raccolti: {collected}/{target_results}**")
+            else:
+                yield _status("markdown", f"**🔄 Pagine {page}-{page + wave - 1} in parallelo (start={starts[0]}…{starts[-1]}) — Organic raccolti: {collected}/{target_results}**")
+
+            futures = [
+                pool.submit(
+                    _checkpointed_fetch, checkpoint, f"start:{s}",
+                    session, endpoint_advanced, endpoint_regular,
+                    _build_payload(keyword, location_code, language_code, se_domain, device, gl, hl, start=s,
+                                   calculate_rectangles=calculate_rectangles),
+                    60, cache, fallback_policy
+                )
+                for s in starts
+            ]
 
-            if r.status_code != 200:
-                status.error(f"❌ HTTP {r.status_code}: {r.text[:300]}")
-                break
+            # Elaborazione in ordine di start, così le posizioni restano quelle della SERP:
+            # ogni pagina viene emessa appena arriva (la prima dopo un solo round trip)
+            for page_start, future in zip(starts, futures):
+                if stop:
+                    future.cancel()
+                    continue
 
-            items, err = _extract_items(data)
-            if err:
-                status.error(f"❌ Errore parsing tasks/result: {err}")
-                if debug_raw:
-                    with st.expander("🔎 Debug RAW (advanced)"):
-                        st.write(data)
-                break
+                try:
+                    outcome = future.result()
+                except DATAFORSEO_TIMEOUTS:
+                    calls += 1
+                    failed_pages += 1
+                    yield _status("warning", f"⚠️ Timeout su pagina {page}. Vado avanti...")
+                    page += 1
+                    continue
+                except Exception as e:
+                    calls += 1
+                    failed_pages += 1
+                    yield _status("error", f"❌ Errore: {str(e)}")
+                    stop = True
+                    continue
 
-            organic_items = [it for it in items if _is_organic(it)]
-            # Se ADVANCED non restituisce organic, proviamo REGULAR (fallback)
-            if len(organic_items) == 0:
-                r2, data2 = _call_dataforseo(session, endpoint_regular, payload, timeout_s=60)
-                if r2.status_code == 200:
-                    items2, err2 = _extract_items(data2)
-                    if not err2:
-                        organic_items = [it for it in items2 if _is_organic(it)]
-                    if debug_raw:
-                        with st.expander("🔎 Debug RAW (regular fallback)"):
-                            st.write(data2)
+                resumed_units += bool(outcome.get("from_checkpoint"))
+                calls += outcome["calls"]
+                cost += outcome["cost"]
+                if outcome["speculative"] is not None:
+                    speculative.append(outcome["speculative"])
+                fallback_runs += outcome["fallback"] in ("after", "parallel")
+                fallback_gains += outcome["fallback_gain"]
+
+                if outcome["error"]:
+                    failed_pages += 1
+                    yield _status("error", outcome["error"])
+                    yield _page(outcome, _empty_serp_frame())
+                    stop = True
+                    continue
+
+                rows = _take_new_organic(_organic_frame(outcome["organic"]), seen, collected, target_results - collected)
+                new_this_page = len(rows)
+                collected += new_this_page
+                yield _page(outcome, rows)
+
+                page += 1
+                if collected >= target_results:
+                    stop = True
+                    continue
+
+                # Stop condition: 2 pagine consecutive senza nuovi organic
+                if new_this_page == 0:
+                    no_new_pages += 1
+                    if no_new_pages >= 2:
+                        stop = True
                 else:
-                    if debug_raw:
-                        with st.expander("🔎 Debug RAW (regular HTTP error)"):
-                            st.write(r2.text[:2000])
+                    no_new_pages = 0
+
+            start = starts[-1] + 10
+
+    cost += sum(_speculative_cost(future) for future in speculative)
+    yield {"type": "done", "stats": {
+        "strategy": strategy,
+        "results": collected,
+        "features": feature_count,
+        "calls": calls,
+        "cost": cost,
+        "elapsed_s": time.perf_counter() - t0,
+        "fallback_runs": fallback_runs,
+        "fallback_gains": fallback_gains,
+        "resumed_units": resumed_units,
+        "failed_pages": failed_pages,
+    }}
+
+class StreamlitProgress:
+    """
+    Progress bar + riga di stato Streamlit. Le funzioni di fetch accettano un `report` con la stessa
+    firma (fraction, message, level): nei job in background è il BackgroundJob, che non usa st.*.
+    """
 
-            if debug_raw:
-                with st.expander("🔎 Debug RAW (advanced)"):
-                    st.write(data)
+    def __init__(self):
+        self.bar = st.progress(0)
+        self.status = st.empty()
 
-            new_this_page = 0
-            for it in organic_items:
-                url = it.get("url") or it.get("link") or ""
-                title = it.get("title") or "N/A"
-                snippet = it.get("description") or it.get("snippet") or "N/A"
+    def __call__(self, fraction: float = None, message: str = None, level: str = "markdown"):
+        if fraction is not None:
+            self.bar.progress(min(max(float(fraction), 0.0), 1.0))
+        if message:
+            getattr(self.status, level)(message)
 
-                if not url or url in seen:
-                    continue
+def fetch_google_organic_dataforseo(
+    keyword: str,
+    login: str,
+    password: str,
+    location_code: int,
+    language_code: str,
+    se_domain: str,
+    gl: str,
+    hl: str,
+    device: str = "desktop",
+    target_results: int = 100,
+    debug_raw: bool = False,
+    concurrency: int = 5,
+    strategy: str = "depth",
+    stats: dict = None,
+    cache: SerpResponseCache = None,
+    fallback_policy: RegularFallbackPolicy = None,
+    on_rows=None,
+    client: DataForSEOAsyncClient = None,
+    calculate_rectangles: bool = False,
+    features: list = None,
+    checkpoint: JobCheckpoint = None,
+    report=None,
+    metrics: SerpCallMetrics = None
+):
+    """
+    Versione Streamlit di iter_google_organic_dataforseo: progress bar, messaggi di stato e debug RAW.
+    Con `report` (vedi StreamlitProgress) non usa st.*: può girare in un job in background.
+    `on_rows(df)` viene chiamata ad ogni pagina con nuovi organic (rendering incrementale).
+    Se `stats` è un dict viene riempito con chiamate, costo (campo `cost`) e tempo impiegato.
+    Se `features` è una lista viene estesa con i record di tutti gli item SERP (organic e feature).
+    Ritorna un DataFrame con colonne SERP_COLUMNS.
+    """
+    frames = []
+    collected = 0
+
+    progress = report or StreamlitProgress()
+
+    for event in iter_google_organic_dataforseo(
+        keyword, login, password, location_code, language_code, se_domain, gl, hl,
+        device=device, target_results=target_results, concurrency=concurrency,
+        strategy=strategy, cache=cache, fallback_policy=fallback_policy, client=client,
+        calculate_rectangles=calculate_rectangles, checkpoint=checkpoint, metrics=metrics
+    ):
+        if event["type"] == "status":
+            progress(message=event["message"], level=event["level"])
+        elif event["type"] == "page":
+            outcome = event["outcome"]
+            if features is not None:
+                features.extend(event["features"])
+            if debug_raw and report is None:
+                if outcome["error"]:
+                    if outcome.get("parse_error"):
+                        with st.expander("🔎 Debug RAW (advanced)"):
+                            st.write(outcome["data"])
+                else:
+                    _show_debug_raw(outcome)
+            if len(event["rows"]):
+                frames.append(event["rows"])
+                collected = event["collected"]
+                progress(min(collected / max(target_results, 1), 0.95))
+                if on_rows is not None:
+                    on_rows(pd.concat(frames, ignore_index=True))
+        elif event["type"] == "done" and stats is not None:
+            stats.update(event["stats"])
+
+    progress(1.0)
+
+    if collected < target_results:
+        progress(message=f"⚠️ Finito: trovati {collected} risultati ORGANIC. (Google/risposta API non ne ha restituiti di più)", level="warning")
+    else:
+        progress(message=f"✅ OK: trovati {collected} risultati ORGANIC", level="success")
+
+    return pd.concat(frames, ignore_index=True) if frames else _empty_serp_frame()
 
-                seen.add(url)
-                domain = ""
+def compare_fetch_strategies(runs: dict) -> tuple:
+    """
+    Confronta le strategie di fetch sulla stessa keyword.
+    runs = {"depth": (results_df, stats), "paged": (results_df, stats)}
+    Ritorna (tabella latenza/costo, dict di parità risultati).
+    """
+    rows = []
+    for name, (res, st_) in runs.items():
+        rows.append({
+            "Strategia": name,
+            "Organic": st_.get("results", len(res)),
+            "Chiamate API": st_.get("calls", 0),
+            "Latenza (s)": round(st_.get("elapsed_s", 0.0), 2),
+            "Costo ($/keyword)": round(st_.get("cost", 0.0), 5),
+        })
+    table = pd.DataFrame(rows)
+
+    (res_a, _), (res_b, _) = list(runs.values())[:2]
+    merged = res_a[["URL", "Posizione"]].merge(res_b[["URL", "Posizione"]], on="URL", how="outer",
+                                               suffixes=("_a", "_b"), indicator=True)
+    common = merged[merged["_merge"] == "both"]
+    parity = {
+        "URL in comune": len(common),
+        "Overlap URL (%)": round(100 * len(common) / len(merged), 1) if len(merged) else 100.0,
+        "Stessa posizione (%)": round(float(100 * (common["Posizione_a"] == common["Posizione_b"]).mean()), 1) if len(common) else 0.0,
+        "Solo prima strategia": int((merged["_merge"] == "left_only").sum()),
+        "Solo seconda strategia": int((merged["_merge"] == "right_only").sum()),
+    }
+    return table, parity
+
+def _matrix_frame(combos: list, by_combo: dict) -> pd.DataFrame:
+    """Risultati delle combinazioni completate, nell'ordine di `combos`, con colonne Mercato/Device."""
+    results = pd.concat(
+        [by_combo[combo].assign(Mercato=combo[0], Device=combo[1]) for combo in combos if combo in by_combo],
+        ignore_index=True
+    ) if by_combo else _empty_serp_frame().assign(Mercato=None, Device=None)
+    return results[["Mercato", "Device"] + SERP_COLUMNS]
+
+def fetch_serp_matrix(
+    keyword: str,
+    login: str,
+    password: str,
+    markets: list,
+    devices: list,
+    target_results: int = 100,
+    strategy: str = "depth",
+    concurrency: int = 5,
+    max_in_flight: int = 20,
+    cache: SerpResponseCache = None,
+    fallback_policy: RegularFallbackPolicy = None,
+    client: DataForSEOAsyncClient = None,
+    calculate_rectangles: bool = False,
+    features: list = None,
+    checkpoint: JobCheckpoint = None,
+    report=None,
+    metrics: SerpCallMetrics = None,
+    on_rows=None
+):
+    """
+    Stessa keyword su tutte le combinazioni mercato (chiave di PAESI) × device, in parallelo.
+    Tutte le estrazioni condividono il client HTTP (pool di connessioni) e un tetto globale
+    di `max_in_flight` richieste HTTP contemporanee.
+    Ritorna (DataFrame con colonne Mercato/Device + SERP_COLUMNS, errori).
+    Se `features` è una lista viene estesa con i record degli item SERP (con Mercato/Device).
+    `on_rows(df)` riceve i risultati parziali ad ogni combinazione completata.
+    """
+    combos = [(m, d) for m in markets for d in devices]
+    shared = _CappedSession(_new_dataforseo_session(login, password, client, metrics), max_in_flight)
+
+    def _run_combo(market, device):
+        info = PAESI[market]
+        frames, records, problems = [], [], []
+        for event in iter_google_organic_dataforseo(
+            keyword, login, password, info["location_code"], info["language_code"], info["se_domain"],
+            info["gl"], info["hl"], device=device, target_results=target_results, concurrency=concurrency,
+            strategy=strategy, cache=cache, fallback_policy=fallback_policy, session=shared,
+            calculate_rectangles=calculate_rectangles,
+            checkpoint=checkpoint.scoped(f"{market}|{device}|") if checkpoint is not None else None
+        ):
+            if event["type"] == "page":
+                frames.append(event["rows"])
+                records.extend({"Mercato": market, "Device": device, **rec} for rec in event["features"])
+            elif event["type"] == "status" and event["level"] == "error":
+                problems.append(f"{market} · {device}: {event['message']}")
+            elif event["type"] == "done" and event["stats"]["failed_pages"] and not problems:
+                problems.append(f"{market} · {device}: {event['stats']['failed_pages']} pagine non completate (timeout)")
+        return (pd.concat(frames, ignore_index=True) if frames else _empty_serp_frame()), records, problems
+
+    progress = report or StreamlitProgress()
+    progress(message=f"**🌍 {len(combos)} combinazioni mercato × device in parallelo (max {max_in_flight} richieste contemporanee)...**")
+
+    by_combo = {}
+    errors = []
+    with ThreadPoolExecutor(max_workers=max(1, len(combos))) as pool:
+        futures = {pool.submit(_run_combo, m, d): (m, d) for m, d in combos}
+        for done, future in enumerate(as_completed(futures), start=1):
+            market, device = futures[future]
+            try:
+                rows, records, problems = future.result()
+            except Exception as e:
+                rows, records, problems = _empty_serp_frame(), [], [f"{market} · {device}: {str(e)}"]
+            by_combo[(market, device)] = rows
+            if features is not None:
+                features.extend(records)
+            errors.extend(problems)
+            progress(done / len(combos), f"**🌍 Completate {done}/{len(combos)} — ultima: {market} · {device} ({len(rows)} organic)**")
+            if on_rows is not None and len(rows):
+                on_rows(_matrix_frame(combos, by_combo))
+
+    results = _matrix_frame(combos, by_combo)
+
+    progress(1.0, f"✅ Matrice completata: {len(combos)} combinazioni, {len(results)} risultati ORGANIC", level="success")
+    return results, errors
+
+def build_position_matrix(df: pd.DataFrame) -> pd.DataFrame:
+    """Tabella URL × (mercato · device) con la posizione, più presenze e posizione media."""
+    if df.empty:
+        return pd.DataFrame()
+    long_df = df.assign(Colonna=df["Mercato"] + " · " + df["Device"])
+    matrix = long_df.pivot_table(index="URL", columns="Colonna", values="Posizione", aggfunc="min")
+    ordered_cols = list(dict.fromkeys(long_df["Colonna"]))
+    matrix = matrix.reindex(columns=ordered_cols)
+    matrix.insert(0, "Posizione media", matrix.mean(axis=1).round(1))
+    matrix.insert(0, "Presenze", matrix[ordered_cols].notna().sum(axis=1))
+    domains = long_df.drop_duplicates("URL").set_index("URL")["Dominio"]
+    matrix.insert(0, "Dominio", domains.reindex(matrix.index))
+    return matrix.sort_values(["Presenze", "Posizione media"], ascending=[False, True]).reset_index()
+
+
+def parse_keyword_list(text: str = "", csv_file=None) -> list:
+    """Keyword da textarea (una per riga) e/o CSV (colonna keyword/query o prima colonna), dedup in ordine."""
+    keywords = [k.strip() for k in (text or "").splitlines()]
+    if csv_file is not None:
+        csv_df = pd.read_csv(csv_file)
+        if len(csv_df.columns):
+            col = next((c for c in csv_df.columns if str(c).strip().lower() in {"keyword", "keywords", "query"}), csv_df.columns[0])
+            keywords += [str(k).strip() for k in csv_df[col].dropna().tolist()]
+    return list(dict.fromkeys(k for k in keywords if k))
+
+def _post_batch_tasks(session: DataForSEOSession, keywords: list, location_code: int, language_code: str,
+                      se_domain: str, device: str, gl: str, hl: str, depth: int, calculate_rectangles: bool = False,
+                      checkpoint: JobCheckpoint = None):
+    """
+    Invia i task in blocchi da TASK_POST_MAX_TASKS alla coda standard.
+    Con `checkpoint` i blocchi già inviati non vengono rispediti (i task restano sulla coda DataForSEO).
+    Ritorna (task_id -> keyword, lista errori, task_id ripresi dal checkpoint).
+    """
+    task_ids = {}
+    errors = []
+    resumed_ids = set()
+    for i in range(0, len(keywords), TASK_POST_MAX_TASKS):
+        chunk = keywords[i:i + TASK_POST_MAX_TASKS]
+        posted = checkpoint.get(f"post:{i}") if checkpoint is not None else None
+        if posted is not None:
+            task_ids.update(posted)
+            resumed_ids.update(posted)
+            continue
+        payload = []
+        for j, kw in enumerate(chunk):
+            task = _build_payload(kw, location_code, language_code, se_domain, device, gl, hl, depth=depth,
+                                  calculate_rectangles=calculate_rectangles)[0]
+            task["tag"] = str(i + j)  # indice nella lista keyword: DataForSEO può normalizzare data.keyword
+            payload.append(task)
+
+        r, data = _call_dataforseo(session, f"{DATAFORSEO_SERP_BASE}/task_post", payload, timeout_s=60)
+        if r.status_code != 200 or not isinstance(data, dict) or data.get("status_code") != 20000:
+            errors.append(f"task_post keyword {i + 1}-{i + len(chunk)}: HTTP {r.status_code} {r.text[:200]}")
+            continue
+
+        chunk_ids = {}
+        for task in data.get("tasks") or []:
+            task_data = (task or {}).get("data") or {}
+            tag = str(task_data.get("tag") or "")
+            kw = keywords[int(tag)] if tag.isdigit() and int(tag) < len(keywords) else task_data.get("keyword")
+            if task.get("status_code") == 20100 and task.get("id"):
+                chunk_ids[task["id"]] = kw
+            else:
+                errors.append(f"task_post '{kw}': status_code={task.get('status_code')} msg={task.get('status_message')}")
+        task_ids.update(chunk_ids)
+        if checkpoint is not None:
+            checkpoint.put(f"post:{i}", chunk_ids, data.get("cost"))
+    return task_ids, errors, resumed_ids
+
+def _get_batch_task(session: DataForSEOSession, task_id: str):
+    """task_get/advanced per un task pronto. Ritorna (item organic grezzi, record di tutti gli item, errore)."""
+    r, data = _call_dataforseo(session, f"{DATAFORSEO_SERP_BASE}/task_get/advanced/{task_id}", None, timeout_s=60)
+    if r.status_code != 200:
+        return [], [], f"HTTP {r.status_code}: {r.text[:200]}"
+    items, err = _extract_items(data)
+    if err:
+        return [], [], err
+    organic, records = _parse_serp_items(items)
+    return organic, records, None
+
+def build_batch_frame(keywords: list, organic_by_keyword: dict, target_results: int) -> pd.DataFrame:
+    """
+    Tutti gli organic del batch in un unico DataFrame: colonne costruite in un passaggio,
+    dominio/lunghezze vettoriali, dedup e posizioni per keyword con drop_duplicates/cumcount.
+    """
+    keyword_col, all_items = [], []
+    for kw in keywords:
+        items = organic_by_keyword.get(kw) or []
+        keyword_col.extend([kw] * len(items))
+        all_items.extend(items)
+    frame = _organic_frame(all_items)
+    frame.insert(0, "Keyword", pd.array(keyword_col, dtype="string"))
+    frame = frame[frame["URL"] != ""].drop_duplicates(["Keyword", "URL"])
+    frame.insert(1, "Posizione", frame.groupby("Keyword", sort=False).cumcount() + 1)
+    frame = frame[frame["Posizione"] <= target_results]
+    return frame[["Keyword"] + SERP_COLUMNS].reset_index(drop=True)
+
+def fetch_google_organic_batch_dataforseo(
+    keywords: list,
+    login: str,
+    password: str,
+    location_code: int,
+    language_code: str,
+    se_domain: str,
+    gl: str,
+    hl: str,
+    device: str = "desktop",
+    target_results: int = 100,
+    concurrency: int = 5,
+    poll_interval_s: float = 5.0,
+    max_wait_s: float = 1800.0,
+    client: DataForSEOAsyncClient = None,
+    calculate_rectangles: bool = False,
+    features: list = None,
+    checkpoint: JobCheckpoint = None,
+    report=None,
+    metrics: SerpCallMetrics = None,
+    on_rows=None,
+    stats: dict = None
+):
+    """
+    Modalità batch: una task (depth=target_results) per keyword sulla coda standard.
+    1) task_post a blocchi da 100 task
+    2) polling di tasks_ready
+    3) task_get/advanced dei task pronti (in parallelo), parsing con _extract_items/_parse_serp_items
+    Ritorna (DataFrame con colonna Keyword + SERP_COLUMNS, errori).
+    Se `features` è una lista viene estesa con i record degli item SERP (con Keyword).
+    Con `checkpoint` ogni keyword completata viene salvata subito: riprendendo il job si rileggono
+    le keyword già scaricate e si recuperano direttamente i task già inviati.
+    `on_rows(df)` riceve i risultati parziali ogni volta che arrivano nuove keyword.
+    Se `stats` è un dict, stats["restored_keywords"] elenca le keyword rilette dal checkpoint.
+    """
+    concurrency = max(1, int(concurrency))
+    depth = min(max(int(target_results), 10), 700)
+
+    session = _new_dataforseo_session(login, password, client, metrics)
+
+    progress = report or StreamlitProgress()
+
+    progress(message=f"**📤 Invio di {len(keywords)} task alla coda DataForSEO...**")
+    task_ids, errors, resumed_ids = _post_batch_tasks(session, keywords, location_code, language_code, se_domain, device, gl, hl, depth,
+                                                      calculate_rectangles, checkpoint)
+    if not task_ids:
+        progress(message="❌ Nessun task creato.", level="error")
+        return build_batch_frame([], {}, target_results), errors
+
+    organic_by_keyword = {}
+    pending = set(task_ids)
+    failed = 0
+    t0 = time.time()
+
+    def _store(tid, organic, records):
+        organic_by_keyword[task_ids[tid]] = organic
+        if features is not None:
+            features.extend({"Keyword": task_ids[tid], **rec} for rec in records)
+
+    if checkpoint is not None:
+        for tid in list(pending):
+            saved = checkpoint.get(f"kw:{tid}")
+            if saved is not None:
+                _store(tid, saved["organic"], saved["features"])
+                pending.discard(tid)
+                if stats is not None:
+                    stats.setdefault("restored_keywords", []).append(task_ids[tid])
+        if len(pending) < len(task_ids):
+            progress(message=f"**♻️ Ripresa: {len(task_ids) - len(pending)} keyword già completate nel checkpoint**")
+
+    with ThreadPoolExecutor(max_workers=concurrency) as pool:
+        if checkpoint is not None and pending & resumed_ids:
+            # Task inviati in una sessione precedente: potrebbero essere già stati letti da tasks_ready,
+            # quindi si prova subito task_get (quelli ancora in coda restano in attesa)
+            futures = {pool.submit(_get_batch_task, session, tid): tid for tid in pending & resumed_ids}
+            for future in as_completed(futures):
+                tid = futures[future]
                 try:
-                    domain = urlparse(url).netloc.lower()
-                except:
-                    pass
-
-                results.append({
-                    "Posizione": len(results) + 1,
-                    "URL": url,
-                    "Title": title,
-                    "Snippet": snippet,
-                    "Dominio": domain,
-                    "Lunghezza Title": len(title),
-                    "Lunghezza Snippet": len(snippet),
-                })
-                new_this_page += 1
-
-                if len(results) >= target_results:
-                    break
-
-            # Stop condition: 2 pagine consecutive senza nuovi organic
-            if new_this_page == 0:
-                no_new_pages += 1
-                if no_new_pages >= 2:
-                    break
+                    organic, records, err = future.result()
+                except Exception:
+                    continue
+                if not err:
+                    checkpoint.put(f"kw:{tid}", {"organic": _compact_organic(organic), "features": records})
+                    _store(tid, organic, records)
+                    pending.discard(tid)
+
+        while pending and time.time() - t0 < max_wait_s:
+            r, data = _call_dataforseo(session, f"{DATAFORSEO_SERP_BASE}/tasks_ready", None, timeout_s=60)
+            ready = []
+            if r.status_code == 200 and isinstance(data, dict):
+                for task in data.get("tasks") or []:
+                    for res in (task or {}).get("result") or []:
+                        if res.get("id") in pending:
+                            ready.append(res["id"])
             else:
-                no_new_pages = 0
+                errors.append(f"tasks_ready: HTTP {r.status_code}")
 
-            start += 10
-            page += 1
-            time.sleep(sleep_s)
+            futures = {pool.submit(_get_batch_task, session, tid): tid for tid in ready}
+            for future in as_completed(futures):
+                tid = futures[future]
+                pending.discard(tid)
+                try:
+                    organic, records, err = future.result()
+                except Exception as e:
+                    organic, records, err = [], [], str(e)
+                if err:
+                    failed += 1
+                    errors.append(f"'{task_ids[tid]}': {err}")
+                    continue
+                if checkpoint is not None:
+                    checkpoint.put(f"kw:{tid}", {"organic": _compact_organic(organic), "features": records})
+                _store(tid, organic, records)
 
-        except requests.exceptions.Timeout:
-            status.warning(f"⚠️ Timeout su pagina {page}. Vado avanti...")
-            start += 10
-            page += 1
-            time.sleep(1.0)
-        except Exception as e:
-            status.error(f"❌ Errore: {str(e)}")
-            break
+            done = len(task_ids) - len(pending)
+            progress(min(done / len(task_ids), 1.0), f"**⏳ Task completati: {done}/{len(task_ids)} — in attesa: {len(pending)}**")
+            if on_rows is not None and ready:
+                on_rows(build_batch_frame(keywords, organic_by_keyword, target_results))
+            if pending:
+                time.sleep(poll_interval_s)
 
-    progress_bar.progress(1.0)
+    if pending:
+        errors.append(f"{len(pending)} task non pronti entro {int(max_wait_s)}s")
 
-    if len(results) < target_results:
-        status.warning(f"⚠️ Finito: trovati {len(results)} risultati ORGANIC. (Google/risposta API non ne ha restituiti di più)")
-    else:
-        status.success(f"✅ OK: trovati {len(results)} risultati ORGANIC")
+    results = build_batch_frame(keywords, organic_by_keyword, target_results)
 
-    return results
+    failed_text = f", {failed} fallite" if failed else ""
+    progress(1.0, f"✅ Batch completato: {len(organic_by_keyword)}/{len(keywords)} keyword{failed_text}, "
+                  f"{len(results)} risultati ORGANIC", level="success")
+    return results, errors
 
 
 # ----------------------------
-# EXPORT + CHARTS
+# STORICO RANK TRACKING (SQLite, append-only)
 # ----------------------------
-def create_excel_export(df, query):
-    output = BytesIO()
-    with pd.ExcelWriter(output, engine='openpyxl') as writer:
-        df.to_excel(writer, sheet_name='Risultati Completi', index=False)
-
-        stats_df = pd.DataFrame({
-            'Metrica': [
-                'Totale Risultati',
-                'Lunghezza Media Title',
-                'Lunghezza Media Snippet',
-                'Domini Unici',
-                'Query Analizzata'
-            ],
-            'Valore': [
-                len(df),
-                f"{df['Lunghezza Title'].mean():.1f} caratteri" if len(df) else "0",
-                f"{df['Lunghezza Snippet'].mean():.1f} caratteri" if len(df) else "0",
-                df['Dominio'].nunique() if len(df) else 0,
-                query
-            ]
+class SerpHistoryStore:
+    """
+    Storico append-only delle SERP estratte.
+    - snapshots: una riga per estrazione (keyword, location_code, device, fetched_at)
+    - urls:      URL/dominio "internati" una sola volta
+    - serp_rows: (snapshot_id, position, url_id) WITHOUT ROWID, raggruppate per snapshot
+    Gli indici coprono la lettura tipica (una keyword/paese/device su un intervallo di date),
+    che resta sotto il secondo anche con un anno di snapshot giornalieri per migliaia di keyword.
+    """
+
+    def __init__(self, path: Path):
+        path.parent.mkdir(parents=True, exist_ok=True)
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(str(path), check_same_thread=False)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.executescript("""
+            CREATE TABLE IF NOT EXISTS snapshots (
+                id INTEGER PRIMARY KEY,
+                keyword TEXT NOT NULL,
+                location_code INTEGER NOT NULL,
+                device TEXT NOT NULL,
+                fetched_at REAL NOT NULL,
+                day TEXT NOT NULL
+            );
+            CREATE INDEX IF NOT EXISTS idx_snapshots_lookup ON snapshots(keyword, location_code, device, fetched_at);
+            CREATE TABLE IF NOT EXISTS urls (
+                id INTEGER PRIMARY KEY,
+                url TEXT NOT NULL UNIQUE,
+                domain TEXT NOT NULL
+            );
+            CREATE TABLE IF NOT EXISTS serp_rows (
+                snapshot_id INTEGER NOT NULL,
+                position INTEGER NOT NULL,
+                url_id INTEGER NOT NULL,
+                PRIMARY KEY (snapshot_id, position)
+            ) WITHOUT ROWID;
+        """)
+        self._conn.commit()
+
+    def save_snapshot(self, keyword: str, location_code: int, device: str, rows: pd.DataFrame, fetched_at: float = None) -> int:
+        """Aggiunge una SERP (DataFrame con URL/Dominio/Posizione). Ritorna l'id dello snapshot."""
+        if rows is None or rows.empty:
+            return None
+        fetched_at = fetched_at or time.time()
+        day = time.strftime("%Y-%m-%d", time.localtime(fetched_at))
+        with self._lock:
+            cur = self._conn.cursor()
+            cur.execute(
+                "INSERT INTO snapshots (keyword, location_code, device, fetched_at, day) VALUES (?, ?, ?, ?, ?)",
+                (keyword, int(location_code), device, fetched_at, day)
+            )
+            snapshot_id = cur.lastrowid
+            urls = rows["URL"].astype(str).tolist()
+            cur.executemany("INSERT OR IGNORE INTO urls (url, domain) VALUES (?, ?)",
+                            zip(urls, rows["Dominio"].astype(str).tolist()))
+            url_ids = {}
+            unique_urls = list(set(urls))
+            for i in range(0, len(unique_urls), 500):  # limite variabili SQLite
+                chunk = unique_urls[i:i + 500]
+                placeholders = ",".join("?" * len(chunk))
+                url_ids.update(cur.execute(f"SELECT url, id FROM urls WHERE url IN ({placeholders})", chunk).fetchall())
+            cur.executemany("INSERT OR IGNORE INTO serp_rows (snapshot_id, position, url_id) VALUES (?, ?, ?)",
+                            zip([snapshot_id] * len(urls), rows["Posizione"].astype(int).tolist(), map(url_ids.get, urls)))
+            self._conn.commit()
+        return snapshot_id
+
+    def tracked(self) -> pd.DataFrame:
+        """Combinazioni keyword/paese/device presenti nello storico, con numero di snapshot."""
+        with self._lock:
+            # Solo colonne di idx_snapshots_lookup: la GROUP BY è una scansione dell'indice
+            rows = self._conn.execute("""
+                SELECT keyword, location_code, device, COUNT(*), MIN(fetched_at), MAX(fetched_at)
+                FROM snapshots GROUP BY keyword, location_code, device ORDER BY keyword
+            """).fetchall()
+        df = pd.DataFrame(rows, columns=["Keyword", "location_code", "Device", "Snapshot", "Dal", "Al"])
+        for col in ("Dal", "Al"):
+            df[col] = pd.to_datetime(df[col], unit="s").dt.strftime("%Y-%m-%d")
+        return df
+
+    def history(self, keyword: str, location_code: int, device: str, since_day: str = None) -> pd.DataFrame:
+        """Tutte le righe degli snapshot di una keyword/paese/device (opzionalmente da `since_day`)."""
+        query = """
+            SELECT s.id, s.fetched_at, s.day, r.position, u.url, u.domain
+            FROM snapshots s
+            JOIN serp_rows r ON r.snapshot_id = s.id
+            JOIN urls u ON u.id = r.url_id
+            WHERE s.keyword = ? AND s.location_code = ? AND s.device = ?
+        """
+        params = [keyword, int(location_code), device]
+        if since_day:
+            # `day` è in ora locale (save_snapshot): mezzanotte locale di since_day, non UTC come strftime('%s')
+            query += " AND s.fetched_at >= ?"
+            params.append(time.mktime(time.strptime(since_day, "%Y-%m-%d")))
+        query += " ORDER BY s.fetched_at, r.position"
+        with self._lock:
+            rows = self._conn.execute(query, params).fetchall()
+        df = pd.DataFrame(rows, columns=["snapshot_id", "fetched_at", "Giorno", "Posizione", "URL", "Dominio"])
+        df["Data"] = pd.to_datetime(df["fetched_at"], unit="s")
+        return df
+
+@st.cache_resource
+def get_history_store() -> SerpHistoryStore:
+    return SerpHistoryStore(SERP_DATA_DIR / "serp_history.sqlite")
+
+def compute_position_deltas(history_df: pd.DataFrame):
+    """
+    Confronta gli ultimi due snapshot.
+    Ritorna (tabella delta per URL, URL nuovi, URL persi); delta > 0 = posizioni guadagnate.
+    """
+    snapshot_ids = history_df["snapshot_id"].drop_duplicates().tolist()
+    if len(snapshot_ids) < 2:
+        return pd.DataFrame(), [], []
+    prev = history_df[history_df["snapshot_id"] == snapshot_ids[-2]].set_index("URL")["Posizione"]
+    last = history_df[history_df["snapshot_id"] == snapshot_ids[-1]].set_index("URL")["Posizione"]
+    deltas = pd.DataFrame({"Posizione precedente": prev, "Posizione attuale": last})
+    deltas["Delta"] = deltas["Posizione precedente"] - deltas["Posizione attuale"]
+    deltas = deltas.dropna().astype(int).sort_values("Posizione attuale").reset_index().rename(columns={"index": "URL"})
+    new_urls = [u for u in last.index if u not in prev.index]
+    lost_urls = [u for u in prev.index if u not in last.index]
+    return deltas, new_urls, lost_urls
+
+def compute_domain_share(history_df: pd.DataFrame, top_n: int = 10) -> pd.DataFrame:
+    """Quota di risultati per dominio in ogni snapshot (top_n domini per presenze totali)."""
+    counts = history_df.groupby(["Data", "Dominio"]).size().unstack(fill_value=0)
+    share = counts.div(counts.sum(axis=1), axis=0) * 100
+    top_domains = counts.sum().sort_values(ascending=False).head(top_n).index
+    return share[top_domains].round(1)
+
+
+# ----------------------------
+# VISIBILITÀ DOMINI (multi-SERP)
+# ----------------------------
+# CTR organico indicativo per le posizioni 1-10; oltre la prima pagina resta un traffico residuo
+CTR_TOP10 = np.array([0.28, 0.15, 0.11, 0.08, 0.06, 0.05, 0.04, 0.03, 0.025, 0.02])
+CTR_PAGE2 = 0.01
+CTR_TAIL = 0.002
+
+def ctr_weights(positions) -> np.ndarray:
+    """Peso CTR per posizione organica (vettoriale)."""
+    pos = np.asarray(positions, dtype=np.int64)
+    weights = np.where(pos <= 20, CTR_PAGE2, CTR_TAIL)
+    top = (pos >= 1) & (pos <= 10)
+    weights[top] = CTR_TOP10[pos[top] - 1]
+    weights[pos < 1] = 0.0
+    return weights
+
+class DomainVisibilityMatrix:
+    """
+    Matrice sparsa dominio × SERP in formato COO: array numpy di codici interi (riga = dominio,
+    colonna = SERP) con peso CTR e posizione. Tutte le aggregazioni sono bincount/prodotti
+    matriciali sui codici, niente groupby per dominio: 10k keyword × 100 posizioni in pochi secondi.
+    Una SERP è una keyword (batch), una combinazione mercato·device (matrice) o l'unica SERP analizzata.
+    """
+
+    def __init__(self, df: pd.DataFrame, serp_cols: list = None):
+        if serp_cols is None:
+            serp_cols = [c for c in ("Keyword", "Mercato", "Device") if c in df.columns]
+        if serp_cols:
+            self.cols = df.groupby(serp_cols, sort=False).ngroup().to_numpy(dtype=np.int64)
+        else:
+            self.cols = np.zeros(len(df), dtype=np.int64)
+        self.n_serps = int(self.cols.max()) + 1 if len(df) else 0
+        self.rows, domains = pd.factorize(df["Dominio"], sort=False)
+        self.domains = np.asarray(domains, dtype=object)
+        self.rows = self.rows.astype(np.int64)
+        positions = df["Posizione"].to_numpy(dtype=np.int64)
+        self.weights = ctr_weights(positions)
+
+        # Presenza (dominio, SERP) unica con la miglior posizione: più URL dello stesso dominio contano una volta
+        pair = self.rows * max(self.n_serps, 1) + self.cols
+        order = np.lexsort((positions, pair))
+        pair_sorted = pair[order]
+        first = np.ones(len(pair_sorted), dtype=bool)
+        first[1:] = pair_sorted[1:] != pair_sorted[:-1]
+        self.pair_domain = self.rows[order][first]
+        self.pair_serp = self.cols[order][first]
+        self.pair_best = positions[order][first]
+
+    def ranking(self, top_n: int = 20) -> pd.DataFrame:
+        """Top-N domini per indice di visibilità (somma dei CTR stimati su tutte le SERP)."""
+        n_domains = len(self.domains)
+        if not n_domains:
+            return pd.DataFrame(columns=["Dominio", "Indice visibilità", "Share of voice (%)", "SERP presenti",
+                                         "SERP in top 10", "Posizione media (migliore)"])
+        ctr_sum = np.bincount(self.rows, weights=self.weights, minlength=n_domains)
+        presence = np.bincount(self.pair_domain, minlength=n_domains)
+        top10 = np.bincount(self.pair_domain[self.pair_best <= 10], minlength=n_domains)
+        best_sum = np.bincount(self.pair_domain, weights=self.pair_best, minlength=n_domains)
+        top = np.argsort(-ctr_sum, kind="stable")[:top_n]
+        total = ctr_sum.sum()
+        return pd.DataFrame({
+            "Dominio": self.domains[top],
+            # click stimati ogni 100 ricerche (una per SERP), media su tutte le SERP analizzate
+            "Indice visibilità": np.round(100 * ctr_sum[top] / self.n_serps, 2),
+            "Share of voice (%)": np.round(100 * ctr_sum[top] / total, 1) if total else 0.0,
+            "SERP presenti": presence[top],
+            "SERP in top 10": top10[top],
+            "Posizione media (migliore)": np.round(best_sum[top] / np.maximum(presence[top], 1), 1),
         })
-        stats_df.to_excel(writer, sheet_name='Statistiche', index=False)
 
-        domain_counts = df['Dominio'].value_counts().reset_index()
-        domain_counts.columns = ['Dominio', 'Occorrenze']
-        domain_counts.to_excel(writer, sheet_name='Analisi Domini', index=False)
+    def overlap(self, domains: list) -> tuple:
+        """
+        Sovrapposizione tra domini: SERP in cui compaiono entrambi (co-presenze) e Jaccard (%).
+        Prodotto B·Bᵀ sulla matrice di presenza ristretta ai domini richiesti.
+        """
+        index = {d: i for i, d in enumerate(self.domains)}
+        codes = np.array([index[d] for d in domains if d in index], dtype=np.int64)
+        labels = list(self.domains[codes])
+        lookup = np.full(len(self.domains), -1, dtype=np.int64)
+        lookup[codes] = np.arange(len(codes))
+        sel = lookup[self.pair_domain]
+        mask = sel >= 0
+        presence = np.zeros((len(codes), max(self.n_serps, 1)), dtype=np.float32)
+        presence[sel[mask], self.pair_serp[mask]] = 1.0
+        co = presence @ presence.T
+        diag = np.diag(co)
+        union = diag[:, None] + diag[None, :] - co
+        jaccard = np.divide(100 * co, union, out=np.zeros_like(co), where=union > 0)
+        return (pd.DataFrame(co.astype(np.int64), index=labels, columns=labels),
+                pd.DataFrame(np.round(jaccard.astype(np.float64), 1), index=labels, columns=labels))
+
+
+# ----------------------------
+# EXPORT + CHARTS
+# ----------------------------
+def render_url_boxes(df: pd.DataFrame) -> str:
+    """HTML di tutte le card risultato, costruito per colonne (nessun loop Python sulle righe)."""
+    if df.empty:
+        return ""
+    html = (
+        "<div class='url-box'><strong style='color: #FF6B35; font-size: 1.2em;'>#" + df['Posizione'].astype(str)
+        + "</strong><br><strong style='color: #4da6ff; font-size: 1.1em;'>" + df['Title'].astype(str)
+        + "</strong><br><a href='" + df['URL'].astype(str) + "' target='_blank' style='color: #00cc66; text-decoration: none;'>"
+        + df['URL'].astype(str) + "</a><br><p style='color: #cccccc; margin-top: 0.5rem;'>" + df['Snippet'].astype(str)
+        + "</p><small style='color: #999;'>📏 Title: " + df['Lunghezza Title'].astype(str)
+        + " char | Snippet: " + df['Lunghezza Snippet'].astype(str) + " char | 🌐 " + df['Dominio'].astype(str)
+        + "</small></div>"
+    )
+    return html.str.cat(sep="")
+
+def serp_txt_export(df: pd.DataFrame) -> str:
+    """Export TXT (#pos - title / url / snippet) costruito per colonne."""
+    if df.empty:
+        return ""
+    blocks = ("#" + df['Posizione'].astype(str) + " - " + df['Title'].astype(str) + "\n"
+              + df['URL'].astype(str) + "\n" + df['Snippet'].astype(str))
+    return blocks.str.cat(sep="\n\n")
+
+# Righe per chunk negli export: la memoria usata dal writer resta costante al crescere del dataset.
+# NB: non vale per il download: st.download_button legge tutto il file (.read()) e tiene i byte nel
+# media file manager, quindi il picco di memoria resta pari alla dimensione dell'export.
+EXPORT_CHUNK_ROWS = 50_000
+
+def iter_export_chunks(df: pd.DataFrame, chunk_rows: int = EXPORT_CHUNK_ROWS):
+    """Slice consecutive del DataFrame (viste, nessuna copia dell'intero dataset)."""
+    for start in range(0, len(df), chunk_rows):
+        yield df.iloc[start:start + chunk_rows]
+
+def _export_file():
+    """
+    File temporaneo su disco, non bufferizzato (FileIO): st.download_button lo accetta direttamente,
+    ma lo legge per intero in memoria al momento del download (vedi EXPORT_CHUNK_ROWS).
+    """
+    return tempfile.TemporaryFile(buffering=0)
+
+def stream_csv_export(df: pd.DataFrame, chunk_rows: int = EXPORT_CHUNK_ROWS):
+    """
+    CSV scritto a chunk su file temporaneo (header solo sul primo). Ritorna il file riavvolto.
+    Evita la copia intera durante la scrittura, non al download (il file viene comunque letto tutto).
+    """
+    output = _export_file()
+    buffered = io.BufferedWriter(output)
+    text = io.TextIOWrapper(buffered, encoding="utf-8", newline="")
+    if df.empty:
+        df.to_csv(text, index=False)
+    for i, chunk in enumerate(iter_export_chunks(df, chunk_rows)):
+        chunk.to_csv(text, index=False, header=(i == 0))
+    text.flush()
+    text.detach()
+    buffered.detach()
     output.seek(0)
     return output
 
-def create_position_chart(df):
-    fig = go.Figure()
-    fig.add_trace(go.Scatter(
-        x=df['Posizione'],
-        y=df['Lunghezza Title'],
-        mode='markers',
-        marker=dict(size=10, color=df['Posizione'], showscale=True, colorbar=dict(title="Posizione")),
-        text=df['Dominio'],
-        hovertemplate='<b>Posizione:</b> %{x}<br><b>Lunghezza Title:</b> %{y}<br><b>Dominio:</b> %{text}<extra></extra>'
-    ))
-    fig.update_layout(
-        title="Lunghezza Title per Posizione SERP (solo Organic)",
-        xaxis_title="Posizione",
-        yaxis_title="Lunghezza Title (caratteri)",
-        template="plotly_dark",
-        plot_bgcolor='#000000',
-        paper_bgcolor='#000000',
-        font=dict(color='#ffffff')
+def stream_parquet_export(df: pd.DataFrame, chunk_rows: int = EXPORT_CHUNK_ROWS):
+    """
+    Parquet scritto a row group (uno per chunk) con pyarrow.ParquetWriter. None se pyarrow manca.
+    Come per il CSV, il download carica comunque in memoria l'intero file.
+    """
+    if not PARQUET_AVAILABLE:
+        return None
+    output = _export_file()
+    # colonne object (es. Mercato/Device) come stringhe: lo schema non dipende dal contenuto del primo chunk
+    as_string = {c: "string" for c in df.columns if df[c].dtype == object}
+    schema = pa.Schema.from_pandas(df.head(0).astype(as_string), preserve_index=False)
+    with pq.ParquetWriter(output, schema, compression="zstd") as writer:
+        for chunk in iter_export_chunks(df, chunk_rows):
+            writer.write_table(pa.Table.from_pandas(chunk.astype(as_string), schema=schema, preserve_index=False))
+    output.seek(0)
+    return output
+
+class ExportStats:
+    """Statistiche del foglio Excel accumulate chunk per chunk (somme/conteggi, nessun dataset intero)."""
+
+    def __init__(self):
+        self.rows = 0
+        self.title_len_sum = 0
+        self.snippet_len_sum = 0
+        self.domain_counts = {}
+
+    def update(self, chunk: pd.DataFrame):
+        self.rows += len(chunk)
+        self.title_len_sum += int(chunk['Lunghezza Title'].sum())
+        self.snippet_len_sum += int(chunk['Lunghezza Snippet'].sum())
+        for domain, count in chunk['Dominio'].value_counts().items():
+            self.domain_counts[domain] = self.domain_counts.get(domain, 0) + int(count)
+
+    def stats_rows(self, query: str) -> list:
+        return [
+            ('Totale Risultati', self.rows),
+            ('Lunghezza Media Title', f"{self.title_len_sum / self.rows:.1f} caratteri" if self.rows else "0"),
+            ('Lunghezza Media Snippet', f"{self.snippet_len_sum / self.rows:.1f} caratteri" if self.rows else "0"),
+            ('Domini Unici', len(self.domain_counts)),
+            ('Query Analizzata', query),
+        ]
+
+    def domain_rows(self) -> list:
+        return sorted(self.domain_counts.items(), key=lambda kv: (-kv[1], kv[0]))
+
+def create_excel_export(df, query, chunk_rows: int = EXPORT_CHUNK_ROWS):
+    """
+    Excel con openpyxl in modalità write-only: le righe vengono scritte in streaming sul foglio
+    (memoria costante durante la scrittura, non al download), mentre Statistiche e Analisi Domini
+    sono calcolati incrementalmente per chunk.
+    """
+    wb = Workbook(write_only=True)
+    ws_data = wb.create_sheet('Risultati Completi')
+    ws_stats = wb.create_sheet('Statistiche')
+    ws_domains = wb.create_sheet('Analisi Domini')
+
+    ws_data.append(list(df.columns))
+    stats = ExportStats()
+    for chunk in iter_export_chunks(df, chunk_rows):
+        stats.update(chunk)
+        values = chunk.astype(object).where(chunk.notna(), None)
+        for row in values.itertuples(index=False, name=None):
+            ws_data.append(row)
+
+    ws_stats.append(['Metrica', 'Valore'])
+    for row in stats.stats_rows(query):
+        ws_stats.append(row)
+    ws_domains.append(['Dominio', 'Occorrenze'])
+    for row in stats.domain_rows():
+        ws_domains.append(row)
+
+    output = _export_file()
+    wb.save(output)
+    output.seek(0)
+    return output
+
+def serp_feature_share(features_df: pd.DataFrame) -> pd.DataFrame:
+    """
+    Quota di SERP che contengono ogni tipo di item. Una SERP = keyword (batch), mercato·device
+    (matrice) o l'unica SERP analizzata; Rank/Y medi dicono quanto in alto compare la feature.
+    """
+    serp_cols = [c for c in ("Keyword", "Mercato", "Device") if c in features_df.columns]
+    if features_df.empty:
+        return pd.DataFrame(columns=["Tipo", "SERP con feature", "Quota SERP (%)", "Item", "Rank medio", "Y medio (px)"])
+    serp_id = features_df[serp_cols].astype(str).agg(" · ".join, axis=1) if serp_cols else pd.Series("serp", index=features_df.index)
+    total_serps = serp_id.nunique()
+    share = (
+        features_df.assign(_serp=serp_id)
+        .groupby("Tipo")
+        .agg(**{"SERP con feature": ("_serp", "nunique"), "Item": ("Tipo", "size"),
+                "Rank medio": ("Rank", "mean"), "Y medio (px)": ("Y", "mean")})
+        .reset_index()
     )
+    share.insert(2, "Quota SERP (%)", (100 * share["SERP con feature"] / total_serps).round(1))
+    share["Rank medio"] = share["Rank medio"].astype(float).round(1)
+    share["Y medio (px)"] = share["Y medio (px)"].round(0)
+    share["Tipo"] = share["Tipo"].map(lambda t: SERP_FEATURE_LABELS.get(t, t))
+    return share.sort_values(["SERP con feature", "Item"], ascending=False).reset_index(drop=True)
+
+# Oltre questa soglia i grafici ricevono dati pre-aggregati/campionati e tracce WebGL invece di un punto per riga
+CHART_MAX_POINTS = 2000
+CHART_MAX_BINS = 60
+
+def _dark_layout(fig: go.Figure, **layout) -> go.Figure:
+    fig.update_layout(template="plotly_dark", plot_bgcolor='#000000', paper_bgcolor='#000000',
+                      font=dict(color='#ffffff'), **layout)
     return fig
 
-def create_domain_chart(df):
-    domain_counts = df['Dominio'].value_counts().head(10)
+def histogram_frame(series: dict, max_bins: int = CHART_MAX_BINS) -> pd.DataFrame:
+    """
+    Istogramma calcolato lato server: bin condivisi tra le serie (dict nome -> valori), una colonna di
+    conteggi per serie. Valori interi con range ridotto -> bin da 1. La figura riceve al massimo
+    `max_bins` barre per serie, qualunque sia il numero di righe.
+    """
+    arrays = {name: pd.to_numeric(pd.Series(values), errors="coerce").dropna().to_numpy(dtype=float)
+              for name, values in series.items()}
+    filled = [v for v in arrays.values() if len(v)]
+    if not filled:
+        return pd.DataFrame(columns=["Da", "A", *arrays])
+    lo = min(float(v.min()) for v in filled)
+    hi = max(float(v.max()) for v in filled)
+    integer = all(np.array_equal(v, np.floor(v)) for v in filled)
+    if integer and hi - lo + 1 <= max_bins:
+        edges = np.arange(lo, hi + 2)
+    else:
+        edges = np.linspace(lo, hi if hi > lo else lo + 1, max_bins + 1)
+    out = pd.DataFrame({"Da": edges[:-1], "A": edges[1:]})
+    for name, values in arrays.items():
+        out[name] = np.histogram(values, bins=edges)[0]
+    return out
+
+@st.cache_data(max_entries=64, show_spinner=False)
+def _histogram_figure(hist: pd.DataFrame, title: str, xaxis_title: str, barmode: str = "overlay") -> go.Figure:
+    """
+    Barre dai conteggi pre-calcolati; memoizzata sull'hash del frame aggregato (piccolo).
+    cache_data e non cache_resource: ogni sessione riceve la sua copia della Figure, modificabile senza effetti sugli altri.
+    """
+    fig = go.Figure()
+    centers = (hist["Da"] + hist["A"]) / 2
+    widths = hist["A"] - hist["Da"]
+    for name in hist.columns[2:]:
+        fig.add_trace(go.Bar(
+            x=centers, y=hist[name], width=widths, name=str(name), opacity=0.7 if barmode == "overlay" else 1.0,
+            customdata=np.column_stack([hist["Da"], hist["A"]]),
+            hovertemplate=f"<b>{name}</b><br>%{{customdata[0]:.4g}} – %{{customdata[1]:.4g}}: %{{y}}<extra></extra>"
+        ))
+    return _dark_layout(fig, title=title, xaxis_title=xaxis_title, yaxis_title="Frequenza", barmode=barmode, bargap=0)
+
+@st.cache_data(max_entries=64, show_spinner=False)
+def _pixel_figure(data: pd.DataFrame, title: str) -> go.Figure:
+    fig = px.scatter(
+        data, x="Rank", y="Y", color="Tipo", size=data["Altezza"].fillna(0).clip(lower=1),
+        hover_data=["Title", "Dominio"], labels={"Y": "Y (px dall'alto)"}, title=title,
+        render_mode="webgl" if len(data) > CHART_MAX_POINTS // 4 else "svg"
+    )
+    fig.update_yaxes(autorange="reversed")
+    return _dark_layout(fig)
+
+def create_pixel_chart(features_df: pd.DataFrame):
+    """Posizione verticale in pixel (calculate_rectangles) di ogni item: più in alto = più visibile."""
+    data = features_df.dropna(subset=["Y"])
+    title = "Posizione in pixel degli item SERP"
+    if len(data) > CHART_MAX_POINTS:
+        title += f" (campione di {CHART_MAX_POINTS} su {len(data)})"
+        data = data.sample(CHART_MAX_POINTS, random_state=0)
+    data = data[["Rank", "Y", "Tipo", "Altezza", "Title", "Dominio"]].assign(
+        Tipo=data["Tipo"].map(lambda t: SERP_FEATURE_LABELS.get(t, t))
+    ).sort_values(["Tipo", "Rank"]).reset_index(drop=True)
+    return _pixel_figure(data, title)
+
+def create_call_latency_chart(calls: pd.DataFrame):
+    network = calls[~calls["cache_hit"]]
+    hist = histogram_frame({name: g["latency_ms"] for name, g in network.groupby("endpoint", sort=True)}, 40)
+    return _histogram_figure(hist, "Distribuzione latenza chiamate DataForSEO", "Latenza (ms)")
+
+def create_call_cost_chart(calls: pd.DataFrame):
+    hist = histogram_frame({name: g["cost"] for name, g in calls.groupby("endpoint", sort=True)}, 20)
+    return _histogram_figure(hist, "Distribuzione costo per chiamata", "Costo per chiamata ($)", barmode="stack")
+
+def create_overlap_heatmap(jaccard: pd.DataFrame):
+    fig = px.imshow(jaccard, text_auto=True, color_continuous_scale="Oranges", zmin=0, zmax=100,
+                    labels={"color": "Jaccard (%)"}, title="Sovrapposizione SERP tra domini (Jaccard %)")
+    return _dark_layout(fig)
+
+def position_points(df: pd.DataFrame) -> pd.DataFrame:
+    """
+    Punti del grafico posizione/lunghezza title. Fino a CHART_MAX_POINTS righe: un punto per risultato
+    (con dominio). Oltre: un punto per coppia (posizione, lunghezza) con il numero di risultati,
+    e se le coppie sono ancora troppe restano le più dense.
+    """
+    if len(df) <= CHART_MAX_POINTS:
+        return df[["Posizione", "Lunghezza Title", "Dominio"]].reset_index(drop=True)
+    points = df.groupby(["Posizione", "Lunghezza Title"], sort=True).size().rename("Risultati").reset_index()
+    if len(points) > CHART_MAX_POINTS:
+        points = points.nlargest(CHART_MAX_POINTS, "Risultati").sort_values(["Posizione", "Lunghezza Title"])
+    return points.reset_index(drop=True)
+
+@st.cache_data(max_entries=64, show_spinner=False)
+def _position_figure(points: pd.DataFrame, total_rows: int) -> go.Figure:
+    fig = go.Figure()
+    if "Risultati" in points.columns:
+        counts = points["Risultati"].to_numpy()
+        fig.add_trace(go.Scattergl(
+            x=points['Posizione'],
+            y=points['Lunghezza Title'],
+            mode='markers',
+            marker=dict(size=4 + 14 * np.sqrt(counts / counts.max()), color=counts, colorscale="Viridis",
+                        showscale=True, colorbar=dict(title="Risultati")),
+            customdata=counts,
+            hovertemplate='<b>Posizione:</b> %{x}<br><b>Lunghezza Title:</b> %{y}<br><b>Risultati:</b> %{customdata}<extra></extra>'
+        ))
+        title = f"Lunghezza Title per Posizione SERP (solo Organic) — {total_rows} risultati aggregati"
+    else:
+        fig.add_trace(go.Scattergl(
+            x=points['Posizione'],
+            y=points['Lunghezza Title'],
+            mode='markers',
+            marker=dict(size=10, color=points['Posizione'], showscale=True, colorbar=dict(title="Posizione")),
+            text=points['Dominio'],
+            hovertemplate='<b>Posizione:</b> %{x}<br><b>Lunghezza Title:</b> %{y}<br><b>Dominio:</b> %{text}<extra></extra>'
+        ))
+        title = "Lunghezza Title per Posizione SERP (solo Organic)"
+    return _dark_layout(fig, title=title, xaxis_title="Posizione", yaxis_title="Lunghezza Title (caratteri)")
+
+def create_position_chart(df):
+    return _position_figure(position_points(df), len(df))
+
+@st.cache_data(max_entries=64, show_spinner=False)
+def _domain_figure(domain_counts: pd.Series) -> go.Figure:
     fig = px.bar(
         x=domain_counts.values,
         y=domain_counts.index,
@@ -339,24 +2320,395 @@ def create_domain_chart(df):
         labels={'x': 'Numero di Risultati', 'y': 'Dominio'},
         title="Top 10 Domini nella SERP (solo Organic)"
     )
-    fig.update_layout(template="plotly_dark", plot_bgcolor='#000000', paper_bgcolor='#000000', font=dict(color='#ffffff'))
-    return fig
+    return _dark_layout(fig)
+
+def create_domain_chart(df):
+    return _domain_figure(df['Dominio'].value_counts().head(10))
 
 def create_length_distribution(df):
-    fig = go.Figure()
-    fig.add_trace(go.Histogram(x=df['Lunghezza Title'], name='Title', opacity=0.7))
-    fig.add_trace(go.Histogram(x=df['Lunghezza Snippet'], name='Snippet', opacity=0.7))
-    fig.update_layout(
-        title="Distribuzione Lunghezze Title e Snippet (solo Organic)",
-        xaxis_title="Lunghezza (caratteri)",
-        yaxis_title="Frequenza",
-        barmode='overlay',
-        template="plotly_dark",
-        plot_bgcolor='#000000',
-        paper_bgcolor='#000000',
-        font=dict(color='#ffffff')
+    hist = histogram_frame({"Title": df['Lunghezza Title'], "Snippet": df['Lunghezza Snippet']})
+    return _histogram_figure(hist, "Distribuzione Lunghezze Title e Snippet (solo Organic)", "Lunghezza (caratteri)")
+
+
+# ----------------------------
+# RISULTATI MEMOIZZATI (uno per fetch)
+# ----------------------------
+class SerpResultView:
+    """
+    Tutto ciò che la sezione RESULTS ricava da un'analisi (statistiche, tabelle, figure, export),
+    calcolato al primo uso e poi riusato. Vive in session_state con chiave (query, fetch_id): i rerun
+    dovuti a widget non correlati non ricostruiscono né aggregati né grafici.
+    Gli export vengono generati solo al click (download_button con callable, eseguito da Streamlit in
+    un altro thread) e restano sul file temporaneo per i download successivi.
+    """
+
+    def __init__(self, key: tuple, df: pd.DataFrame, features: pd.DataFrame = None, metrics: SerpCallMetrics = None,
+                 paese: str = None):
+        self.key = key
+        self.query = key[0] or ""
+        self.paese = paese
+        self.slug = self.query.replace(' ', '_')
+        self.df = df
+        self.features = features
+        self.metrics = metrics
+        self._values = {}
+        self._locks = {}
+        self._lock = threading.Lock()
+
+    def _cached(self, name, build):
+        with self._lock:
+            if name in self._values:
+                return self._values[name]
+            lock = self._locks.setdefault(name, threading.Lock())
+        # Lock per voce: un export lento (thread del download) non blocca il resto della pagina
+        with lock:
+            if name not in self._values:
+                value = build()
+                with self._lock:
+                    self._values[name] = value
+            return self._values[name]
+
+    # --- aggregati ---
+    def stats(self) -> dict:
+        df = self.df
+        return self._cached("stats", lambda: {
+            "rows": len(df), "domains": df['Dominio'].nunique(),
+            "title_mean": df['Lunghezza Title'].mean(), "snippet_mean": df['Lunghezza Snippet'].mean(),
+            "title_max": df['Lunghezza Title'].max(), "title_min": df['Lunghezza Title'].min(),
+        })
+
+    def domain_counts(self) -> pd.Series:
+        return self._cached("domain_counts", lambda: self.df['Dominio'].value_counts())
+
+    def urls_text(self) -> str:
+        return self._cached("urls_text", lambda: "\n".join(self.df['URL'].tolist()))
+
+    def keyword_summary(self) -> pd.DataFrame:
+        return self._cached("keyword_summary", lambda: self.df.groupby('Keyword', sort=False).agg(
+            Organic=('URL', 'size'), Domini=('Dominio', 'nunique')).reset_index())
+
+    def position_matrix(self) -> pd.DataFrame:
+        return self._cached("position_matrix", lambda: build_position_matrix(self.df))
+
+    def url_boxes(self, limit: int = None) -> str:
+        return self._cached(f"url_boxes:{limit}", lambda: render_url_boxes(self.df if limit is None else self.df.head(limit)))
+
+    def visibility(self) -> DomainVisibilityMatrix:
+        return self._cached("visibility", lambda: DomainVisibilityMatrix(self.df))
+
+    def visibility_ranking(self, top_n: int) -> pd.DataFrame:
+        return self._cached(f"visibility:{top_n}", lambda: self.visibility().ranking(top_n))
+
+    def overlap(self, domains: list) -> tuple:
+        return self._cached(f"overlap:{'|'.join(domains)}", lambda: self.visibility().overlap(domains))
+
+    def feature_share(self) -> pd.DataFrame:
+        return self._cached("feature_share", lambda: serp_feature_share(self.features))
+
+    def non_organic_features(self) -> pd.DataFrame:
+        return self._cached("non_organic", lambda: self.features[self.features["Tipo"] != "organic"])
+
+    def metrics_summary(self) -> pd.DataFrame:
+        return self._cached("metrics_summary", lambda: self.metrics.summary())
+
+    def metrics_calls(self) -> pd.DataFrame:
+        return self._cached("metrics_calls", lambda: self.metrics.frame())
+
+    # --- figure ---
+    def chart(self, name: str):
+        builders = {
+            "position": lambda: create_position_chart(self.df),
+            "domain": lambda: create_domain_chart(self.df),
+            "length": lambda: create_length_distribution(self.df),
+            "pixel": lambda: create_pixel_chart(self.features),
+            "latency": lambda: create_call_latency_chart(self.metrics_calls()),
+            "cost": lambda: create_call_cost_chart(self.metrics_calls()),
+        }
+        return self._cached(f"chart:{name}", builders[name])
+
+    # --- export (lazy: passati come callable a st.download_button) ---
+    def export(self, kind: str):
+        builders = {
+            "csv": lambda: stream_csv_export(self.df),
+            "excel": lambda: create_excel_export(self.df, self.query),
+            "txt": lambda: serp_txt_export(self.df),
+            "parquet": lambda: stream_parquet_export(self.df),
+            "urls_txt": self.urls_text,
+            "urls_csv": lambda: "URL\n" + self.urls_text(),
+            "matrix_csv": lambda: self.position_matrix().to_csv(index=False).encode('utf-8'),
+            "metrics_json": lambda: self.metrics.to_json({"query": self.query, "paese": self.paese}),
+        }
+        return self._cached(f"export:{kind}", builders[kind])
+
+    def download(self, kind: str):
+        """Callable per download_button: il file si genera al primo click e poi si riusa."""
+        return lambda: self.export(kind)
+
+def get_result_view() -> SerpResultView:
+    """Vista memoizzata dei risultati in sessione; nuova solo se è cambiato il fetch (o la query)."""
+    key = (st.session_state.get('query'), st.session_state.get('fetch_id'))
+    view = st.session_state.get('result_view')
+    if view is None or view.key != key:
+        view = SerpResultView(key, st.session_state['results'], st.session_state.get('serp_features'),
+                              st.session_state.get('run_metrics'), st.session_state.get('paese'))
+        st.session_state['result_view'] = view
+    return view
+
+
+# ----------------------------
+# ESECUZIONE ANALISI (inline o job in background)
+# ----------------------------
+def run_serp_analysis(params: dict, report=None, on_rows=None) -> dict:
+    """
+    Esegue un'analisi (params["mode"] = single | batch | matrix) e ritorna un dict con results,
+    features, errors, notes, query, paese, strategy_comparison, metrics (SerpCallMetrics). Con `report` non usa st.*
+    (gira nei thread di SerpJobRunner); senza, mostra progress e stato nella pagina.
+    params contiene i valori dei widget e gli oggetti condivisi (client, cache, policy, store).
+    """
+    mode = params["mode"]
+    feature_records = []
+    notes, errors = [], []
+    comparison = None
+    metrics = SerpCallMetrics()
+    common = dict(
+        login=params["login"], password=params["password"], target_results=int(params["num_results"]),
+        concurrency=int(params["concurrency"]), client=params["client"],
+        calculate_rectangles=params["rectangles"], report=report, metrics=metrics
     )
-    return fig
+    strategy = "paged" if params["fetch_strategy"].startswith("Paginazione") else "depth"
+    job_store = params["job_store"]
+    job_owner = credential_owner(params["login"], params["password"])
+    checkpoint = None
+
+    def _open_checkpoint(kind, label, identity, unit_name):
+        nonlocal checkpoint
+        checkpoint, resumed_units = open_checkpoint(job_store, job_owner, kind, label, identity)
+        if resumed_units:
+            notes.append(("info", f"♻️ Ripresa del job {checkpoint.job_id}: {resumed_units} {unit_name} già completate non sono state rifatturate."))
+
+    if mode == "matrix":
+        query = params["query"]
+        if params["resumable"]:
+            _open_checkpoint("matrix", query, {
+                "keyword": query, "markets": params["markets"], "devices": params["devices"],
+                "target_results": int(params["num_results"]), "strategy": params["fetch_strategy"],
+                "rectangles": params["rectangles"]
+            }, "pagine")
+        results, errors = fetch_serp_matrix(
+            keyword=query, markets=params["markets"], devices=params["devices"], strategy=strategy,
+            max_in_flight=int(params["max_in_flight"]),
+            cache=params["cache"] if params["use_cache"] else None,
+            fallback_policy=params["fallback_policy"] if params["adaptive_fallback"] else None,
+            features=feature_records, checkpoint=checkpoint, on_rows=on_rows, **common
+        )
+        if params["save_history"]:
+            restored = checkpoint.restored if checkpoint is not None else set()
+            skipped = 0
+            for (market, dev), combo_rows in results.groupby(["Mercato", "Device"], sort=False):
+                if any(unit.startswith(f"{market}|{dev}|") for unit in restored):
+                    skipped += 1
+                    continue
+                params["history_store"].save_snapshot(query, PAESI[market]["location_code"], dev, combo_rows)
+            if skipped:
+                notes.append(("caption", f"🗂️ Storico non aggiornato per {skipped} combinazioni riprese dal checkpoint (dati non freschi)."))
+        features = serp_features_frame(feature_records, ("Mercato", "Device"))
+        label, paese = query, ", ".join(params["markets"])
+
+    elif mode == "batch":
+        info = PAESI[params["paese"]]
+        keywords = params["keywords"]
+        if params["resumable"]:
+            _open_checkpoint("batch", f"batch {len(keywords)} keyword", {
+                "keywords": keywords, "location_code": info["location_code"], "device": params["device"],
+                "target_results": int(params["num_results"]), "rectangles": params["rectangles"]
+            }, "unità (invii e keyword)")
+        batch_stats = {}
+        results, errors = fetch_google_organic_batch_dataforseo(
+            keywords=keywords, location_code=info["location_code"], language_code=info["language_code"],
+            se_domain=info["se_domain"], gl=info["gl"], hl=info["hl"], device=params["device"],
+            features=feature_records, checkpoint=checkpoint, on_rows=on_rows, stats=batch_stats, **common
+        )
+        if params["save_history"]:
+            restored = set(batch_stats.get("restored_keywords", []))
+            for kw, kw_rows in results.groupby("Keyword", sort=False):
+                if kw not in restored:
+                    params["history_store"].save_snapshot(kw, info["location_code"], params["device"], kw_rows)
+            if restored:
+                notes.append(("caption", f"🗂️ Storico non aggiornato per {len(restored)} keyword riprese dal checkpoint (dati non freschi)."))
+        features = serp_features_frame(feature_records, ("Keyword",))
+        label, paese = f"batch_{len(keywords)}_keyword", params["paese"]
+
+    else:
+        info = PAESI[params["paese"]]
+        query = params["query"]
+        fetch_kwargs = dict(
+            keyword=query, location_code=info["location_code"], language_code=info["language_code"],
+            se_domain=info["se_domain"], gl=info["gl"], hl=info["hl"], device=params["device"],
+            debug_raw=params["debug_raw"],
+            cache=params["cache"] if params["use_cache"] else None,
+            fallback_policy=params["fallback_policy"] if params["adaptive_fallback"] else None,
+            on_rows=on_rows, **common
+        )
+        if params["fetch_strategy"] == "Confronta le due strategie":
+            # Il confronto misura latenza e costo reali: niente checkpoint, cache né aggiornamenti
+            # della policy di fallback (i campioni sarebbero doppi e la seconda strategia leggerebbe dalla cache)
+            fetch_kwargs.update(cache=None, fallback_policy=None)
+            runs = {}
+            for strat in ("depth", "paged"):
+                strat_stats = {}
+                if report is None:
+                    st.markdown(f"**Strategia: {strat}**")
+                else:
+                    report(0.0, f"**Strategia: {strat}**")
+                strat_results = fetch_google_organic_dataforseo(**fetch_kwargs, strategy=strat, stats=strat_stats,
+                                                                features=feature_records if strat == "depth" else None)
+                runs[strat] = (strat_results, strat_stats)
+            results = runs["depth"][0]
+            comparison = compare_fetch_strategies(runs)
+        else:
+            if params["resumable"]:
+                _open_checkpoint("single", query, {
+                    "keyword": query, "location_code": info["location_code"], "device": params["device"],
+                    "target_results": int(params["num_results"]), "strategy": params["fetch_strategy"],
+                    "rectangles": params["rectangles"]
+                }, "pagine")
+            run_stats = {}
+            results = fetch_google_organic_dataforseo(**fetch_kwargs, strategy=strategy, stats=run_stats,
+                                                      features=feature_records, checkpoint=checkpoint)
+            if run_stats.get("failed_pages"):
+                errors.append(f"{run_stats['failed_pages']} pagine non completate: rilancia l'analisi per riprenderle")
+            if run_stats.get("fallback_runs"):
+                notes.append(("caption", f"🔁 Fallback REGULAR eseguiti: {run_stats['fallback_runs']} — utili: {run_stats['fallback_gains']}"))
+        if params["save_history"]:
+            if checkpoint is not None and checkpoint.restored:
+                notes.append(("caption", "🗂️ Storico non aggiornato: parte della SERP è stata ripresa dal checkpoint (dati non freschi)."))
+            else:
+                params["history_store"].save_snapshot(query, info["location_code"], params["device"], results)
+        features = serp_features_frame(feature_records)
+        label, paese = query, params["paese"]
+
+    # Job chiuso solo se completo: con errori resta riprendibile
+    if checkpoint is not None and not errors:
+        job_store.finish_job(checkpoint.job_id)
+
+    return {"results": results, "features": features, "errors": errors, "notes": notes,
+            "query": label, "paese": paese, "strategy_comparison": comparison, "metrics": metrics}
+
+def apply_analysis_output(out: dict):
+    """Porta l'esito di run_serp_analysis nella sessione (sezione RESULTS)."""
+    st.session_state['results'] = out["results"]
+    st.session_state['serp_features'] = out["features"]
+    st.session_state['query'] = out["query"]
+    st.session_state['paese'] = out["paese"]
+    st.session_state['run_errors'] = out["errors"]
+    st.session_state['run_notes'] = out["notes"]
+    st.session_state['run_metrics'] = out["metrics"]
+    st.session_state['fetch_id'] = time.time_ns()
+    if out["strategy_comparison"] is not None:
+        st.session_state['strategy_comparison'] = out["strategy_comparison"]
+    else:
+        st.session_state.pop('strategy_comparison', None)
+
+class BackgroundJob:
+    """Stato di un job in background: aggiornato dal thread worker, letto dalla pagina in polling."""
+
+    def __init__(self, job_id: str, owner: str, label: str):
+        self.id = job_id
+        self.owner = owner
+        self.label = label
+        self.status = "queued"
+        self.progress = 0.0
+        self.message = ""
+        self.partial = None
+        self.result = None
+        self.error = None
+        self.collected = False
+        self.future = None
+        self.created_at = time.time()
+        self.finished_at = None
+
+    def __call__(self, fraction: float = None, message: str = None, level: str = "markdown"):
+        """Stessa firma di StreamlitProgress: le funzioni di fetch lo usano come `report`."""
+        if fraction is not None:
+            self.progress = min(max(float(fraction), 0.0), 1.0)
+        if message:
+            self.message = message
+
+    def set_partial(self, df: pd.DataFrame):
+        self.partial = df
+
+class SerpJobRunner:
+    """
+    Coda locale di job SERP eseguiti da un pool di thread del processo (condiviso tra sessioni e tab).
+    Il thread di script Streamlit si limita a sottomettere e a leggere lo stato: un rerun o un cambio
+    di widget non interrompe più l'estrazione. I job conclusi vengono dimenticati dopo `keep_s`.
+    Ogni job appartiene alla sessione che l'ha sottomesso: get/cancel/counts ignorano quelli altrui.
+    """
+
+    def __init__(self, max_workers: int = 4, keep_s: float = 6 * 3600):
+        self.keep_s = keep_s
+        self._pool = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix="serp-job")
+        self._jobs = {}
+        self._lock = threading.Lock()
+        self._seq = 0
+
+    def submit(self, owner: str, label: str, fn, **kwargs) -> str:
+        with self._lock:
+            self._purge()
+            self._seq += 1
+            job = BackgroundJob(f"job-{self._seq}", owner, label)
+            self._jobs[job.id] = job
+        job.future = self._pool.submit(self._run, job, fn, kwargs)
+        return job.id
+
+    @staticmethod
+    def _run(job: BackgroundJob, fn, kwargs):
+        job.status = "running"
+        try:
+            # I risultati parziali finiscono nel job: il pannello li mostra mentre l'analisi procede
+            job.result = fn(report=job, on_rows=job.set_partial, **kwargs)
+            job.progress = 1.0
+            job.status = "done"
+        except Exception as e:
+            job.error = str(e)
+            job.status = "error"
+        finally:
+            job.finished_at = time.time()
+
+    def get(self, owner: str, job_id: str):
+        with self._lock:
+            job = self._jobs.get(job_id)
+        return job if job is not None and job.owner == owner else None
+
+    def cancel(self, owner: str, job_id: str) -> bool:
+        """Annulla un job ancora in coda (quelli già partiti terminano da soli)."""
+        job = self.get(owner, job_id)
+        if job is not None and job.future is not None and job.future.cancel():
+            job.status = "cancelled"
+            job.finished_at = time.time()
+            return True
+        return False
+
+    def counts(self, owner: str) -> dict:
+        with self._lock:
+            states = [j.status for j in self._jobs.values() if j.owner == owner]
+        return {s: states.count(s) for s in ("queued", "running", "done", "error")}
+
+    def _purge(self):
+        now = time.time()
+        for job_id in [j.id for j in self._jobs.values() if j.finished_at and now - j.finished_at > self.keep_s]:
+            del self._jobs[job_id]
+
+@st.cache_resource
+def get_job_runner(max_workers: int = 4) -> SerpJobRunner:
+    return SerpJobRunner(max_workers=max_workers)
+
+def live_preview_columns(df: pd.DataFrame) -> list:
+    """Colonne dell'anteprima live: chiavi della modalità (Keyword, Mercato/Device) + posizione e URL."""
+    return [c for c in ("Keyword", "Mercato", "Device") if c in df.columns] + ['Posizione', 'Title', 'URL', 'Dominio']
+
+JOB_STATUS_LABELS = {"queued": "⏳ In coda", "running": "🔄 In corso", "done": "✅ Completato",
+                     "error": "❌ Errore", "cancelled": "🚫 Annullato"}
 
 
 # ----------------------------
@@ -375,17 +2727,42 @@ st.markdown("""
 </div>
 """, unsafe_allow_html=True)
 
+run_mode = st.radio(
+    "Modalità",
+    ["🔎 Singola query", "📚 Batch keyword (lista/CSV)", "🌍 Matrice paesi × device"],
+    horizontal=True,
+    help="Batch: usa la coda standard DataForSEO (task_post / tasks_ready / task_get), più economica e adatta a migliaia di keyword. "
+         "Matrice: la stessa query su tutti i paesi e device selezionati, in parallelo."
+)
+batch_mode = run_mode.startswith("📚")
+matrix_mode = run_mode.startswith("🌍")
+
 col1, col2 = st.columns([3, 1])
 with col1:
-    query = st.text_input("🔎 Query di ricerca", placeholder="es. gian luca rana")
+    if batch_mode:
+        batch_text = st.text_area("📚 Keyword (una per riga)", height=150, placeholder="keyword 1\nkeyword 2\n...")
+        batch_csv = st.file_uploader("...oppure carica un CSV (colonna 'keyword' o prima colonna)", type=["csv"])
+        query = ""
+    else:
+        query = st.text_input("🔎 Query di ricerca", placeholder="es. gian luca rana")
 with col2:
     num_results = st.selectbox("📊 Risultati (Organic)", [10, 20, 30, 40, 50, 60, 70, 80, 90, 100], index=9)
 
 col3, col4 = st.columns(2)
-with col3:
-    paese_sel = st.selectbox("🌍 Paese", list(PAESI.keys()), index=3)  # default UK se vuoi
-with col4:
-    device = st.selectbox("📱 Device", ["desktop", "mobile"], index=0)
+if matrix_mode:
+    with col3:
+        matrix_markets = st.multiselect("🌍 Paesi", list(PAESI.keys()), default=list(PAESI.keys()))
+    with col4:
+        matrix_devices = st.multiselect("📱 Device", ["desktop", "mobile"], default=["desktop", "mobile"])
+    matrix_max_in_flight = st.slider("🚦 Tetto globale richieste contemporanee", 1, 50, 20,
+                                     help="Limite unico per tutte le combinazioni, che condividono lo stesso pool di connessioni.")
+    paese_sel = matrix_markets[0] if matrix_markets else list(PAESI.keys())[3]
+    device = matrix_devices[0] if matrix_devices else "desktop"
+else:
+    with col3:
+        paese_sel = st.selectbox("🌍 Paese", list(PAESI.keys()), index=3)  # default UK se vuoi
+    with col4:
+        device = st.selectbox("📱 Device", ["desktop", "mobile"], index=0)
 
 st.markdown("### 🔐 Credenziali DataForSEO")
 c5, c6 = st.columns(2)
@@ -394,137 +2771,443 @@ with c5:
 with c6:
     dfs_password = st.text_input("Password (DataForSEO)", value="", type="password", placeholder="password DataForSEO")
 
+st.markdown("### ⚡ Prestazioni")
+cp1, cp2 = st.columns(2)
+with cp1:
+    fetch_strategy = st.selectbox(
+        "Strategia di estrazione",
+        ["Depth unico (1 chiamata)", "Paginazione (10 per pagina)", "Confronta le due strategie"],
+        index=0,
+        help="Depth unico: una sola task con depth=N risultati, la paginazione interviene solo come fallback. "
+             "Confronta: esegue entrambe e mostra parità dei risultati, latenza e costo."
+    )
+with cp2:
+    concurrency = st.slider(
+        "Richieste parallele (pagine SERP)", 1, 10, 5,
+        help="1 = paginazione sequenziale classica. Con valori più alti le pagine start=0,10,20... vengono richieste insieme."
+    )
+
+cc1, cc2, cc3 = st.columns(3)
+with cc1:
+    use_cache = st.checkbox("💾 Usa cache locale risposte", value=True,
+                            help="Le pagine SERP già scaricate (stessa keyword/paese/device/pagina) vengono riusate senza rifatturarle.")
+with cc2:
+    cache_ttl_h = st.number_input("TTL cache (ore)", min_value=1, max_value=24 * 30, value=24,
+                                  help="Età massima delle risposte riusate in questa sessione (non cambia la cache per gli altri).")
+with cc3:
+    st.caption(f"Dimensione max cache: {SERP_CACHE_MAX_BYTES // (1024 * 1024)} MB, condivisa da tutte le sessioni "
+               "(variabile SERP_CACHE_MAX_MB sul server).")
+
+adaptive_fallback = st.checkbox(
+    "🔁 Fallback REGULAR adattivo", value=True,
+    help="Per paese/device ricorda se il fallback sull'endpoint REGULAR ha mai aggiunto organic: "
+         "se sì lo esegue in parallelo ad ADVANCED, se non serve mai lo salta."
+)
+fallback_policy = get_fallback_policy()
+
+save_history = st.checkbox("📈 Salva ogni SERP nello storico rank tracking", value=True)
+resumable_jobs = st.checkbox(
+    "♻️ Job riprendibili (checkpoint dopo ogni pagina/keyword)", value=True,
+    help="Se l'analisi si interrompe (sessione chiusa, timeout, errore), rilanciandola con gli stessi parametri "
+         "riparte dall'ultima unità completata senza rifatturare pagine e keyword già scaricate."
+)
+job_store = get_job_store()
+calculate_rectangles = st.checkbox(
+    "📐 Posizioni in pixel degli item SERP (calculate_rectangles)", value=False,
+    help="DataForSEO aggiunge coordinate e dimensioni di ogni item (organic e SERP feature). Ha un costo extra per task."
+)
+history_store = get_history_store()
+
+dataforseo_client = get_dataforseo_client()
+with st.expander("🔌 Client HTTP DataForSEO (pool condiviso)"):
+    st.caption(
+        "Limiti condivisi da tutte le analisi del server, impostati con le variabili d'ambiente "
+        "DATAFORSEO_POOL_SIZE, DATAFORSEO_PER_HOST_LIMIT, DATAFORSEO_HTTP2, DATAFORSEO_RATE_PER_MINUTE, DATAFORSEO_MAX_RETRIES."
+    )
+    ch1, ch2, ch3, ch4, ch5 = st.columns(5)
+    ch1.metric("Connessioni nel pool", dataforseo_client.pool_size)
+    ch2.metric("Richieste per host", dataforseo_client.per_host_limit)
+    ch3.metric("HTTP/2", "sì" if dataforseo_client.http2 else "no")
+    ch4.metric("Richieste/minuto", DATAFORSEO_CLIENT_LIMITS["rate_per_minute"])
+    ch5.metric("Retry su 429/5xx", dataforseo_client.max_retries)
+
+serp_cache = get_serp_cache()
+
+run_in_background = st.checkbox(
+    "🧵 Esegui in background (coda job)", value=True,
+    help="L'analisi gira in un worker del server: la pagina mostra l'avanzamento e i risultati a fine job, "
+         "e cambiare widget o aprire altri tab non la interrompe."
+)
+job_runner = get_job_runner()
+_run_ctx = get_script_run_ctx()
+job_session_id = _run_ctx.session_id if _run_ctx else ""
+
 st.markdown("### 🛠️ Debug")
-debug_raw = st.checkbox("Mostra risposta RAW API (debug)", value=False)
+debug_raw = st.checkbox("Mostra risposta RAW API (debug)", value=False,
+                        help="Solo per le analisi singole eseguite senza background.")
 
 st.markdown("<br>", unsafe_allow_html=True)
 
 if st.button("🚀 ANALIZZA SERP (SOLO ORGANIC)", use_container_width=True):
-    if not query.strip():
+    batch_keywords = parse_keyword_list(batch_text, batch_csv) if batch_mode else []
+    if batch_mode and not batch_keywords:
+        st.error("⚠️ Inserisci almeno una keyword o carica un CSV!")
+    elif not batch_mode and not query.strip():
         st.error("⚠️ Inserisci una query di ricerca!")
+    elif matrix_mode and (not matrix_markets or not matrix_devices):
+        st.error("⚠️ Seleziona almeno un paese e un device!")
     elif not dfs_login.strip() or not dfs_password.strip():
         st.error("⚠️ Inserisci login e password DataForSEO!")
     else:
-        info = PAESI[paese_sel]
-        with st.spinner("Estrazione SERP (organic) in corso..."):
-            results = fetch_google_organic_dataforseo(
-                keyword=query.strip(),
-                login=dfs_login.strip(),
-                password=dfs_password.strip(),
-                location_code=info["location_code"],
-                language_code=info["language_code"],
-                se_domain=info["se_domain"],
-                gl=info["gl"],
-                hl=info["hl"],
-                device=device,
-                target_results=int(num_results),
-                debug_raw=debug_raw
-            )
-
-        st.session_state['results'] = results
-        st.session_state['query'] = query.strip()
-        st.session_state['paese'] = paese_sel
+        params = dict(
+            mode="matrix" if matrix_mode else "batch" if batch_mode else "single",
+            query=query.strip(), keywords=batch_keywords, paese=paese_sel, device=device,
+            markets=matrix_markets if matrix_mode else [], devices=matrix_devices if matrix_mode else [],
+            max_in_flight=matrix_max_in_flight if matrix_mode else 20,
+            num_results=int(num_results), fetch_strategy=fetch_strategy, concurrency=int(concurrency),
+            login=dfs_login.strip(), password=dfs_password.strip(),
+            use_cache=use_cache, adaptive_fallback=adaptive_fallback, save_history=save_history,
+            resumable=resumable_jobs, rectangles=calculate_rectangles, debug_raw=debug_raw and not run_in_background,
+            client=dataforseo_client, cache=serp_cache.with_max_age(float(cache_ttl_h) * 3600), fallback_policy=fallback_policy,
+            history_store=history_store, job_store=job_store
+        )
+        if run_in_background:
+            label = params["query"] if params["mode"] != "batch" else f"batch {len(batch_keywords)} keyword"
+            job_id = job_runner.submit(job_session_id, f"{run_mode.split(' ', 1)[1]}: {label}",
+                                       run_serp_analysis, params=params)
+            st.session_state.setdefault('serp_job_ids', []).append(job_id)
+        else:
+            # Rendering incrementale: tabella e grafico domini si aggiornano ad ogni pagina/combinazione/keyword ricevuta
+            live_header = st.empty()
+            live_cols = st.columns([3, 2])
+            live_table = live_cols[0].empty()
+            live_chart = live_cols[1].empty()
+            live_renders = [0]
+
+            def _render_live(live_df):
+                live_renders[0] += 1
+                live_header.markdown(f"**⚡ Risultati in arrivo: {len(live_df)} organic**")
+                live_table.dataframe(live_df[live_preview_columns(live_df)], use_container_width=True,
+                                     hide_index=True, height=350)
+                live_chart.plotly_chart(create_domain_chart(live_df), use_container_width=True,
+                                        key=f"live_domain_chart_{live_renders[0]}")
+
+            with st.spinner("Estrazione SERP (organic) in corso..."):
+                out = run_serp_analysis(params, on_rows=_render_live)
+
+            # I risultati completi vengono mostrati sotto: via l'anteprima live
+            live_header.empty()
+            live_table.empty()
+            live_chart.empty()
+            apply_analysis_output(out)
+
+
+def _background_jobs_panel():
+    """Stato dei job di questa sessione; a job concluso i risultati passano alla sezione RESULTS."""
+    jobs = [j for j in (job_runner.get(job_session_id, jid) for jid in st.session_state.get('serp_job_ids', []))
+            if j is not None]
+    if not jobs:
+        return
+    st.markdown("### 🧵 Analisi in background")
+    for job in reversed(jobs[-5:]):
+        with st.container(border=True):
+            st.markdown(f"**{job.label}** — {JOB_STATUS_LABELS.get(job.status, job.status)}")
+            if job.status in ("queued", "running"):
+                st.progress(job.progress)
+                if job.message:
+                    st.markdown(job.message)
+                if job.partial is not None and len(job.partial):
+                    st.dataframe(job.partial[live_preview_columns(job.partial)], use_container_width=True,
+                                 hide_index=True, height=250)
+                if job.status == "queued" and st.button("🚫 Annulla", key=f"cancel_{job.id}"):
+                    job_runner.cancel(job_session_id, job.id)
+            elif job.status == "error":
+                st.error(job.error)
+            elif job.finished_at:
+                st.caption(f"Concluso in {job.finished_at - job.created_at:.1f}s")
+
+    finished = [j for j in jobs if j.status == "done" and not j.collected]
+    if finished:
+        for job in finished:
+            job.collected = True
+        apply_analysis_output(finished[-1].result)
+        st.rerun(scope="app")
+
+# Polling solo finché ci sono job attivi di questa sessione
+active_jobs = any(
+    j is not None and (j.status in ("queued", "running") or (j.status == "done" and not j.collected))
+    for j in (job_runner.get(job_session_id, jid) for jid in st.session_state.get('serp_job_ids', []))
+)
+st.fragment(run_every=1.0 if active_jobs else None)(_background_jobs_panel)()
+
+cache_stats = serp_cache.stats()
+with st.expander(f"💾 Cache locale — {cache_stats['hits']} hit / {cache_stats['misses']} miss"):
+    ck1, ck2, ck3, ck4, ck5 = st.columns(5)
+    ck1.metric("Hit", cache_stats["hits"])
+    ck2.metric("Miss", cache_stats["misses"])
+    ck3.metric("Hit rate", f"{cache_stats['hit_rate']:.0%}")
+    ck4.metric("Voci", cache_stats["entries"])
+    ck5.metric("Dimensione", f"{cache_stats['bytes'] / (1024 * 1024):.1f} MB")
+    if st.button("🗑️ Svuota cache"):
+        serp_cache.clear()
+        st.rerun()
+
+# Solo i job con checkpoint dell'account DataForSEO inserito nella sidebar
+job_owner = credential_owner(dfs_login.strip(), dfs_password.strip()) if dfs_login.strip() and dfs_password.strip() else None
+jobs_df = job_store.jobs_frame(job_owner) if job_owner else pd.DataFrame()
+if len(jobs_df):
+    running_jobs = int((jobs_df["Stato"] == "running").sum())
+    with st.expander(f"🗂️ Job SERP con checkpoint — {running_jobs} interrotti/in corso"):
+        st.caption(
+            "Un job interrotto riprende rilanciando la stessa analisi (stessa keyword/lista, paese, device, risultati) "
+            f"entro {job_store.resume_ttl_s / 3600:.0f} ore; dopo diventa \"stale\" e l'analisi riparte da zero."
+        )
+        st.dataframe(jobs_df, use_container_width=True, hide_index=True)
+        cj1, cj2 = st.columns(2)
+        with cj1:
+            if st.button("🧹 Elimina job completati/scaduti"):
+                job_store.delete_jobs(job_owner, "done")
+                job_store.delete_jobs(job_owner, "stale")
+                st.rerun()
+        with cj2:
+            if st.button("🗑️ Elimina tutti i job"):
+                job_store.delete_jobs(job_owner)
+                st.rerun()
+
+fallback_df = fallback_policy.stats_frame()
+if len(fallback_df):
+    with st.expander("🔁 Fallback REGULAR — quanto spesso aggiunge risultati"):
+        loc_names = {v["location_code"]: k for k, v in PAESI.items()}
+        fallback_df.insert(0, "Paese", fallback_df["location_code"].map(loc_names).fillna(fallback_df["location_code"].astype(str)))
+        st.dataframe(fallback_df.drop(columns=["location_code"]), use_container_width=True, hide_index=True)
 
 
 # ----------------------------
 # RESULTS
 # ----------------------------
-if 'results' in st.session_state and st.session_state['results']:
-    df = pd.DataFrame(st.session_state['results'])
+if st.session_state.get('results') is not None and len(st.session_state['results']):
+    df = st.session_state['results']
+    view = get_result_view()
+
+    for level, note in st.session_state.get('run_notes') or []:
+        getattr(st, level)(note)
+    if st.session_state.get('run_errors'):
+        with st.expander(f"⚠️ {len(st.session_state['run_errors'])} errori nell'ultima analisi"):
+            st.write(st.session_state['run_errors'])
+
+    if view.metrics is not None:
+        metrics_summary = view.metrics_summary()
+        if len(metrics_summary):
+            total = metrics_summary.iloc[-1]
+            with st.expander(f"📡 Metriche chiamate DataForSEO — {total['Chiamate']} chiamate, "
+                             f"p95 {total['p95 (ms)']} ms, ${total['Costo ($)']}"):
+                cm1, cm2, cm3, cm4, cm5 = st.columns(5)
+                cm1.metric("Chiamate", int(total["Chiamate"]))
+                cm2.metric("Hit cache", int(total["Hit cache"]))
+                cm3.metric("Retry / timeout", f"{int(total['Retry'])} / {int(total['Timeout'])}")
+                cm4.metric("Dati ricevuti", f"{total['KB ricevuti'] / 1024:.2f} MB")
+                cm5.metric("Costo", f"${total['Costo ($)']:.4f}")
+                st.dataframe(metrics_summary, use_container_width=True, hide_index=True)
+                cmc1, cmc2 = st.columns(2)
+                with cmc1:
+                    if total["Chiamate"] > total["Hit cache"]:
+                        st.plotly_chart(view.chart("latency"), use_container_width=True)
+                with cmc2:
+                    st.plotly_chart(view.chart("cost"), use_container_width=True)
+                st.download_button("📥 Scarica metriche JSON", view.download("metrics_json"),
+                                   f"serp_metrics_{view.slug}.json", "application/json")
+
+    if st.session_state.get('strategy_comparison'):
+        cmp_table, cmp_parity = st.session_state['strategy_comparison']
+        with st.expander("⚖️ Confronto strategie: depth unico vs paginazione", expanded=True):
+            st.dataframe(cmp_table, use_container_width=True, hide_index=True)
+            cols_parity = st.columns(len(cmp_parity))
+            for col_p, (label, value) in zip(cols_parity, cmp_parity.items()):
+                col_p.metric(label, value)
+
+    if 'Mercato' in df.columns:
+        with st.expander("🌍 Confronto posizioni: URL × mercato × device", expanded=True):
+            st.dataframe(view.position_matrix(), use_container_width=True, hide_index=True, height=450)
+            st.download_button("📥 Scarica matrice CSV", view.download("matrix_csv"),
+                               f"serp_matrix_{view.slug}.csv", "text/csv")
 
     st.markdown("<br>", unsafe_allow_html=True)
 
+    stats = view.stats()
     col_s1, col_s2, col_s3, col_s4 = st.columns(4)
     with col_s1:
-        st.markdown(f"<div class='stats-box'><h3 style='margin:0; color:white;'>{len(df)}</h3><p style='margin:0; color:white;'>Organic</p></div>", unsafe_allow_html=True)
+        st.markdown(f"<div class='stats-box'><h3 style='margin:0; color:white;'>{stats['rows']}</h3><p style='margin:0; color:white;'>Organic</p></div>", unsafe_allow_html=True)
     with col_s2:
-        st.markdown(f"<div class='stats-box'><h3 style='margin:0; color:white;'>{df['Dominio'].nunique()}</h3><p style='margin:0; color:white;'>Domini Unici</p></div>", unsafe_allow_html=True)
+        st.markdown(f"<div class='stats-box'><h3 style='margin:0; color:white;'>{stats['domains']}</h3><p style='margin:0; color:white;'>Domini Unici</p></div>", unsafe_allow_html=True)
     with col_s3:
-        st.markdown(f"<div class='stats-box'><h3 style='margin:0; color:white;'>{df['Lunghezza Title'].mean():.0f}</h3><p style='margin:0; color:white;'>Media Title</p></div>", unsafe_allow_html=True)
+        st.markdown(f"<div class='stats-box'><h3 style='margin:0; color:white;'>{stats['title_mean']:.0f}</h3><p style='margin:0; color:white;'>Media Title</p></div>", unsafe_allow_html=True)
     with col_s4:
-        st.markdown(f"<div class='stats-box'><h3 style='margin:0; color:white;'>{df['Lunghezza Snippet'].mean():.0f}</h3><p style='margin:0; color:white;'>Media Snippet</p></div>", unsafe_allow_html=True)
+        st.markdown(f"<div class='stats-box'><h3 style='margin:0; color:white;'>{stats['snippet_mean']:.0f}</h3><p style='margin:0; color:white;'>Media Snippet</p></div>", unsafe_allow_html=True)
 
     st.markdown("<br>", unsafe_allow_html=True)
 
-    tab1, tab2, tab3, tab4, tab5 = st.tabs(["📋 Risultati", "📊 Grafici", "🎯 Analisi", "📥 Export", "📝 Raw Data"])
+    tab1, tab2, tab3, tab4, tab5, tab6 = st.tabs(["📋 Risultati", "📊 Grafici", "🎯 Analisi", "📥 Export", "📝 Raw Data",
+                                                  "✨ SERP Features"])
 
     with tab1:
         st.markdown("### 🎯 Risultati SERP — SOLO Organic")
-        all_urls = "\n".join(df['URL'].tolist())
         st.info(f"📊 **{len(df)} URL (organic)** estratti dalla query: *{st.session_state['query']}*")
 
         c1, c2 = st.columns(2)
         with c1:
-            st.text_area("📋 Seleziona e Copia (Ctrl+A → Ctrl+C)", all_urls, height=150)
+            st.text_area("📋 Seleziona e Copia (Ctrl+A → Ctrl+C)", view.urls_text(), height=150)
         with c2:
             st.markdown("### 💾 Scarica")
-            st.download_button("📥 Scarica TXT", all_urls, f"urls_{st.session_state['query'].replace(' ', '_')}.txt", "text/plain", use_container_width=True)
-            urls_csv = "URL\n" + "\n".join(df['URL'].tolist())
-            st.download_button("📊 Scarica CSV", urls_csv, f"urls_{st.session_state['query'].replace(' ', '_')}.csv", "text/csv", use_container_width=True)
+            st.download_button("📥 Scarica TXT", view.download("urls_txt"), f"urls_{view.slug}.txt", "text/plain", use_container_width=True)
+            st.download_button("📊 Scarica CSV", view.download("urls_csv"), f"urls_{view.slug}.csv", "text/csv", use_container_width=True)
+
+        if 'Keyword' in df.columns:
+            st.markdown("### 📚 Risultati per Keyword")
+            st.dataframe(view.keyword_summary(), use_container_width=True, hide_index=True)
 
         st.markdown("---")
         st.markdown("### 📋 Dettaglio Risultati")
-        for _, row in df.iterrows():
-            st.markdown(f"""
-            <div class='url-box'>
-                <strong style='color: #FF6B35; font-size: 1.2em;'>#{row['Posizione']}</strong><br>
-                <strong style='color: #4da6ff; font-size: 1.1em;'>{row['Title']}</strong><br>
-                <a href='{row['URL']}' target='_blank' style='color: #00cc66; text-decoration: none;'>{row['URL']}</a><br>
-                <p style='color: #cccccc; margin-top: 0.5rem;'>{row['Snippet']}</p>
-                <small style='color: #999;'>📏 Title: {row['Lunghezza Title']} char | Snippet: {row['Lunghezza Snippet']} char | 🌐 {row['Dominio']}</small>
-            </div>
-            """, unsafe_allow_html=True)
+        detail_limit = None
+        if ('Keyword' in df.columns or 'Mercato' in df.columns) and len(df) > 300:
+            st.caption(f"Mostrati i primi 300 risultati su {len(df)}: il dettaglio completo è nell'export e in Raw Data.")
+            detail_limit = 300
+        st.markdown(view.url_boxes(detail_limit), unsafe_allow_html=True)
 
     with tab2:
         st.markdown("### 📊 Visualizzazioni Grafiche")
-        st.plotly_chart(create_position_chart(df), use_container_width=True)
+        st.plotly_chart(view.chart("position"), use_container_width=True)
         cg1, cg2 = st.columns(2)
         with cg1:
-            st.plotly_chart(create_domain_chart(df), use_container_width=True)
+            st.plotly_chart(view.chart("domain"), use_container_width=True)
         with cg2:
-            st.plotly_chart(create_length_distribution(df), use_container_width=True)
+            st.plotly_chart(view.chart("length"), use_container_width=True)
 
     with tab3:
         st.markdown("### 🎯 Analisi Dettagliata")
         ca1, ca2 = st.columns(2)
         with ca1:
             st.markdown("<div class='metric-card'><h3 style='color:#FF6B35;'>📏 Lunghezze Medie</h3></div>", unsafe_allow_html=True)
-            st.metric("Title medio", f"{df['Lunghezza Title'].mean():.1f} caratteri")
-            st.metric("Snippet medio", f"{df['Lunghezza Snippet'].mean():.1f} caratteri")
-            st.metric("Title più lungo", f"{df['Lunghezza Title'].max()} caratteri")
-            st.metric("Title più corto", f"{df['Lunghezza Title'].min()} caratteri")
+            st.metric("Title medio", f"{stats['title_mean']:.1f} caratteri")
+            st.metric("Snippet medio", f"{stats['snippet_mean']:.1f} caratteri")
+            st.metric("Title più lungo", f"{stats['title_max']} caratteri")
+            st.metric("Title più corto", f"{stats['title_min']} caratteri")
         with ca2:
             st.markdown("<div class='metric-card'><h3 style='color:#FF6B35;'>🌐 Analisi Domini</h3></div>", unsafe_allow_html=True)
-            st.metric("Domini unici", df['Dominio'].nunique())
-            st.metric("Dominio più presente", df['Dominio'].mode()[0] if not df['Dominio'].mode().empty else "N/A")
-            st.metric("Max occorrenze stesso dominio", df['Dominio'].value_counts().max())
+            domain_counts = view.domain_counts()
+            st.metric("Domini unici", stats['domains'])
+            st.metric("Dominio più presente", domain_counts.index[0] if len(domain_counts) else "N/A")
+            st.metric("Max occorrenze stesso dominio", domain_counts.max())
 
         st.markdown("<br>", unsafe_allow_html=True)
         st.markdown("### 🏆 Top 10 Domini")
-        domain_table = df['Dominio'].value_counts().head(10).reset_index()
+        domain_table = domain_counts.head(10).reset_index()
         domain_table.columns = ['Dominio', 'Occorrenze']
         st.dataframe(domain_table, use_container_width=True)
 
+        st.markdown("### 📈 Indice di visibilità (CTR-weighted)")
+        visibility = view.visibility()
+        top_n_domains = st.slider("Top domini", min_value=5, max_value=50, value=20, step=5)
+        visibility_table = view.visibility_ranking(top_n_domains)
+        st.caption(f"Calcolato su {visibility.n_serps} SERP: indice = click stimati ogni 100 ricerche "
+                   f"(curva CTR per posizione), share of voice = quota dei click stimati totali.")
+        st.dataframe(visibility_table, use_container_width=True, hide_index=True)
+        if visibility.n_serps > 1 and len(visibility_table) > 1:
+            co_presence, jaccard = view.overlap(visibility_table["Dominio"].head(15).tolist())
+            st.plotly_chart(create_overlap_heatmap(jaccard), use_container_width=True)
+            with st.expander("🔢 Co-presenze (SERP in cui compaiono entrambi i domini)"):
+                st.dataframe(co_presence, use_container_width=True)
+
     with tab4:
         st.markdown("### 📥 Esporta i Risultati")
-        cd1, cd2, cd3 = st.columns(3)
+        st.caption("I file vengono generati al click e riusati per i download successivi di questa analisi.")
+        cd1, cd2, cd3, cd4 = st.columns(4)
         with cd1:
-            csv = df.to_csv(index=False).encode('utf-8')
-            st.download_button("📥 Scarica CSV", csv, f"serp_organic_{st.session_state['query'].replace(' ', '_')}.csv", "text/csv", use_container_width=True)
+            st.download_button("📥 Scarica CSV", view.download("csv"), f"serp_organic_{view.slug}.csv", "text/csv", use_container_width=True)
         with cd2:
-            excel_file = create_excel_export(df, st.session_state['query'])
-            st.download_button("📊 Scarica Excel", excel_file, f"serp_organic_{st.session_state['query'].replace(' ', '_')}.xlsx",
+            st.download_button("📊 Scarica Excel", view.download("excel"), f"serp_organic_{view.slug}.xlsx",
                                "application/vnd.openxmlformats-officedocument.spreadsheetml.sheet", use_container_width=True)
         with cd3:
-            txt = "\n\n".join([f"#{row['Posizione']} - {row['Title']}\n{row['URL']}\n{row['Snippet']}" for _, row in df.iterrows()])
-            st.download_button("📝 Scarica TXT", txt, f"serp_organic_{st.session_state['query'].replace(' ', '_')}.txt", "text/plain", use_container_width=True)
+            st.download_button("📝 Scarica TXT", view.download("txt"), f"serp_organic_{view.slug}.txt", "text/plain", use_container_width=True)
+        with cd4:
+            if PARQUET_AVAILABLE:
+                st.download_button("🧱 Scarica Parquet", view.download("parquet"), f"serp_organic_{view.slug}.parquet",
+                                   "application/vnd.apache.parquet", use_container_width=True)
+            else:
+                st.caption("Parquet non disponibile (installa pyarrow)")
 
     with tab5:
         st.markdown("### 📊 Tabella Dati Completa (SOLO Organic)")
         st.dataframe(df, use_container_width=True, height=500)
 
+    with tab6:
+        st.markdown("### ✨ SERP Features (dalla stessa risposta, nessuna chiamata extra)")
+        features_df = view.features
+        if features_df is None or features_df.empty:
+            st.info("Nessun item SERP registrato per questa analisi.")
+        else:
+            st.dataframe(view.feature_share(), use_container_width=True, hide_index=True)
+            if features_df["Y"].notna().any():
+                st.plotly_chart(view.chart("pixel"), use_container_width=True)
+            else:
+                st.caption("Attiva 📐 calculate_rectangles per l'analisi delle posizioni in pixel.")
+            non_organic = view.non_organic_features()
+            st.markdown(f"#### Dettaglio feature ({len(non_organic)} item)")
+            st.dataframe(non_organic, use_container_width=True, hide_index=True, height=400)
+
 else:
     st.info("👉 Esegui una ricerca per vedere i risultati.")
 
+
+# ----------------------------
+# STORICO
+# ----------------------------
+tracked_df = history_store.tracked()
+if len(tracked_df):
+    st.markdown("---")
+    st.markdown("### 📈 Storico Rank Tracking")
+    loc_names = {v["location_code"]: k for k, v in PAESI.items()}
+    tracked_labels = [
+        f"{row.Keyword} · {loc_names.get(row.location_code, row.location_code)} · {row.Device} ({row.Snapshot} snapshot)"
+        for row in tracked_df.itertuples()
+    ]
+    hist_sel = st.selectbox("Keyword tracciata", range(len(tracked_labels)), format_func=lambda i: tracked_labels[i])
+    tracked_row = tracked_df.iloc[hist_sel]
+    hist_df = history_store.history(tracked_row["Keyword"], tracked_row["location_code"], tracked_row["Device"])
+
+    deltas, new_urls, lost_urls = compute_position_deltas(hist_df)
+    ch1, ch2, ch3, ch4 = st.columns(4)
+    ch1.metric("Snapshot", hist_df["snapshot_id"].nunique())
+    ch2.metric("Periodo", f"{tracked_row['Dal']} → {tracked_row['Al']}")
+    ch3.metric("URL nuovi (ultimo vs precedente)", len(new_urls))
+    ch4.metric("URL persi (ultimo vs precedente)", len(lost_urls))
+
+    th1, th2, th3 = st.tabs(["↕️ Delta posizioni", "📉 Andamento", "🌐 Quota domini"])
+    with th1:
+        if deltas.empty:
+            st.info("Serve almeno un secondo snapshot per calcolare i delta.")
+        else:
+            st.dataframe(deltas, use_container_width=True, hide_index=True, height=350)
+            cn1, cn2 = st.columns(2)
+            with cn1:
+                st.markdown("**🆕 URL nuovi**")
+                st.write(new_urls or "—")
+            with cn2:
+                st.markdown("**❌ URL persi**")
+                st.write(lost_urls or "—")
+    with th2:
+        last_snapshot = hist_df[hist_df["snapshot_id"] == hist_df["snapshot_id"].max()]
+        top_urls = last_snapshot.nsmallest(10, "Posizione")["URL"]
+        trend = hist_df[hist_df["URL"].isin(top_urls)]
+        fig_trend = px.line(trend, x="Data", y="Posizione", color="URL", markers=True,
+                            title="Posizioni nel tempo (top 10 URL dell'ultimo snapshot)")
+        fig_trend.update_yaxes(autorange="reversed")
+        fig_trend.update_layout(template="plotly_dark", plot_bgcolor='#000000', paper_bgcolor='#000000', font=dict(color='#ffffff'))
+        st.plotly_chart(fig_trend, use_container_width=True)
+    with th3:
+        share = compute_domain_share(hist_df)
+        fig_share = px.area(share, title="Quota risultati per dominio nel tempo (%)")
+        fig_share.update_layout(template="plotly_dark", plot_bgcolor='#000000', paper_bgcolor='#000000', font=dict(color='#ffffff'))
+        st.plotly_chart(fig_share, use_container_width=True)
+
 st.markdown("---")
 st.markdown("<p style='text-align: center; color: #999;'>🔍 SERP Analyzer PRO - DataForSEO (SOLO Organic)</p>", unsafe_allow_html=True)
@@ -2,7 +2,17 @@ import streamlit as st
 import pandas as pd
 import json
 import time
-from anthropic import Anthropic
+import random
+import threading
+import queue
+import sqlite3
+import zlib
+import hashlib
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+from datetime import datetime, timezone
+from pathlib import Path
+from anthropic import Anthropic, RateLimitError, APIStatusError, APIConnectionError
 from io import BytesIO
 
 # ===============================
@@ -260,16 +270,38 @@ with st.sidebar:
 
     batch_size_option = st.selectbox(
         "Batch size",
-        [100, 150, 200],
+        [100, 200, 300, 500],
         index=1,
-        help="⚠️ Riduci a 100 se vedi errori JSON"
+        help="Output compatto (numero keyword → id categoria): anche i batch da 500 restano lontani dal limite di token"
     )
 
+    fase2_mode = st.radio(
+        "Esecuzione FASE 2",
+        ["⚡ Tempo reale (parallelo)", "📬 Message Batches API (offline)"],
+        help="Message Batches: tutti i batch in un job asincrono a costo ridotto (-50%), di solito pronto entro un'ora "
+             "(max 24h). Il job resta salvato e i risultati si caricano anche riaprendo la pagina."
+    )
+
+    parallel_batches = st.slider(
+        "Batch in parallelo (FASE 2)",
+        1, 10, 4,
+        help="Batch inviati contemporaneamente, sempre entro il budget di richieste e token al minuto"
+    )
+
+    with st.expander("⚡ Rate limit Anthropic"):
+        rpm_limit = st.number_input("Richieste/minuto", min_value=1, max_value=10000, value=50)
+        itpm_limit = st.number_input("Input token/minuto", min_value=1000, max_value=10_000_000, value=30000, step=1000)
+        otpm_limit = st.number_input("Output token/minuto", min_value=1000, max_value=2_000_000, value=8000, step=1000)
+        st.caption("Limiti del tuo tier: dopo la prima risposta vengono allineati agli header anthropic-ratelimit-*.")
+
     st.markdown("---")
     st.markdown("**Modello:** Claude Sonnet 4.5")
     st.markdown("**Max keywords:** 5000+")
     st.markdown(f"**Output:** {output_language}")
-    st.markdown("**⚠️ Delay:** 60s tra batch")
+    if fase2_mode == "📬 Message Batches API (offline)":
+        st.markdown("**📬 FASE 2:** job Message Batches (offline)")
+    else:
+        st.markdown(f"**⚡ FASE 2:** fino a {parallel_batches} batch in parallelo")
 
 # ===============================
 # Input Section - Layout Verticale
@@ -610,7 +642,7 @@ Return ONLY a JSON with your {max_clusters} category definitions:
     # Chiama l'API
     try:
         response = client.messages.create(
-            model="claude-sonnet-4-20250514",
+            model=CLAUDE_MODEL,
             max_tokens=4000,
             messages=[{"role": "user", "content": prompt}]
         )
@@ -687,58 +719,355 @@ def add_uncategorized_keywords(all_clusters, original_keywords):
     return all_clusters, uncategorized
 
 # ===============================
-# Funzione clustering (Claude)
+# Helper: rate limit Anthropic (FASE 2 concorrente)
 # ===============================
-def cluster_keywords_claude(keywords_list, api_key, batch_size, custom_cats, mode, max_clusters, output_language, products_list=None, macro_theme=None):
+CLAUDE_MODEL = "claude-sonnet-4-20250514"
+MAX_REQUEUE_ROUNDS = 2  # nuovi tentativi per le keyword rimaste senza assegnazione in un batch
+LIVE_PREVIEW_ROWS = 15
+RATE_LIMIT_DIMENSIONS = ("requests", "input-tokens", "output-tokens")
+
+
+def _header_number(headers, name):
+    value = headers.get(name)
     try:
-        client = Anthropic(api_key=api_key)
-        all_clusters = []
-        total_batches = (len(keywords_list) + batch_size - 1) // batch_size
+        return float(value) if value is not None else None
+    except ValueError:
+        return None
 
-        # =====================================================
-        # FASE 1: Analisi globale e definizione categorie
-        # =====================================================
-        st.info("🔍 **FASE 1**: Analisi globale delle keyword per definire le categorie ottimali...")
 
-        defined_categories = analyze_and_define_categories(
-            client=client,
-            all_keywords=keywords_list,
-            max_clusters=max_clusters,
-            output_language=output_language,
-            custom_cats=custom_cats,
-            mode=mode,
-            products_list=products_list,
-            macro_theme=macro_theme
-        )
+def _header_reset_in(headers, name):
+    """Secondi mancanti al reset indicato da un header RFC 3339 (None se assente)."""
+    value = headers.get(name)
+    if not value:
+        return None
+    try:
+        reset_at = datetime.fromisoformat(value.replace("Z", "+00:00"))
+    except ValueError:
+        return None
+    return max(0.0, (reset_at - datetime.now(timezone.utc)).total_seconds())
 
-        if not defined_categories:
-            return None, "Impossibile definire le categorie. Riprova."
 
-        # Mostra le categorie definite
-        st.success(f"✅ **{len(defined_categories)} categorie definite** per il clustering:")
-        categories_preview = ", ".join([f"**{cat['name']}**" for cat in defined_categories])
-        st.markdown(f"📂 {categories_preview}")
+def estimate_tokens(text):
+    """Stima grezza (≈3 caratteri per token): basta per prenotare il budget, poi si corregge con usage."""
+    return len(text) // 3 + 1
 
-        # =====================================================
-        # FASE 2: Assegnazione keyword alle categorie fisse
-        # =====================================================
-        st.info(f"📦 **FASE 2**: Assegnazione keyword alle {len(defined_categories)} categorie definite...")
 
-        if len(keywords_list) > batch_size:
-            st.text(f"Elaborazione in {total_batches} batch da ~{batch_size} keywords...")
+USAGE_FIELDS = ("input_tokens", "output_tokens", "cache_creation_input_tokens", "cache_read_input_tokens")
+# Sotto questa lunghezza (Sonnet) la prompt cache non viene creata: cache_control non servirebbe a nulla
+PROMPT_CACHE_MIN_TOKENS = 1024
+# Versione di prompt/output FASE 2 salvata con ogni job Message Batches:
+# 1 = cluster JSON con keyword ripetute, 2 = assegnazioni compatte [numero, id categoria, brand]
+ASSIGNMENT_FORMAT_VERSION = 2
 
-        # Prepara testo categorie per i prompt
-        categories_text_for_prompt = "\n".join(
-            f"- **{cat['name']}**: {cat['description']}"
-            for cat in defined_categories
-        )
 
-        # Prepare context sections
-        context_section = ""
+def usage_counts(usage):
+    """Token di una risposta, inclusi quelli scritti/letti dalla prompt cache (None se la cache non è usata)."""
+    return {field: getattr(usage, field, None) or 0 for field in USAGE_FIELDS}
+
+
+class AnthropicRateBudget:
+    """
+    Budget condiviso dai thread della FASE 2: richieste, token di input e token di output al minuto
+    (token bucket con ricarica continua). Parte dai limiti della sidebar e si allinea ai valori reali
+    degli header anthropic-ratelimit-* (limite, residuo, reset); su 429 tutti aspettano il retry-after.
+    """
+
+    def __init__(self, requests_per_min, input_tokens_per_min, output_tokens_per_min):
+        self.limits = {
+            "requests": float(requests_per_min),
+            "input-tokens": float(input_tokens_per_min),
+            "output-tokens": float(output_tokens_per_min),
+        }
+        self.available = dict(self.limits)
+        self._updated = time.monotonic()
+        self._paused_until = 0.0
+        self._cond = threading.Condition()
+        self.wait_s = 0.0
+        self.throttled = 0
+
+    def _refill(self, now):
+        elapsed = now - self._updated
+        for dim, limit in self.limits.items():
+            self.available[dim] = min(limit, self.available[dim] + elapsed * limit / 60.0)
+        self._updated = now
+
+    def acquire(self, input_tokens, output_tokens):
+        """Blocca finché c'è budget per una richiesta con i token stimati, poi li prenota."""
+        need = {"requests": 1, "input-tokens": input_tokens, "output-tokens": output_tokens}
+        started = time.monotonic()
+        with self._cond:
+            while True:
+                now = time.monotonic()
+                self._refill(now)
+                wait = self._paused_until - now
+                if wait <= 0:
+                    # Una richiesta più grande dell'intero limite parte a bucket pieno (il residuo va in negativo)
+                    wait = max((min(need[d], self.limits[d]) - self.available[d]) * 60.0 / self.limits[d] for d in need)
+                    if wait <= 0:
+                        for dim in need:
+                            self.available[dim] -= need[dim]
+                        break
+                self._cond.wait(timeout=min(wait, 5.0))
+            self.wait_s += time.monotonic() - started
+
+    def settle(self, reserved_input, reserved_output, used_input, used_output):
+        """Restituisce (o addebita) la differenza tra token prenotati e token realmente usati."""
+        with self._cond:
+            self._refill(time.monotonic())
+            for dim, delta in (("input-tokens", reserved_input - used_input), ("output-tokens", reserved_output - used_output)):
+                self.available[dim] = min(self.limits[dim], self.available[dim] + delta)
+            self._cond.notify_all()
+
+    def update_from_headers(self, headers):
+        with self._cond:
+            now = time.monotonic()
+            self._refill(now)
+            for dim in RATE_LIMIT_DIMENSIONS:
+                limit = _header_number(headers, f"anthropic-ratelimit-{dim}-limit")
+                remaining = _header_number(headers, f"anthropic-ratelimit-{dim}-remaining")
+                if limit:
+                    self.limits[dim] = limit
+                if remaining is not None:
+                    self.available[dim] = min(self.available[dim], remaining)
+                    reset_in = _header_reset_in(headers, f"anthropic-ratelimit-{dim}-reset")
+                    if remaining < 1 and reset_in:
+                        self._paused_until = max(self._paused_until, now + reset_in)
+            self._cond.notify_all()
+
+    def pause(self, seconds):
+        with self._cond:
+            self.throttled += 1
+            self._paused_until = max(self._paused_until, time.monotonic() + seconds)
+            self._cond.notify_all()
+
+
+class AssignmentStreamParser:
+    """
+    Parser JSON incrementale per {"assignments": [[n, id, "Brand"], ...]}: riceve il testo a pezzi
+    (streaming) e restituisce ogni voce appena la sua parentesi si chiude. Markdown o testo attorno
+    vengono ignorati; una coda troncata o malformata fa perdere solo le voci incomplete.
+    """
+
+    def __init__(self):
+        self.entries = []
+        self._buffer = ""
+        self._pos = 0
+        self._in_list = False
+        self._item_start = None
+        self._in_string = False
+        self._escape = False
+        self.done = False
+
+    def feed(self, chunk):
+        """Aggiunge testo e ritorna le voci completate da questo pezzo."""
+        self._buffer += chunk
+        buffer = self._buffer
+        if not self._in_list:
+            key = buffer.find('"assignments"')
+            list_start = buffer.find("[", key) if key != -1 else -1
+            if list_start == -1:
+                return []
+            self._in_list = True
+            self._pos = list_start + 1
+
+        new_entries = []
+        pos = self._pos
+        while pos < len(buffer) and not self.done:
+            ch = buffer[pos]
+            if self._item_start is None:
+                if ch == "[":
+                    self._item_start = pos
+                elif ch == "]":
+                    self.done = True  # fine della lista assignments
+            elif self._in_string:
+                if self._escape:
+                    self._escape = False
+                elif ch == "\\":
+                    self._escape = True
+                elif ch == '"':
+                    self._in_string = False
+            elif ch == '"':
+                self._in_string = True
+            elif ch == "[":
+                self._item_start = pos  # voce precedente mai chiusa: si riparte da qui
+            elif ch == "]":
+                try:
+                    new_entries.append(json.loads(buffer[self._item_start:pos + 1]))
+                except json.JSONDecodeError:
+                    pass  # voce malformata: la keyword resta mancante e viene riaccodata
+                self._item_start = None
+            pos += 1
+        self._pos = pos
+        self.entries.extend(new_entries)
+        return new_entries
+
+    @property
+    def text(self):
+        """Tutto il testo ricevuto finora."""
+        return self._buffer
+
+
+def _partial_usage(stream, parser):
+    """
+    Token già fatturati da uno stream interrotto: input (e cache) da message_start, output dall'ultimo
+    message_delta visto; se il message_delta non è mai arrivato l'output si stima dal testo ricevuto.
+    """
+    usage = dict.fromkeys(USAGE_FIELDS, 0)
+    try:
+        snapshot = stream.current_message_snapshot if stream is not None else None
+    except AssertionError:  # nessun message_start ricevuto
+        snapshot = None
+    if snapshot is not None and snapshot.usage is not None:
+        usage = usage_counts(snapshot.usage)
+    if parser.text:
+        usage["output_tokens"] = max(usage["output_tokens"], estimate_tokens(parser.text))
+    return usage
+
 
-        if products_list:
-            products_text = "\n".join(f"- {p}" for p in products_list)
-            context_section += f"""
+def _interrupted_stream(parser, usage, retries):
+    """Stream interrotto dopo alcune voci: si tengono quelle, le keyword mancanti vengono riaccodate."""
+    return {"entries": parser.entries, "usage": usage, "retries": retries, "stop_reason": "interrupted"}
+
+
+def assign_batch_claude(client, budget, system, prompt, est_input, est_output, on_entries=None, max_retries=4):
+    """
+    Chiamata FASE 2 di un batch in streaming (gira in un thread del pool: niente st.* qui).
+    Le voci vengono passate a on_entries man mano che si chiudono nel testo ricevuto.
+    Ritorna un dict con entries, usage, retries, stop_reason oppure error.
+    """
+    retries = 0
+    while True:
+        budget.acquire(est_input, est_output)
+        parser = AssignmentStreamParser()
+        stream = None
+        try:
+            with client.messages.stream(
+                model=CLAUDE_MODEL,
+                # Margine doppio sull'output stimato: l'output compatto non arriva mai vicino al limite
+                max_tokens=2 * est_output,
+                system=system,
+                messages=[{"role": "user", "content": prompt}]
+            ) as stream:
+                budget.update_from_headers(stream.response.headers)
+                for text in stream.text_stream:
+                    entries = parser.feed(text)
+                    if entries and on_entries:
+                        on_entries(entries)
+                response = stream.get_final_message()
+        except RateLimitError as e:
+            # Richiesta rifiutata: i token prenotati tornano nel budget, si aspetta il retry-after
+            budget.settle(est_input, est_output, 0, 0)
+            budget.update_from_headers(e.response.headers)
+            retry_after = _header_number(e.response.headers, "retry-after")
+            budget.pause(retry_after if retry_after is not None else 15 * (retries + 1))
+            retries += 1
+            if retries > max_retries:
+                return {"error": f"Rate limit superato dopo {max_retries} tentativi."}
+            continue
+        except (APIConnectionError, APIStatusError) as e:
+            # I token già fatturati (stream partito e poi interrotto) restano addebitati nel budget
+            usage = _partial_usage(stream, parser)
+            budget.settle(est_input, est_output, usage["input_tokens"] + usage["cache_creation_input_tokens"], usage["output_tokens"])
+            if parser.entries:
+                return _interrupted_stream(parser, usage, retries)
+            # Overloaded (529), 5xx e problemi di rete: backoff con jitter; gli altri 4xx non si ritentano
+            if isinstance(e, APIStatusError) and e.status_code < 500:
+                return {"error": f"Errore API: {str(e)}"}
+            retries += 1
+            if retries > max_retries:
+                return {"error": f"Errore API dopo {max_retries} tentativi: {str(e)}"}
+            time.sleep(random.uniform(0, min(60, 2 ** retries)))
+            continue
+        except Exception as e:
+            # Anche gli errori di rete a metà stream arrivano qui (non sono convertiti dall'SDK)
+            usage = _partial_usage(stream, parser)
+            budget.settle(est_input, est_output, usage["input_tokens"] + usage["cache_creation_input_tokens"], usage["output_tokens"])
+            if parser.entries:
+                return _interrupted_stream(parser, usage, retries)
+            return {"error": f"Errore API: {str(e)}"}
+
+        usage = usage_counts(response.usage)
+        # Le letture dalla cache non contano nel limite di input token al minuto, le scritture sì
+        budget.settle(est_input, est_output, usage["input_tokens"] + usage["cache_creation_input_tokens"], usage["output_tokens"])
+        return {"entries": parser.entries, "usage": usage, "retries": retries, "stop_reason": response.stop_reason}
+
+
+def assignments_to_clusters(assignments, batch_keywords, defined_categories):
+    """
+    Ricostruisce i cluster dal formato compatto [numero keyword, id categoria, brand opzionale]:
+    testo della keyword da batch_keywords, nome e descrizione dalla categoria della FASE 1.
+    Voci fuori range o keyword già assegnate vengono ignorate.
+    """
+    by_category = {}
+    assigned = set()
+    for entry in assignments:
+        if not isinstance(entry, list) or len(entry) < 2:
+            continue
+        try:
+            kw_number, category_id = int(entry[0]), int(entry[1])
+        except (TypeError, ValueError):
+            continue
+        if not 1 <= kw_number <= len(batch_keywords) or not 1 <= category_id <= len(defined_categories) or kw_number in assigned:
+            continue
+        assigned.add(kw_number)
+        brand = entry[2].strip() if len(entry) > 2 and isinstance(entry[2], str) and entry[2].strip() else None
+        by_category.setdefault(category_id, []).append({'keyword': batch_keywords[kw_number - 1], 'brand': brand})
+
+    return [
+        {
+            'cluster_name': defined_categories[category_id - 1]['name'],
+            'description': defined_categories[category_id - 1]['description'],
+            'keywords': keywords
+        }
+        for category_id, keywords in sorted(by_category.items())
+    ]
+
+
+def clusters_from_entries(entries, batch_keywords, defined_categories):
+    """Cluster normalizzati dalle voci ricevute + keyword del batch rimaste senza assegnazione."""
+    clusters = normalize_clusters({'clusters': assignments_to_clusters(entries, batch_keywords, defined_categories)})
+    assigned = {kw['keyword'] for c in clusters for kw in c['keywords']}
+    return clusters, [kw for kw in batch_keywords if kw not in assigned]
+
+
+def parse_assignment_response(result_text, batch_keywords, defined_categories):
+    """Come clusters_from_entries, per una risposta già completa (anche troncata o con testo attorno al JSON)."""
+    parser = AssignmentStreamParser()
+    parser.feed(result_text or "")
+    return clusters_from_entries(parser.entries, batch_keywords, defined_categories)
+
+
+def parse_legacy_assignment_response(result_text, batch_keywords, defined_categories):
+    """
+    Risposta nel formato 1 ({"clusters": [{"cluster_name", "keywords": [{"keyword", "brand"}]}]}),
+    convertita in voci compatte: categorie riconosciute per nome, keyword per testo.
+    """
+    start, end = (result_text or "").find("{"), (result_text or "").rfind("}")
+    try:
+        legacy = json.loads(result_text[start:end + 1]) if 0 <= start < end else {}
+    except json.JSONDecodeError:
+        legacy = {}
+    category_ids = {cat['name'].strip().lower(): cat_id for cat_id, cat in enumerate(defined_categories, 1)}
+    kw_numbers = {kw: kw_number for kw_number, kw in enumerate(batch_keywords, 1)}
+    entries = []
+    for cluster in normalize_clusters(legacy if isinstance(legacy, dict) else {}):
+        category_id = category_ids.get(str(cluster['cluster_name']).strip().lower())
+        if category_id is None:
+            continue
+        for kw in cluster['keywords']:
+            if kw['keyword'] in kw_numbers:
+                entries.append([kw_numbers[kw['keyword']], category_id, kw['brand'] or ""])
+    return clusters_from_entries(entries, batch_keywords, defined_categories)
+
+# ===============================
+# Funzione clustering (Claude)
+# ===============================
+def build_context_section(products_list=None, macro_theme=None):
+    context_section = ""
+
+    if products_list:
+        products_text = "\n".join(f"- {p}" for p in products_list)
+        context_section += f"""
 PRODUCT CONTEXT:
 These are the products we're analyzing keywords for:
 {products_text}
@@ -747,27 +1076,36 @@ IMPORTANT: When you see these product names in keywords, treat them as PRODUCTS
 Example: If "correttore" is in the product list, keywords like "correttore kiko" should be categorized based on INTENT, not treated as a different product type.
 """
 
-        if macro_theme:
-            context_section += f"""
+    if macro_theme:
+        context_section += f"""
 MACRO THEME(S): {macro_theme}
 Use this theme to better understand the overall context of the keyword research.
 """
 
-        for batch_idx in range(total_batches):
-            start_idx = batch_idx * batch_size
-            end_idx = min(start_idx + batch_size, len(keywords_list))
-            batch_keywords = keywords_list[start_idx:end_idx]
+    return context_section
+
+
+def build_assignment_system(defined_categories, products_list=None, macro_theme=None):
+    """
+    Parte fissa del prompt FASE 2 (contesto, categorie, regole, schema JSON), identica per tutti i batch.
+    Va nel system con cache_control (solo se supera PROMPT_CACHE_MIN_TOKENS): dal secondo batch in poi
+    viene letta dalla prompt cache.
+    """
+    # Prepara testo categorie per i prompt: l'id numerico è quello usato nell'output
+    categories_text_for_prompt = "\n".join(
+        f"{cat_id}. **{cat['name']}**: {cat['description']}"
+        for cat_id, cat in enumerate(defined_categories, 1)
+    )
 
-            if total_batches > 1:
-                st.text(f"📦 Batch {batch_idx + 1}/{total_batches}: keywords {start_idx+1}-{end_idx}")
+    context_section = build_context_section(products_list, macro_theme)
 
-            # =====================================================
-            # FASE 2: Prompt per assegnazione a categorie FISSE
-            # =====================================================
-            # Le categorie sono già state definite nella FASE 1
-            # L'AI deve SOLO assegnare, NON creare nuove categorie
+    # =====================================================
+    # FASE 2: Prompt per assegnazione a categorie FISSE
+    # =====================================================
+    # Le categorie sono già state definite nella FASE 1
+    # L'AI deve SOLO assegnare, NON creare nuove categorie
 
-            prompt = f"""You are an expert SEO keyword intent analyzer.
+    system_text = f"""You are an expert SEO keyword intent analyzer.
 
 CRITICAL TASK: Assign each keyword to ONE of the predefined categories below.
 
@@ -775,184 +1113,537 @@ CRITICAL TASK: Assign each keyword to ONE of the predefined categories below.
 
 {context_section}
 
-PREDEFINED CATEGORIES (use EXACTLY these names):
+PREDEFINED CATEGORIES (id. name: description):
 {categories_text_for_prompt}
 
-KEYWORDS TO CATEGORIZE ({len(batch_keywords)}):
-{chr(10).join(f"{i+1}. {kw}" for i, kw in enumerate(batch_keywords))}
-
 ASSIGNMENT RULES:
 1. EVERY keyword MUST be assigned to exactly ONE category from the list above
 2. Use the category DESCRIPTION to decide where each keyword belongs
 3. Think: "WHY is the user searching this?" and match to the best fitting category
 4. If a keyword could fit multiple categories, choose the MOST SPECIFIC one
 5. Do NOT create new categories - use ONLY the {len(defined_categories)} categories listed above
-6. Use the EXACT category names as shown above (case-sensitive)
+6. Refer to categories ONLY by their numeric id (1-{len(defined_categories)})
 
 BRAND DETECTION:
 - If keyword contains a recognizable brand name (Armani, Dior, MAC, Nike, Apple, Samsung, KIKO, etc.), extract it
-- Put brand name in "brand" field (capitalize properly)
+- Capitalize the brand name properly
 
-OUTPUT FORMAT:
-- Category names: Use EXACTLY as shown above (in {output_language})
-- Keywords: Keep in original language
-- Description: Brief (max 10 words, in {output_language})
+OUTPUT FORMAT (compact, index-based):
+- One entry per keyword, in list order: [keyword_number, category_id]
+- If the keyword contains a brand, add it as third element: [keyword_number, category_id, "Brand"]
+- Do NOT repeat keyword text, category names or descriptions
 
 JSON FORMAT:
-{{
-  "clusters": [
-    {{
-      "cluster_name": "EXACT category name from the list above",
-      "keywords": [
-        {{
-          "keyword": "the keyword (original language)",
-          "brand": "Brand Name or null"
-        }}
-      ],
-      "description": "Brief reason in {output_language} (max 10 words)"
-    }}
-  ]
-}}
+{{"assignments": [[1, 3], [2, 1, "Dior"], [3, 2]]}}
 
 REMEMBER: Use ONLY the {len(defined_categories)} predefined categories. Every keyword must be assigned."""
 
-            # Retry & call
-            max_retries = 3
-            retry_count = 0
-            response = None
+    system_block = {"type": "text", "text": system_text}
+    if estimate_tokens(system_text) >= PROMPT_CACHE_MIN_TOKENS:
+        system_block["cache_control"] = {"type": "ephemeral"}
+    return [system_block]
 
-            while retry_count < max_retries:
-                try:
-                    response = client.messages.create(
-                        model="claude-sonnet-4-20250514",
-                        max_tokens=20000,
-                        messages=[{"role": "user", "content": prompt}]
-                    )
-                    break
-                except Exception as e:
-                    if "rate_limit" in str(e).lower():
-                        retry_count += 1
-                        if retry_count < max_retries:
-                            wait_time = 60 * retry_count
-                            st.warning(f"⏳ Rate limit. Attesa {wait_time}s (tentativo {retry_count}/{max_retries})...")
-                            time.sleep(wait_time)
-                        else:
-                            return None, f"Rate limit superato dopo {max_retries} tentativi."
-                    else:
-                        return None, f"Errore API: {str(e)}"
-
-            # Delay tra batch
-            if batch_idx < total_batches - 1:
-                st.info("⏱️ Pausa 60s per rate limit...")
-                time.sleep(60)
-
-            result_text = (response.content[0].text if response and response.content else "").strip()
-            if not result_text:
-                return None, f"Batch {batch_idx+1}: risposta vuota"
-
-            # Clean markdown
-            if "```json" in result_text:
-                result_text = result_text.split("```json")[1].split("```")[0].strip()
-            elif "```" in result_text:
-                result_text = result_text.split("```")[1].split("```")[0].strip()
-
-            # Extract JSON
-            start = result_text.find("{")
-            end = result_text.rfind("}")
-            if start == -1 or end == -1:
-                st.error(f"Batch {batch_idx+1}: JSON non trovato")
-                st.code(result_text[:300])
-                return None, "JSON invalido"
 
-            result_text = result_text[start:end+1]
+def build_assignment_batches(keywords_list, batch_size, defined_categories, products_list=None, macro_theme=None):
+    """
+    Prompt FASE 2: (system condiviso, lista di (batch_idx, batch_keywords, prompt, input stimato, output stimato)).
+    Il prompt del batch contiene solo le keyword. Dipendono solo dai parametri: un job Message Batches
+    salvato si ricostruisce identico.
+    """
+    system = build_assignment_system(defined_categories, products_list, macro_theme)
+    system_tokens = estimate_tokens(system[0]["text"])
+    total_batches = (len(keywords_list) + batch_size - 1) // batch_size
 
-            # Tentativo chiusura se troncato
-            if not result_text.endswith("}"):
-                st.warning(f"⚠️ Batch {batch_idx+1}: Risposta troncata, tentativo recupero...")
-                open_brackets = result_text.count("[") - result_text.count("]")
-                open_braces = result_text.count("{") - result_text.count("}")
-                if open_brackets > 0:
-                    result_text += "]" * open_brackets
-                if open_braces > 0:
-                    result_text += "}" * open_braces
-
-            # Parse
-            try:
-                batch_result = json.loads(result_text)
+    batches = []
+    for batch_idx in range(total_batches):
+        start_idx = batch_idx * batch_size
+        end_idx = min(start_idx + batch_size, len(keywords_list))
+        batches.append(make_assignment_batch(batch_idx, keywords_list[start_idx:end_idx], system_tokens))
 
-                if not isinstance(batch_result, dict) or 'clusters' not in batch_result:
-                    st.error(f"❌ Batch {batch_idx+1}: Struttura JSON invalida")
-                    st.code(result_text[:500])
-                    return None, "Struttura JSON non valida"
+    return system, batches
 
-                normalized = normalize_clusters(batch_result)
-                batch_result['clusters'] = normalized
 
-                batch_kw_count = sum(len(c.get('keywords', [])) for c in batch_result['clusters'])
-                if batch_kw_count < len(batch_keywords):
-                    missing = len(batch_keywords) - batch_kw_count
-                    st.warning(f"⚠️ Batch {batch_idx+1}: {missing} keyword non categorizzate ({batch_kw_count}/{len(batch_keywords)})")
+def make_assignment_batch(batch_idx, batch_keywords, system_tokens):
+    """Un batch FASE 2: (batch_idx, batch_keywords, prompt, input stimato, output stimato)."""
+    prompt = f"""KEYWORDS TO CATEGORIZE ({len(batch_keywords)}):
+{chr(10).join(f"{i+1}. {kw}" for i, kw in enumerate(batch_keywords))}
+
+Assign EVERY keyword above to one of the predefined categories and return ONLY the JSON."""
+
+    # Output stimato: ~10 token per voce [numero, id, "Brand"]
+    est_output = 10 * len(batch_keywords) + 50
+    return (batch_idx, batch_keywords, prompt, system_tokens + estimate_tokens(prompt), est_output)
+
+
+def run_assignment_batches(client, system, defined_categories, batches, concurrency, rate_limits):
+    """
+    FASE 2 in tempo reale: batch in streaming e in parallelo entro il budget RPM/token, nessuna pausa fissa.
+    Se il system è cacheable il primo batch parte da solo e scrive la prompt cache, gli altri la leggono;
+    altrimenti partono tutti subito.
+    Le assegnazioni compaiono a video mentre arrivano; le keyword mancanti (risposta troncata o
+    malformata) vengono riaccodate in un nuovo batch fino a MAX_REQUEUE_ROUNDS volte.
+    Un batch fallito non butta quelli già completati (e pagati): le sue keyword seguono la stessa strada
+    (riaccodate, poi "Non Categorizzate"). Errore solo se non è riuscito nessun batch.
+    Ritorna (risultati per batch_idx, statistiche, errore).
+    """
+    total_batches = len(batches)
+    batch_sizes = {batch[0]: len(batch[1]) for batch in batches}
+    total_keywords = sum(batch_sizes.values())
+    system_tokens = estimate_tokens(system[0]["text"])
+    budget = AnthropicRateBudget(*rate_limits)
+    fase2_client = client.with_options(max_retries=0)  # i retry li gestisce assign_batch_claude
+    batch_results = {}
+    usage_totals = dict.fromkeys(USAGE_FIELDS, 0)
+    retries = 0
+    requeued = 0
+    requeue_rounds = {}
+    batch_errors = []
+    done_count = 0
+    fase2_start = time.monotonic()
+    fase2_progress = st.progress(0.0, text=f"FASE 2: 0/{total_batches} batch")
+
+    # Anteprima live: ultime assegnazioni ricevute dallo stream (i thread accodano, il main thread disegna)
+    live_entries = queue.Queue()
+    live_recent = deque(maxlen=LIVE_PREVIEW_ROWS)
+    live_assigned = 0
+    live_view = st.empty()
+
+    pool = ThreadPoolExecutor(max_workers=max(1, min(concurrency, total_batches)))
+    pending = {}
+
+    def submit(batch):
+        future = pool.submit(
+            assign_batch_claude, fase2_client, budget, system, batch[2], batch[3], batch[4],
+            on_entries=lambda entries: live_entries.put((batch[1], entries))
+        )
+        pending[future] = batch
+
+    to_submit = list(batches)
+    try:
+        if system[0].get("cache_control"):
+            submit(to_submit.pop(0))
+        else:
+            for batch in to_submit:
+                submit(batch)
+            to_submit = []
+        while pending:
+            done, _ = wait(pending, timeout=0.25, return_when=FIRST_COMPLETED)
+
+            received = 0
+            while not live_entries.empty():
+                batch_keywords, entries = live_entries.get_nowait()
+                for cluster in assignments_to_clusters(entries, batch_keywords, defined_categories):
+                    for kw in cluster['keywords']:
+                        live_recent.appendleft({'Keyword': kw['keyword'], 'Categoria': cluster['cluster_name'],
+                                                'Brand': kw['brand'] or ''})
+                        received += 1
+            if received:
+                live_assigned += received
+                with live_view.container():
+                    st.caption(f"⚡ {live_assigned}/{total_keywords} keyword assegnate in streaming")
+                    st.dataframe(pd.DataFrame(list(live_recent)), use_container_width=True, hide_index=True)
+
+            for future in done:
+                batch_idx, batch_keywords = pending.pop(future)[:2]
+                outcome = future.result()
+                if outcome.get("error"):
+                    batch_errors.append(f"Batch {batch_idx+1}: {outcome['error']}")
+                    st.warning(f"⚠️ {batch_errors[-1]}")
+                    clusters, missing = [], list(batch_keywords)
                 else:
-                    st.success(f"✅ Batch {batch_idx+1}: {batch_kw_count}/{len(batch_keywords)} keyword categorizzate")
-
-                all_clusters.extend(batch_result['clusters'])
-
-            except json.JSONDecodeError as e:
-                st.error(f"❌ Batch {batch_idx+1}: errore JSON - {str(e)}")
-                st.code(result_text[:500] + "\n...\n" + result_text[-200:])
-                with st.expander("🔍 Debug Info"):
-                    st.text(f"Lunghezza: {len(result_text)} chars")
-                    st.text(f"[ : {result_text.count('[') - result_text.count(']')}")
-                    st.text(f"{{ : {result_text.count('{') - result_text.count('}')}")
-                return None, f"JSON error: {str(e)}"
-
-        # 1. Consolida cluster con lo stesso nome da batch diversi
-        # Non passiamo più max_clusters perché le categorie sono già definite nella FASE 1
-        consolidated_clusters, unique_categories_count = consolidate_clusters(all_clusters)
-
-        # 2. Aggiungi keyword non categorizzate
-        final_clusters, uncategorized_kws = add_uncategorized_keywords(consolidated_clusters, keywords_list)
-
-        # Ricalcola unique categories dopo aver aggiunto "Non Categorizzate"
-        unique_categories = len(final_clusters)
-
-        # Totali
-        total_in_output = sum(len(c.get('keywords', [])) for c in final_clusters)
-        total_categorized = total_in_output - len(uncategorized_kws)
-
-        # Info sui risultati
-        if len(uncategorized_kws) > 0:
-            st.warning(f"⚠️ {len(uncategorized_kws)} keyword non categorizzate - aggiunte alla categoria 'Non Categorizzate'")
-
-        st.success(f"✅ **Clustering completato:** {unique_categories} categorie, {total_categorized}/{len(keywords_list)} keyword categorizzate")
-
-        def cname(c):
-            return (c.get('cluster_name') or '').lower()
-
-        summary = {
-            "total_keywords": total_categorized,
-            "total_keywords_input": len(keywords_list),
-            "total_keywords_output": total_in_output,
-            "total_clusters": len(all_clusters),  # Cluster prima della consolidazione
-            "unique_categories": unique_categories,  # Categorie uniche dopo consolidazione
-            "uncategorized_count": len(uncategorized_kws),
-            "generic_count": sum(len(c.get('keywords', [])) for c in final_clusters if cname(c) == 'generic' or 'generico' in cname(c) or 'générique' in cname(c)),
-            "buy_compare_count": sum(len(c.get('keywords', [])) for c in final_clusters if 'buy' in cname(c) or 'compare' in cname(c) or 'acquist' in cname(c) or 'compar' in cname(c)),
-            "local_count": sum(len(c.get('keywords', [])) for c in final_clusters if 'local' in cname(c) or 'locale' in cname(c)),
-            "howto_count": sum(len(c.get('keywords', [])) for c in final_clusters if 'how to' in cname(c) or 'come' in cname(c) or 'tutorial' in cname(c)),
-            "branded_count": sum(
-                1
-                for c in final_clusters
-                for kw in c.get('keywords', [])
-                if isinstance(kw, dict) and kw.get('brand')
-            )
-        }
+                    clusters, missing = clusters_from_entries(outcome["entries"], batch_keywords, defined_categories)
+                    for field in USAGE_FIELDS:
+                        usage_totals[field] += outcome["usage"][field]
+                    retries += outcome["retries"]
+                batch_results.setdefault(batch_idx, []).extend(clusters)
+
+                if missing and requeue_rounds.get(batch_idx, 0) < MAX_REQUEUE_ROUNDS:
+                    requeue_rounds[batch_idx] = requeue_rounds.get(batch_idx, 0) + 1
+                    requeued += len(missing)
+                    st.warning(f"⚠️ Batch {batch_idx+1}: {len(missing)} keyword senza assegnazione, riaccodate")
+                    submit(make_assignment_batch(batch_idx, missing, system_tokens))
+                    continue
+
+                done_count += 1
+                batch_kw_count = batch_sizes[batch_idx] - len(missing)
+                if missing:
+                    st.warning(f"⚠️ Batch {batch_idx+1}: {len(missing)} keyword non categorizzate ({batch_kw_count}/{batch_sizes[batch_idx]})")
+                else:
+                    st.success(f"✅ Batch {batch_idx+1}: {batch_kw_count}/{batch_sizes[batch_idx]} keyword categorizzate")
+                fase2_progress.progress(done_count / total_batches, text=f"FASE 2: {done_count}/{total_batches} batch")
+
+            # Cache scritta dal primo batch: ora partono tutti gli altri
+            if done and to_submit:
+                for batch in to_submit:
+                    submit(batch)
+                to_submit = []
+    finally:
+        # Su errore i batch non ancora partiti vengono annullati
+        pool.shutdown(wait=False, cancel_futures=True)
+
+    fase2_progress.empty()
+    live_view.empty()
+    if batch_errors and not any(batch_results.values()):
+        return None, None, batch_errors[0]
+    stats = {
+        "fase2_mode": "realtime",
+        "fase2_batches": total_batches,
+        "fase2_seconds": round(time.monotonic() - fase2_start, 1),
+        "rate_limit_wait_seconds": round(budget.wait_s, 1),
+        "rate_limit_hits": budget.throttled,
+        "api_retries": retries,
+        "requeued_keywords": requeued,
+        **usage_totals
+    }
+    return batch_results, stats, None
+
+
+def cache_hit_rate(summary):
+    """Quota dei token di input FASE 2 serviti dalla prompt cache."""
+    total_input = summary["input_tokens"] + summary["cache_creation_input_tokens"] + summary["cache_read_input_tokens"]
+    return summary["cache_read_input_tokens"] / total_input if total_input else 0.0
+
+
+def finalize_clustering(batch_results, keywords_list, stats):
+    """Unisce i batch, consolida i cluster, aggiunge le non categorizzate e calcola il summary."""
+    all_clusters = []
+    # Stesso ordine dell'elaborazione sequenziale: il consolidamento resta deterministico
+    for batch_idx in sorted(batch_results):
+        all_clusters.extend(batch_results[batch_idx])
+
+    # 1. Consolida cluster con lo stesso nome da batch diversi
+    # Non passiamo più max_clusters perché le categorie sono già definite nella FASE 1
+    consolidated_clusters, unique_categories_count = consolidate_clusters(all_clusters)
+
+    # 2. Aggiungi keyword non categorizzate
+    final_clusters, uncategorized_kws = add_uncategorized_keywords(consolidated_clusters, keywords_list)
+
+    # Ricalcola unique categories dopo aver aggiunto "Non Categorizzate"
+    unique_categories = len(final_clusters)
+
+    # Totali
+    total_in_output = sum(len(c.get('keywords', [])) for c in final_clusters)
+    total_categorized = total_in_output - len(uncategorized_kws)
+
+    # Info sui risultati
+    if len(uncategorized_kws) > 0:
+        st.warning(f"⚠️ {len(uncategorized_kws)} keyword non categorizzate - aggiunte alla categoria 'Non Categorizzate'")
+
+    st.success(f"✅ **Clustering completato:** {unique_categories} categorie, {total_categorized}/{len(keywords_list)} keyword categorizzate")
+
+    def cname(c):
+        return (c.get('cluster_name') or '').lower()
+
+    summary = {
+        "total_keywords": total_categorized,
+        "total_keywords_input": len(keywords_list),
+        "total_keywords_output": total_in_output,
+        "total_clusters": len(all_clusters),  # Cluster prima della consolidazione
+        "unique_categories": unique_categories,  # Categorie uniche dopo consolidazione
+        "uncategorized_count": len(uncategorized_kws),
+        "generic_count": sum(len(c.get('keywords', [])) for c in final_clusters if cname(c) == 'generic' or 'generico' in cname(c) or 'générique' in cname(c)),
+        "buy_compare_count": sum(len(c.get('keywords', [])) for c in final_clusters if 'buy' in cname(c) or 'compare' in cname(c) or 'acquist' in cname(c) or 'compar' in cname(c)),
+        "local_count": sum(len(c.get('keywords', [])) for c in final_clusters if 'local' in cname(c) or 'locale' in cname(c)),
+        "howto_count": sum(len(c.get('keywords', [])) for c in final_clusters if 'how to' in cname(c) or 'come' in cname(c) or 'tutorial' in cname(c)),
+        "branded_count": sum(
+            1
+            for c in final_clusters
+            for kw in c.get('keywords', [])
+            if isinstance(kw, dict) and kw.get('brand')
+        ),
+        **stats
+    }
+
+    return {"clusters": final_clusters, "summary": summary}
+
+
+def cluster_keywords_claude(keywords_list, api_key, batch_size, custom_cats, mode, max_clusters, output_language, products_list=None, macro_theme=None,
+                            concurrency=4, rate_limits=(50, 30000, 8000), fase2_mode="realtime"):
+    try:
+        client = Anthropic(api_key=api_key)
+        total_batches = (len(keywords_list) + batch_size - 1) // batch_size
+
+        # =====================================================
+        # FASE 1: Analisi globale e definizione categorie
+        # =====================================================
+        st.info("🔍 **FASE 1**: Analisi globale delle keyword per definire le categorie ottimali...")
 
-        return {"clusters": final_clusters, "summary": summary}, None
+        defined_categories = analyze_and_define_categories(
+            client=client,
+            all_keywords=keywords_list,
+            max_clusters=max_clusters,
+            output_language=output_language,
+            custom_cats=custom_cats,
+            mode=mode,
+            products_list=products_list,
+            macro_theme=macro_theme
+        )
+
+        if not defined_categories:
+            return None, "Impossibile definire le categorie. Riprova."
+
+        # Mostra le categorie definite
+        st.success(f"✅ **{len(defined_categories)} categorie definite** per il clustering:")
+        categories_preview = ", ".join([f"**{cat['name']}**" for cat in defined_categories])
+        st.markdown(f"📂 {categories_preview}")
+
+        # =====================================================
+        # FASE 2: Assegnazione keyword alle categorie fisse
+        # =====================================================
+        st.info(f"📦 **FASE 2**: Assegnazione keyword alle {len(defined_categories)} categorie definite...")
+
+        if len(keywords_list) > batch_size:
+            st.text(f"Elaborazione in {total_batches} batch da ~{batch_size} keywords...")
+
+        system, batches = build_assignment_batches(keywords_list, batch_size, defined_categories, products_list, macro_theme)
+
+        if fase2_mode == "batch":
+            # Offline: tutti i prompt in un unico job, i risultati si raccolgono dal pannello dei job
+            params = {
+                "keywords": keywords_list,
+                "batch_size": batch_size,
+                "defined_categories": defined_categories,
+                "output_language": output_language,
+                "products_list": products_list,
+                "macro_theme": macro_theme
+            }
+            label = f"{len(keywords_list)} keyword · {len(defined_categories)} categorie · {output_language}"
+            message_batch = submit_assignment_batch_job(client, system, batches, label, params)
+            return {"batch_job": message_batch.id}, None
+
+        batch_results, stats, error = run_assignment_batches(client, system, defined_categories, batches, concurrency, rate_limits)
+        if error:
+            return None, error
+
+        return finalize_clustering(batch_results, keywords_list, stats), None
 
     except Exception as e:
         return None, f"Errore: {str(e)}"
 
+# ===============================
+# Job Message Batches (FASE 2 offline)
+# ===============================
+CLUSTERING_DATA_DIR = Path(__file__).resolve().parent.parent / ".clustering_data"
+BATCH_JOB_POLL_SECONDS = 30
+BATCH_JOB_STATUS_LABELS = {
+    "in_progress": "⏳ In elaborazione",
+    "canceling": "🚫 In annullamento",
+    "ended": "✅ Terminato",
+    "collected": "📥 Risultati caricati",
+}
+BATCH_REQUEST_COUNTS = ("processing", "succeeded", "errored", "canceled", "expired")
+
+
+class BatchJobStore:
+    """
+    Job Message Batches in SQLite: id del batch Anthropic, stato e parametri per ricostruire i prompt.
+    Sopravvivono alla sessione Streamlit; la API key non viene mai salvata, solo il suo hash (`owner`):
+    ogni utente vede, riprende ed elimina soltanto i job inviati con la propria chiave.
+    """
+
+    def __init__(self, path: Path):
+        path.parent.mkdir(parents=True, exist_ok=True)
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(str(path), check_same_thread=False)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute("""
+            CREATE TABLE IF NOT EXISTS batch_jobs (
+                batch_id TEXT PRIMARY KEY,
+                label TEXT NOT NULL,
+                status TEXT NOT NULL,
+                request_counts TEXT NOT NULL,
+                params BLOB NOT NULL,
+                created_at REAL NOT NULL,
+                updated_at REAL NOT NULL,
+                format_version INTEGER,
+                owner TEXT
+            )
+        """)
+        # Job salvati prima della colonna: formato sconosciuto (NULL), riconosciuto dalla risposta
+        columns = {row[1] for row in self._conn.execute("PRAGMA table_info(batch_jobs)")}
+        if "format_version" not in columns:
+            self._conn.execute("ALTER TABLE batch_jobs ADD COLUMN format_version INTEGER")
+        # Job salvati prima della colonna: senza proprietario (NULL), non più visibili da nessuna sessione
+        if "owner" not in columns:
+            self._conn.execute("ALTER TABLE batch_jobs ADD COLUMN owner TEXT")
+        self._conn.execute("CREATE INDEX IF NOT EXISTS idx_batch_jobs_owner ON batch_jobs(owner, created_at)")
+        self._conn.commit()
+
+    def add_job(self, owner: str, batch_id: str, label: str, params: dict, request_counts: dict,
+                format_version: int = ASSIGNMENT_FORMAT_VERSION):
+        body = zlib.compress(json.dumps(params, separators=(",", ":")).encode("utf-8"), 6)
+        now = time.time()
+        with self._lock:
+            self._conn.execute(
+                "INSERT OR REPLACE INTO batch_jobs (batch_id, label, status, request_counts, params, created_at, updated_at, format_version, owner) "
+                "VALUES (?, ?, 'in_progress', ?, ?, ?, ?, ?, ?)",
+                (batch_id, label, json.dumps(request_counts), body, now, now, format_version, owner)
+            )
+            self._conn.commit()
+
+    def update_job(self, owner: str, batch_id: str, status: str, request_counts: dict = None):
+        with self._lock:
+            if request_counts is None:
+                self._conn.execute("UPDATE batch_jobs SET status = ?, updated_at = ? WHERE batch_id = ? AND owner = ?",
+                                   (status, time.time(), batch_id, owner))
+            else:
+                self._conn.execute("UPDATE batch_jobs SET status = ?, request_counts = ?, updated_at = ? WHERE batch_id = ? AND owner = ?",
+                                   (status, json.dumps(request_counts), time.time(), batch_id, owner))
+            self._conn.commit()
+
+    def get_params(self, owner: str, batch_id: str):
+        with self._lock:
+            row = self._conn.execute("SELECT params FROM batch_jobs WHERE batch_id = ? AND owner = ?",
+                                     (batch_id, owner)).fetchone()
+        return None if row is None else json.loads(zlib.decompress(row[0]).decode("utf-8"))
+
+    def get_format_version(self, owner: str, batch_id: str):
+        with self._lock:
+            row = self._conn.execute("SELECT format_version FROM batch_jobs WHERE batch_id = ? AND owner = ?",
+                                     (batch_id, owner)).fetchone()
+        return None if row is None else row[0]
+
+    def jobs(self, owner: str, limit: int = 20):
+        with self._lock:
+            rows = self._conn.execute(
+                "SELECT batch_id, label, status, request_counts, created_at, updated_at, format_version FROM batch_jobs "
+                "WHERE owner = ? ORDER BY created_at DESC LIMIT ?", (owner, limit)
+            ).fetchall()
+        return [
+            {"batch_id": r[0], "label": r[1], "status": r[2], "request_counts": json.loads(r[3]),
+             "created_at": r[4], "updated_at": r[5], "format_version": r[6]}
+            for r in rows
+        ]
+
+    def delete_job(self, owner: str, batch_id: str):
+        with self._lock:
+            self._conn.execute("DELETE FROM batch_jobs WHERE batch_id = ? AND owner = ?", (batch_id, owner))
+            self._conn.commit()
+
+
+@st.cache_resource
+def get_batch_job_store() -> BatchJobStore:
+    return BatchJobStore(CLUSTERING_DATA_DIR / "batch_jobs.sqlite")
+
+
+def api_key_owner(api_key: str) -> str:
+    """Proprietario dei job: hash SHA-256 della API key (la chiave in chiaro non finisce su disco)."""
+    return hashlib.sha256(api_key.encode("utf-8")).hexdigest()
+
+
+def _request_counts(message_batch):
+    return {name: getattr(message_batch.request_counts, name, 0) for name in BATCH_REQUEST_COUNTS}
+
+
+def submit_assignment_batch_job(client, system, batches, label, params):
+    """Invia tutti i prompt FASE 2 come un solo job Message Batches e lo registra su disco."""
+    requests = [
+        {
+            "custom_id": f"batch-{batch_idx}",
+            "params": {
+                "model": CLAUDE_MODEL,
+                "max_tokens": 2 * est_output,
+                "system": system,
+                "messages": [{"role": "user", "content": prompt}]
+            }
+        }
+        for batch_idx, batch_keywords, prompt, est_input, est_output in batches
+    ]
+    message_batch = client.messages.batches.create(requests=requests)
+    get_batch_job_store().add_job(api_key_owner(client.api_key), message_batch.id, label, params,
+                                  _request_counts(message_batch))
+    return message_batch
+
+
+def refresh_batch_job(client, batch_id):
+    """Aggiorna stato e contatori di un job dal server Anthropic."""
+    message_batch = client.messages.batches.retrieve(batch_id)
+    get_batch_job_store().update_job(api_key_owner(client.api_key), batch_id, message_batch.processing_status,
+                                     _request_counts(message_batch))
+    return message_batch
+
+
+def collect_batch_job(client, batch_id, concurrency, rate_limits):
+    """
+    Scarica i risultati di un job terminato e li passa a normalize/consolidate come la FASE 2 in tempo reale.
+    I batch errored/canceled/expired e le keyword rimaste senza assegnazione vengono rieseguiti in tempo reale.
+    Le risposte di job inviati con il formato 1 vengono convertite; formati sconosciuti sono rifiutati.
+    Ritorna (result, errore).
+    """
+    store = get_batch_job_store()
+    owner = api_key_owner(client.api_key)
+    params = store.get_params(owner, batch_id)
+    if params is None:
+        return None, "Job non trovato"
+    format_version = store.get_format_version(owner, batch_id)
+    if format_version not in (None, 1, ASSIGNMENT_FORMAT_VERSION):
+        return None, f"Job creato con un formato di output non supportato (v{format_version}): rilancia il clustering"
+
+    message_batch = client.messages.batches.retrieve(batch_id)
+    if message_batch.processing_status != "ended":
+        return None, "Il job non è ancora terminato"
+
+    keywords_list = params["keywords"]
+    system, batches = build_assignment_batches(
+        keywords_list, params["batch_size"], params["defined_categories"],
+        params.get("products_list"), params.get("macro_theme")
+    )
+    batches_by_id = {f"batch-{batch[0]}": batch for batch in batches}
+    system_tokens = estimate_tokens(system[0]["text"])
+
+    batch_results = {}
+    failed = []
+    usage_totals = dict.fromkeys(USAGE_FIELDS, 0)
+    for entry in client.messages.batches.results(batch_id):
+        batch = batches_by_id.get(entry.custom_id)
+        if batch is None or entry.result.type != "succeeded":
+            continue
+        message = entry.result.message
+        text = (message.content[0].text if message.content else "").strip()
+        # Versione NULL (job salvati prima della colonna): il formato 1 si riconosce dalla chiave "clusters"
+        if format_version == 1 or (format_version is None and '"clusters"' in text):
+            clusters, missing = parse_legacy_assignment_response(text, batch[1], params["defined_categories"])
+        else:
+            clusters, missing = parse_assignment_response(text, batch[1], params["defined_categories"])
+        batch_results[batch[0]] = clusters
+        if missing:
+            failed.append(make_assignment_batch(batch[0], missing, system_tokens))
+        for field, tokens in usage_counts(message.usage).items():
+            usage_totals[field] += tokens
+
+    stats = {
+        "fase2_mode": "batch",
+        "fase2_batches": len(batches),
+        "fase2_seconds": round((message_batch.ended_at - message_batch.created_at).total_seconds(), 1),
+        "batch_api_reruns": 0,
+        "rate_limit_wait_seconds": 0.0,
+        "rate_limit_hits": 0,
+        "api_retries": 0,
+        "requeued_keywords": 0,
+        **usage_totals
+    }
+
+    # Solo le richieste non riuscite (errored/canceled/expired) contano come rielaborazioni del job;
+    # le keyword senza assegnazione dei batch riusciti sono keyword riaccodate
+    unfinished = [batch for batch in batches if batch[0] not in batch_results]
+    stats["batch_api_reruns"] = len(unfinished)
+    stats["requeued_keywords"] = sum(len(batch[1]) for batch in failed)
+    failed += unfinished
+    if failed:
+        st.warning(f"⚠️ {len(unfinished)} batch non completati dal job, {stats['requeued_keywords']} keyword senza "
+                   f"assegnazione: rielaborazione in tempo reale...")
+        rerun_results, rerun_stats, error = run_assignment_batches(client, system, params["defined_categories"], failed, concurrency, rate_limits)
+        if error:
+            return None, error
+        for batch_idx, clusters in rerun_results.items():
+            batch_results.setdefault(batch_idx, []).extend(clusters)
+        for key in ("rate_limit_wait_seconds", "rate_limit_hits", "api_retries", "requeued_keywords", *USAGE_FIELDS):
+            stats[key] += rerun_stats[key]
+
+    result = finalize_clustering(batch_results, keywords_list, stats)
+    store.update_job(owner, batch_id, "collected")
+    return result, None
+
 # ===============================
 # Main logic
 # ===============================
@@ -984,7 +1675,10 @@ if analyze_btn:
                     max_clusters,
                     output_language,
                     products_list,
-                    macro_theme
+                    macro_theme,
+                    concurrency=parallel_batches,
+                    rate_limits=(rpm_limit, itpm_limit, otpm_limit),
+                    fase2_mode="batch" if fase2_mode == "📬 Message Batches API (offline)" else "realtime"
                 )
 
                 progress.progress(100)
@@ -993,6 +1687,14 @@ if analyze_btn:
 
             if error:
                 st.error(f"❌ {error}")
+            elif result.get('batch_job'):
+                st.markdown(f"""
+                <div class='success-box'>
+                📬 <strong>Job Message Batches inviato</strong> ({result['batch_job']})<br>
+                • I risultati si caricano dal pannello "Job Message Batches" a job terminato<br>
+                • Il job resta salvato: puoi chiudere la pagina e tornare più tardi
+                </div>
+                """, unsafe_allow_html=True)
             else:
                 st.session_state['clustering_results'] = result
 
@@ -1002,7 +1704,14 @@ if analyze_btn:
                     f"• {result['summary']['total_keywords']} keywords categorizzate con successo",
                     f"• {uncategorized_count} keywords non categorizzate (incluse nell'output)",
                     f"• **{result['summary']['unique_categories']} CATEGORIE UNICHE** (in {output_language})",
-                    f"• {result['summary']['branded_count']} keywords con brand"
+                    f"• {result['summary']['branded_count']} keywords con brand",
+                    f"• FASE 2: {result['summary']['fase2_batches']} batch in {result['summary']['fase2_seconds']}s "
+                    f"(attesa rate limit {result['summary']['rate_limit_wait_seconds']}s, 429: {result['summary']['rate_limit_hits']}, "
+                    f"retry: {result['summary']['api_retries']}, keyword riaccodate: {result['summary']['requeued_keywords']})",
+                    f"• Token: {result['summary']['input_tokens']} input, {result['summary']['output_tokens']} output",
+                    f"• Prompt cache: {result['summary']['cache_read_input_tokens']} token letti, "
+                    f"{result['summary']['cache_creation_input_tokens']} scritti "
+                    f"({cache_hit_rate(result['summary']):.0%} dell'input FASE 2 dalla cache)"
                 ]
 
                 if products_list:
@@ -1017,6 +1726,71 @@ if analyze_btn:
                 </div>
                 """, unsafe_allow_html=True)
 
+# ===============================
+# Job Message Batches
+# ===============================
+def _batch_jobs_panel():
+    """
+    Job Message Batches salvati su disco: stato aggiornato dal server e caricamento dei risultati a job terminato.
+    Solo i job inviati con la API key inserita: senza chiave il pannello non mostra nulla.
+    """
+    if not api_key:
+        return
+    store = get_batch_job_store()
+    owner = api_key_owner(api_key)
+    jobs = store.jobs(owner)
+    if not jobs:
+        return
+    client = Anthropic(api_key=api_key)
+    st.markdown("### 📬 Job Message Batches")
+
+    for job in jobs:
+        batch_id = job["batch_id"]
+        if job["status"] in ("in_progress", "canceling"):
+            try:
+                message_batch = refresh_batch_job(client, batch_id)
+                job["status"] = message_batch.processing_status
+                job["request_counts"] = _request_counts(message_batch)
+            except Exception as e:
+                st.warning(f"⚠️ {batch_id}: stato non aggiornato ({str(e)})")
+
+        counts = job["request_counts"]
+        total_requests = sum(counts.values())
+        counts_text = " · ".join(f"{name}: {counts.get(name, 0)}" for name in BATCH_REQUEST_COUNTS)
+        with st.container(border=True):
+            st.markdown(f"**{job['label']}** — {BATCH_JOB_STATUS_LABELS.get(job['status'], job['status'])}")
+            st.caption(f"{batch_id} · inviato il {datetime.fromtimestamp(job['created_at']).strftime('%Y-%m-%d %H:%M')}")
+            if job["status"] in ("in_progress", "canceling") and total_requests:
+                st.progress((total_requests - counts.get("processing", 0)) / total_requests, text=counts_text)
+            elif total_requests:
+                st.caption(counts_text)
+
+            col_job1, col_job2, col_job3 = st.columns(3)
+            if job["status"] in ("ended", "collected"):
+                if col_job1.button("📥 Carica risultati", key=f"collect_{batch_id}", use_container_width=True):
+                    with st.spinner("Caricamento risultati del job..."):
+                        result, error = collect_batch_job(client, batch_id, parallel_batches, (rpm_limit, itpm_limit, otpm_limit))
+                    if error:
+                        st.error(f"❌ {error}")
+                    else:
+                        st.session_state['clustering_results'] = result
+                        st.rerun(scope="app")
+            if job["status"] == "in_progress":
+                if col_job2.button("🚫 Annulla", key=f"cancel_{batch_id}", use_container_width=True):
+                    client.messages.batches.cancel(batch_id)
+                    store.update_job(owner, batch_id, "canceling")
+                    st.rerun()
+            if job["status"] in ("ended", "collected"):
+                if col_job3.button("🗑️ Rimuovi", key=f"remove_{batch_id}", use_container_width=True):
+                    store.delete_job(owner, batch_id)
+                    st.rerun()
+
+# Polling solo finché ci sono job ancora in elaborazione di questa API key
+pending_batch_jobs = bool(api_key) and any(
+    job["status"] in ("in_progress", "canceling") for job in get_batch_job_store().jobs(api_key_owner(api_key))
+)
+st.fragment(run_every=BATCH_JOB_POLL_SECONDS if pending_batch_jobs else None)(_batch_jobs_panel)()
+
 # ===============================
 # Results
 # ===============================
@@ -1042,6 +1816,13 @@ if 'clustering_results' in st.session_state:
     with col_stat4:
         st.metric("Non Categorizzate", uncategorized)
 
+    if 'cache_read_input_tokens' in result['summary']:
+        st.caption(
+            f"FASE 2 · token input {result['summary']['input_tokens']}, output {result['summary']['output_tokens']} · "
+            f"prompt cache: {result['summary']['cache_read_input_tokens']} letti, "
+            f"{result['summary']['cache_creation_input_tokens']} scritti ({cache_hit_rate(result['summary']):.0%} dalla cache)"
+        )
+
     st.markdown("---")
 
     # Costruisci tabella ordinata per categoria